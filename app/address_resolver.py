@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+from app_config import ServerConfig, on_config_reload
+from http_client import qradar_get
+
+SOURCE_ADDRESSES = "source_addresses" #QRADAR endpoint of the source addresses of the offenses
+LOCAL_DESTINATION_ADDRESSES = "local_destination_addresses" #QRADAR endpoint of the local destination addresses of the offenses
+ADDRESS_IP_FIELDS = {SOURCE_ADDRESSES: "source_ip", LOCAL_DESTINATION_ADDRESSES: "local_destination_ip"} #Field with the IP of the address on every endpoint
+
+class AddressResolver:
+    '''Bounded in-memory cache of the IPs of the QRADAR source and local destination address IDs, with a TTL on every entry and LRU eviction.
+    Attacker and target IPs repeat a lot across offenses, so after the first lookup they are resolved without calling QRADAR.
+    The cache can be shared by every thread of the app: all the calls are serialized with a lock. It does not call QRADAR itself, see resolve_addresses.'''
+
+    def __init__(self, ttl:int, max_size:int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cache: OrderedDict = OrderedDict() #LRU cache of (endpoint, address ID) -> (IP, expiration monotonic time)
+        self.lock = threading.Lock()
+
+    def get_cached(self, endpoint:str, address_ids:List[int]) -> Tuple[Dict[int,str],List[int]]:
+        '''Looks up several address IDs on the cache. Expired entries are removed and returned as missing.
+
+        :param str endpoint: SOURCE_ADDRESSES or LOCAL_DESTINATION_ADDRESSES.
+        :param List[int] address_ids: IDs of the addresses.
+        :return: Dictionary with the address ID as key and its IP as value for the cached addresses, and the IDs missing on the cache (without duplicates).
+        :rtype: Tuple[Dict[int,str],List[int]]
+        '''
+        ips = {}
+        missing_address_ids = []
+        now = time.monotonic()
+        with self.lock:
+            for address_id in dict.fromkeys(address_ids):
+                entry = self.cache.get((endpoint, address_id))
+                if entry is not None and entry[1] > now:
+                    self.cache.move_to_end((endpoint, address_id))
+                    ips[address_id] = entry[0]
+                else:
+                    self.cache.pop((endpoint, address_id), None)
+                    missing_address_ids.append(address_id)
+        return ips, missing_address_ids
+
+    def put(self, endpoint:str, ips:Dict[int,str]) -> None:
+        '''Stores the IPs of several address IDs on the cache, evicting the least recently used ones if the cache is full.
+
+        :param str endpoint: SOURCE_ADDRESSES or LOCAL_DESTINATION_ADDRESSES.
+        :param Dict[int,str] ips: Dictionary with the address ID as key and its IP as value.
+        :return: None
+        :rtype: None
+        '''
+        expiration_time = time.monotonic() + self.ttl
+        with self.lock:
+            for address_id, ip in ips.items():
+                self.cache[(endpoint, address_id)] = (ip, expiration_time)
+                self.cache.move_to_end((endpoint, address_id))
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def reconfigure(self, ttl:int, max_size:int) -> None:
+        '''Applies a new TTL and max size to the cache (on a config reload). Cached entries keep their expiration time, and the least recently used ones are evicted if the cache shrinks.
+
+        :param int ttl: Seconds an address IP is kept on the cache.
+        :param int max_size: Maximum number of address IPs kept on the cache.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.ttl = ttl
+            self.max_size = max_size
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+def get_addresses_url(config:ServerConfig, endpoint:str) -> str:
+    '''Returns the URL of a QRADAR addresses endpoint, next to the offenses endpoint on the qradar_url (<console>/api/siem/offenses).
+
+    :param ServerConfig config: Configuration received from the config.ini file
+    :param str endpoint: SOURCE_ADDRESSES or LOCAL_DESTINATION_ADDRESSES.
+    :return: URL of the addresses endpoint.
+    :rtype: str
+    '''
+    return f"{config.qradar_url.rstrip('/').rsplit('/', 1)[0]}/{endpoint}"
+
+def build_addresses_query(endpoint:str, address_ids:List[int]) -> Tuple[Dict[str,str],Dict[str,str]]:
+    '''Builds the query parameters and headers of the QRADAR call resolving a chunk of address IDs with a single filtered call.
+
+    :param str endpoint: SOURCE_ADDRESSES or LOCAL_DESTINATION_ADDRESSES.
+    :param List[int] address_ids: IDs of the addresses of the chunk.
+    :return: Query parameters and headers of the call.
+    :rtype: Tuple[Dict[str,str],Dict[str,str]]
+    '''
+    params = { "filter": f"id in ({','.join(str(address_id) for address_id in address_ids)})", "fields": f"id,{ADDRESS_IP_FIELDS[endpoint]}" }
+    return params, {"RANGE": f"items=0-{len(address_ids) - 1}"}
+
+def parse_addresses_response(endpoint:str, addresses:List[Dict[any,any]]) -> Dict[int,str]:
+    '''Parses the addresses obtained from QRADAR.
+
+    :param str endpoint: SOURCE_ADDRESSES or LOCAL_DESTINATION_ADDRESSES.
+    :param List[Dict[any,any]] addresses: JSON response of the addresses endpoint.
+    :return: Dictionary with the address ID as key and its IP as value.
+    :rtype: Dict[int,str]
+    '''
+    return {address.get('id'): address.get(ADDRESS_IP_FIELDS[endpoint]) for address in addresses}
+
+def split_in_chunks(address_ids:List[int], chunk_size:int) -> List[List[int]]:
+    '''Splits the address IDs in chunks of the given size.
+
+    :param List[int] address_ids: The address IDs to split.
+    :param int chunk_size: Maximum number of address IDs of every chunk.
+    :return: The chunks of address IDs.
+    :rtype: List[List[int]]
+    '''
+    return [address_ids[start:start + chunk_size] for start in range(0, len(address_ids), chunk_size)]
+
+def get_offenses_address_ids(offenses:List[Dict[any,any]]) -> Dict[str,List[int]]:
+    '''Collects the source and local destination address IDs of several offenses.
+
+    :param List[Dict[any,any]] offenses: The offenses obtained from QRADAR SIEM
+    :return: Dictionary with the addresses endpoint as key and the address IDs of the offenses as value.
+    :rtype: Dict[str,List[int]]
+    '''
+    return {
+        SOURCE_ADDRESSES: [address_id for offense in offenses for address_id in offense.get('source_address_ids') or []],
+        LOCAL_DESTINATION_ADDRESSES: [address_id for offense in offenses for address_id in offense.get('local_destination_address_ids') or []],
+    }
+
+def resolve_addresses(endpoint:str, address_ids:List[int]) -> Dict[int,str]:
+    '''Resolves the IPs of several address IDs. Cached addresses are not looked up again, the missing ones are looked up on QRADAR in chunks with a single filtered call (id in (...)) per chunk.
+
+    :param str endpoint: SOURCE_ADDRESSES or LOCAL_DESTINATION_ADDRESSES.
+    :param List[int] address_ids: IDs of the addresses.
+    :return: Dictionary with the address ID as key and its IP as value. Non-existent addresses are not on it.
+    :rtype: Dict[int,str]
+    :raises HttpError: if an error occurred making the HTTP request
+    '''
+    ips, missing_address_ids = address_resolver.get_cached(endpoint, address_ids)
+    for chunk in split_in_chunks(missing_address_ids, config.address_lookup_chunk_size):
+        params, headers = build_addresses_query(endpoint, chunk)
+        response = qradar_get(get_addresses_url(config, endpoint), params=params, headers=headers)
+        response.raise_for_status()
+        resolved_ips = parse_addresses_response(endpoint, response.json())
+        address_resolver.put(endpoint, resolved_ips)
+        ips.update(resolved_ips)
+    return ips
+
+def resolve_offenses_addresses(offenses:List[Dict[any,any]]) -> Dict[str,Dict[int,str]]:
+    '''Resolves the source and local destination IPs of several offenses at once, so a batch of offenses costs at most one QRADAR call per addresses endpoint and chunk.
+
+    :param List[Dict[any,any]] offenses: The offenses obtained from QRADAR SIEM
+    :return: Dictionary with the addresses endpoint as key and the resolved IPs (address ID -> IP) as value.
+    :rtype: Dict[str,Dict[int,str]]
+    :raises HttpError: if an error occurred making the HTTP request
+    '''
+    return {endpoint: resolve_addresses(endpoint, address_ids) for endpoint, address_ids in get_offenses_address_ids(offenses).items()}
+
+def format_offense_ips(offense:Dict[any,any], ips:Dict[str,Dict[int,str]], endpoint:str) -> str:
+    '''Formats the IPs of the source or local destination addresses of an offense for the JIRA ticket. Addresses that could not be resolved are shown with their QRADAR ID.
+
+    :param Dict[any,any] offense: The offense obtained from QRADAR SIEM
+    :param Dict[str,Dict[int,str]] ips: Resolved IPs, as returned by resolve_offenses_addresses.
+    :param str endpoint: SOURCE_ADDRESSES or LOCAL_DESTINATION_ADDRESSES.
+    :return: Comma separated IPs.
+    :rtype: str
+    '''
+    address_ids = offense.get('source_address_ids' if endpoint == SOURCE_ADDRESSES else 'local_destination_address_ids') or []
+    return ', '.join(ips.get(endpoint, {}).get(address_id) or f"address ID {address_id}" for address_id in address_ids)
+
+config: ServerConfig = None
+address_resolver: AddressResolver = None #Cache shared by every thread of the app. Created on init_address_resolver
+address_resolver_lock = threading.Lock()
+
+def init_address_resolver(passedconfig:ServerConfig) -> AddressResolver:
+    '''Initializates the address IPs cache shared by the app threads. The cache is only created once.
+
+    :param ServerConfig passedconfig: Configuration received from the config.ini file
+    :return: The shared address resolver cache.
+    :rtype: AddressResolver
+    '''
+    global config, address_resolver
+    with address_resolver_lock:
+        if address_resolver is None:
+            config = passedconfig
+            address_resolver = AddressResolver(config.address_cache_ttl, config.address_cache_size)
+            on_config_reload(lambda reloaded_config: address_resolver.reconfigure(reloaded_config.address_cache_ttl, reloaded_config.address_cache_size))
+        return address_resolver
@@ -1,6 +1,14 @@
+import atexit
 import configparser
+import copy
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import signal
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Callable, List
 
 class ServerConfig:
     '''Class for app configuration. Contains main configuration variables that are used for the app.'''
@@ -8,15 +16,76 @@ class ServerConfig:
         self.qradar_url = None
         self.qradar_api_key = None
         self.failed_processed_id_file = None
+        self.failed_offenses_store_file = None
+        self.offense_issue_index_file = None
+        self.offense_issue_index_cache_size = None
         self.last_processed_id_file = None
+        self.last_updated_time_file = None
         self.jira_url = None
         self.jira_user = None
         self.jira_api_token = None
         self.jira_project_key = None
         self.logging_level = None
         self.cli_logging_enabled = None
+        self.log_format = None
+        self.log_queue_size = None
+        self.log_queue_full_policy = None
+        self.log_sampling_rate = None
         self.polling_rate_new_offenses_checking = None
         self.polling_rate_offenses_failure_reuploading = None
+        self.adaptive_polling_enabled = None
+        self.max_polling_rate_new_offenses_checking = None
+        self.polling_backoff_factor = None
+        self.new_offenses_probe_enabled = None
+        self.retry_base_delay = None
+        self.retry_max_delay = None
+        self.retry_max_attempts = None
+        self.failed_offenses_lookup_chunk_size = None
+        self.offense_updates_sync_enabled = None
+        self.polling_rate_offense_updates_sync = None
+        self.min_update_interval = None
+        self.max_pending_offense_updates = None
+        self.max_offense_update_attempts = None
+        self.drain_mode_enabled = None
+        self.offenses_page_size = None
+        self.jira_upload_workers = None
+        self.checkpoint_flush_every = None
+        self.checkpoint_flush_interval = None
+        self.jira_bulk_enabled = None
+        self.jira_bulk_batch_size = None
+        self.jira_bulk_max_linger = None
+        self.streaming_json_parsing_enabled = None
+        self.coalescing_enabled = None
+        self.coalescing_key_fields = None
+        self.coalescing_window = None
+        self.address_cache_size = None
+        self.address_cache_ttl = None
+        self.address_lookup_chunk_size = None
+        self.qradar_pool_size = None
+        self.jira_pool_size = None
+        self.http_connect_timeout = None
+        self.http_read_timeout = None
+        self.jira_requests_per_second = None
+        self.jira_burst = None
+        self.jira_max_concurrency = None
+        self.jira_latency_target = None
+        self.jira_throttle_max_retries = None
+        self.circuit_breaker_enabled = None
+        self.circuit_failure_threshold = None
+        self.circuit_open_seconds = None
+        self.jira_spool_file = None
+        self.metrics_enabled = None
+        self.metrics_host = None
+        self.metrics_port = None
+        self.metrics_lag_probe_interval = None
+        self.sharding_enabled = None
+        self.shard_count = None
+        self.shard_lease_file = None
+        self.shard_lease_ttl = None
+        self.shard_instance_id = None
+        self.runtime = None
+        self.async_max_in_flight_requests = None
+        self.config_watch_interval = None
 
 def get_logging_level(level:str):
     '''Maps the logging level string to a corresponding logging level integer valule. If an invalid one is passed, will default to INFO.
@@ -54,16 +123,54 @@ def get_logging_level(level:str):
         print(f"An invalid logging level has been retrieved from the config.ini file. Using default level INFO.")
         return logging.INFO
 
-def init_server_config():
+def get_int_config_value(config:configparser.ConfigParser, section:str, option:str, default:int, minimum:int = 1) -> int:
+    '''Reads an integer option from the configparser. If the option is missing, is not an integer or is lower than the minimum accepted value, a warning is printed and the default value is returned.
+
+    :param ConfigParser config: Configparser with the config.ini file already read.
+    :param str section: Section of the config.ini file where the option is.
+    :param str option: Name of the option to read.
+    :param int default: Value to use if the option is missing or misconfigured.
+    :param int minimum: Minimum accepted value for the option.
+    :return: The integer value of the option.
+    :rtype: int
+    '''
+    try:
+        value = config.getint(section, option, fallback=default)
+    except ValueError:
+        print(f"[QRadar2Jira_Integration] WARNING {option} on section {section} is misconfigured. Should be an integer value. Defaulting to {default}")
+        return default
+    if value < minimum:
+        print(f"[QRadar2Jira_Integration] WARNING {option} on section {section} is misconfigured. Should be an integer value bigger or equal than {minimum}. Defaulting to {default}")
+        return default
+    return value
+
+def get_bool_config_value(config:configparser.ConfigParser, section:str, option:str, default:bool) -> bool:
+    '''Reads a boolean option from the configparser. If the option is missing or is not a valid boolean, the default value is returned.
+
+    :param ConfigParser config: Configparser with the config.ini file already read.
+    :param str section: Section of the config.ini file where the option is.
+    :param str option: Name of the option to read.
+    :param bool default: Value to use if the option is missing or misconfigured.
+    :return: The boolean value of the option.
+    :rtype: bool
+    '''
+    try:
+        return config.getboolean(section, option, fallback=default)
+    except ValueError:
+        print(f"[QRadar2Jira_Integration] WARNING {option} on section {section} is misconfigured. Should be true or false. Defaulting to {default}")
+        return default
+
+def init_server_config(config_file:str = 'config.ini'):
     '''Initializes ServerConfig object to be used by app modules by using the config.ini file and the configparser module.
     
+    :param str config_file: Location of the config.ini file.
     :return: ServerConfig object with the configuration for the app
     :rtype: ServerConfig'''
     #Read the configuration file
     print('[QRadar2Jira_Integration] Building App configparser...')
     config = configparser.ConfigParser()
     print('[QRadar2Jira_Integration] Reading config.ini file...')
-    config.read('config.ini')
+    config.read(config_file)
     print('[QRadar2Jira_Integration] Config.ini file read succesfully!...')
 
     # Create an instance of server_config
@@ -73,7 +180,10 @@ def init_server_config():
     server_config.qradar_url = config.get('MainConfig', 'qradar_url')
     server_config.qradar_api_key = config.get('MainConfig', 'qradar_api_key')
     server_config.failed_processed_id_file = config.get('MainConfig', 'failed_processed_id_file')
+    server_config.failed_offenses_store_file = config.get('MainConfig', 'failed_offenses_store_file', fallback='failed_jira_offense_creations.db')
+    server_config.offense_issue_index_file = config.get('MainConfig', 'offense_issue_index_file', fallback='offense_jira_issues.db')
     server_config.last_processed_id_file = config.get('MainConfig', 'last_processed_id_file')
+    server_config.last_updated_time_file = config.get('MainConfig', 'last_updated_time_file', fallback='last_synced_offense_updated_time.txt')
     server_config.jira_url = config.get('MainConfig', 'jira_url')
     server_config.jira_user = config.get('MainConfig', 'jira_user')
     server_config.jira_api_token = config.get('MainConfig', 'jira_api_token')
@@ -95,6 +205,19 @@ def init_server_config():
 
     server_config.cli_logging_enabled = cli_logs_enabled
 
+    log_format = config.get('Logging', 'log_format', fallback='text').strip().lower()
+    if log_format not in ('text', 'json'):
+        print(f"[QRadar2Jira_Integration] WARNING log_format on section Logging is misconfigured. Should be text or json. Defaulting to text")
+        log_format = 'text'
+    server_config.log_format = log_format
+    server_config.log_queue_size = get_int_config_value(config, 'Logging', 'log_queue_size', 10000)
+    log_queue_full_policy = config.get('Logging', 'log_queue_full_policy', fallback='drop').strip().lower()
+    if log_queue_full_policy not in ('drop', 'block'):
+        print(f"[QRadar2Jira_Integration] WARNING log_queue_full_policy on section Logging is misconfigured. Should be drop or block. Defaulting to drop")
+        log_queue_full_policy = 'drop'
+    server_config.log_queue_full_policy = log_queue_full_policy
+    server_config.log_sampling_rate = get_int_config_value(config, 'Logging', 'log_sampling_rate', 1)
+
     try:
         server_config.polling_rate_new_offenses_checking = config.getint("OffensesPollingRate",'polling_rate_new_offenses_checking')
         if (server_config.polling_rate_new_offenses_checking is None or server_config.polling_rate_new_offenses_checking < 1):
@@ -113,19 +236,192 @@ def init_server_config():
         print(f"[QRadar2Jira_Integration]  WARNING Reuploading failed offenses to jira polling time in seconds is misconfigured. Should be an integer value from 5 to 3600. Defaulting to 15 (seconds)")
         server_config.polling_rate_offenses_failure_reuploading = 1800
 
+    server_config.adaptive_polling_enabled = get_bool_config_value(config, 'OffensesPollingRate', 'adaptive_polling_enabled', False)
+    server_config.max_polling_rate_new_offenses_checking = get_int_config_value(config, 'OffensesPollingRate', 'max_polling_rate_new_offenses_checking', 300)
+    server_config.polling_backoff_factor = get_int_config_value(config, 'OffensesPollingRate', 'polling_backoff_factor', 2)
+    server_config.new_offenses_probe_enabled = get_bool_config_value(config, 'OffensesPollingRate', 'new_offenses_probe_enabled', True)
+
+    server_config.retry_base_delay = get_int_config_value(config, 'FailedOffensesRetry', 'retry_base_delay', 30)
+    server_config.retry_max_delay = get_int_config_value(config, 'FailedOffensesRetry', 'retry_max_delay', 1800)
+    server_config.retry_max_attempts = get_int_config_value(config, 'FailedOffensesRetry', 'retry_max_attempts', 10)
+    server_config.failed_offenses_lookup_chunk_size = get_int_config_value(config, 'FailedOffensesRetry', 'failed_offenses_lookup_chunk_size', 50)
+
+    server_config.offense_updates_sync_enabled = get_bool_config_value(config, 'OffenseUpdatesSync', 'offense_updates_sync_enabled', False)
+    server_config.polling_rate_offense_updates_sync = get_int_config_value(config, 'OffenseUpdatesSync', 'polling_rate_offense_updates_sync', 60)
+    server_config.min_update_interval = get_int_config_value(config, 'OffenseUpdatesSync', 'min_update_interval', 900, minimum=0)
+    server_config.max_pending_offense_updates = get_int_config_value(config, 'OffenseUpdatesSync', 'max_pending_offense_updates', 10000)
+    server_config.max_offense_update_attempts = get_int_config_value(config, 'OffenseUpdatesSync', 'max_offense_update_attempts', 5)
+
+    server_config.drain_mode_enabled = get_bool_config_value(config, 'OffensesProcessing', 'drain_mode_enabled', True)
+    server_config.offenses_page_size = get_int_config_value(config, 'OffensesProcessing', 'offenses_page_size', 50)
+    if server_config.max_pending_offense_updates < server_config.offenses_page_size:
+        print(f"[QRadar2Jira_Integration] WARNING max_pending_offense_updates on section OffenseUpdatesSync is misconfigured. Should be bigger or equal than offenses_page_size, or the updated offenses are never fetched. Defaulting to {server_config.offenses_page_size}")
+        server_config.max_pending_offense_updates = server_config.offenses_page_size
+    server_config.jira_upload_workers = get_int_config_value(config, 'OffensesProcessing', 'jira_upload_workers', 4)
+    server_config.checkpoint_flush_every = get_int_config_value(config, 'OffensesProcessing', 'checkpoint_flush_every', 100)
+    server_config.checkpoint_flush_interval = get_int_config_value(config, 'OffensesProcessing', 'checkpoint_flush_interval', 5, minimum=0)
+    server_config.offense_issue_index_cache_size = get_int_config_value(config, 'OffensesProcessing', 'offense_issue_index_cache_size', 10000)
+    server_config.jira_bulk_enabled = get_bool_config_value(config, 'OffensesProcessing', 'jira_bulk_enabled', False)
+    server_config.jira_bulk_batch_size = get_int_config_value(config, 'OffensesProcessing', 'jira_bulk_batch_size', 50)
+    if server_config.jira_bulk_batch_size > 50:
+        print(f"[QRadar2Jira_Integration] WARNING jira_bulk_batch_size on section OffensesProcessing is misconfigured. JIRA accepts 50 issues at most on a bulk request. Defaulting to 50")
+        server_config.jira_bulk_batch_size = 50
+    server_config.jira_bulk_max_linger = get_int_config_value(config, 'OffensesProcessing', 'jira_bulk_max_linger', 5, minimum=0)
+    server_config.streaming_json_parsing_enabled = get_bool_config_value(config, 'OffensesProcessing', 'streaming_json_parsing_enabled', False)
+
+    server_config.coalescing_enabled = get_bool_config_value(config, 'OffenseCoalescing', 'coalescing_enabled', False)
+    server_config.coalescing_key_fields = config.get('OffenseCoalescing', 'coalescing_key_fields', fallback='offense_type,offense_source').strip() or 'offense_type,offense_source'
+    server_config.coalescing_window = get_int_config_value(config, 'OffenseCoalescing', 'coalescing_window', 600)
+
+    server_config.address_cache_size = get_int_config_value(config, 'AddressResolution', 'address_cache_size', 10000)
+    server_config.address_cache_ttl = get_int_config_value(config, 'AddressResolution', 'address_cache_ttl', 3600)
+    server_config.address_lookup_chunk_size = get_int_config_value(config, 'AddressResolution', 'address_lookup_chunk_size', 50)
+
+    server_config.qradar_pool_size = get_int_config_value(config, 'HttpClient', 'qradar_pool_size', 10)
+    server_config.jira_pool_size = get_int_config_value(config, 'HttpClient', 'jira_pool_size', 10)
+    server_config.http_connect_timeout = get_int_config_value(config, 'HttpClient', 'connect_timeout', 10)
+    server_config.http_read_timeout = get_int_config_value(config, 'HttpClient', 'read_timeout', 60)
+
+    server_config.jira_requests_per_second = get_int_config_value(config, 'JiraRateLimit', 'jira_requests_per_second', 10)
+    server_config.jira_burst = get_int_config_value(config, 'JiraRateLimit', 'jira_burst', 20)
+    server_config.jira_max_concurrency = get_int_config_value(config, 'JiraRateLimit', 'jira_max_concurrency', 10)
+    server_config.jira_latency_target = get_int_config_value(config, 'JiraRateLimit', 'jira_latency_target', 5)
+    server_config.jira_throttle_max_retries = get_int_config_value(config, 'JiraRateLimit', 'jira_throttle_max_retries', 5, minimum=0)
+
+    server_config.circuit_breaker_enabled = get_bool_config_value(config, 'JiraCircuitBreaker', 'circuit_breaker_enabled', False)
+    server_config.circuit_failure_threshold = get_int_config_value(config, 'JiraCircuitBreaker', 'circuit_failure_threshold', 5)
+    server_config.circuit_open_seconds = get_int_config_value(config, 'JiraCircuitBreaker', 'circuit_open_seconds', 30)
+    server_config.jira_spool_file = config.get('JiraCircuitBreaker', 'jira_spool_file', fallback='jira_spool.db').strip()
+
+    server_config.metrics_enabled = get_bool_config_value(config, 'Metrics', 'metrics_enabled', False)
+    server_config.metrics_host = config.get('Metrics', 'metrics_host', fallback='127.0.0.1').strip()
+    server_config.metrics_port = get_int_config_value(config, 'Metrics', 'metrics_port', 9108)
+    server_config.metrics_lag_probe_interval = get_int_config_value(config, 'Metrics', 'metrics_lag_probe_interval', 30, minimum=0)
+
+    server_config.sharding_enabled = get_bool_config_value(config, 'Sharding', 'sharding_enabled', False)
+    server_config.shard_count = get_int_config_value(config, 'Sharding', 'shard_count', 1)
+    server_config.shard_lease_file = config.get('Sharding', 'shard_lease_file', fallback='shard_leases.db').strip()
+    server_config.shard_lease_ttl = get_int_config_value(config, 'Sharding', 'shard_lease_ttl', 30, minimum=3)
+    server_config.shard_instance_id = config.get('Sharding', 'shard_instance_id', fallback='').strip() or None
+
+    runtime = config.get('Runtime', 'runtime', fallback='threads').strip().lower()
+    if runtime not in ('threads', 'asyncio'):
+        print(f"[QRadar2Jira_Integration] WARNING runtime on section Runtime is misconfigured. Should be threads or asyncio. Defaulting to threads")
+        runtime = 'threads'
+    server_config.runtime = runtime
+    server_config.async_max_in_flight_requests = get_int_config_value(config, 'Runtime', 'async_max_in_flight_requests', 100)
+    server_config.config_watch_interval = get_int_config_value(config, 'Runtime', 'config_watch_interval', 0, minimum=0)
+
     return server_config
 
-server_config = init_server_config()
+#Options that are only read when the app starts (files, pools, workers, threads and endpoints). A change of these options on a config reload is logged and applied on the next restart
+RESTART_REQUIRED_OPTIONS = ('failed_processed_id_file', 'failed_offenses_store_file', 'offense_issue_index_file', 'offense_issue_index_cache_size', 'last_processed_id_file', 'last_updated_time_file',
+                            'cli_logging_enabled', 'log_format', 'log_queue_size', 'log_queue_full_policy', 'offense_updates_sync_enabled', 'jira_upload_workers', 'jira_bulk_enabled', 'coalescing_enabled',
+                            'qradar_pool_size', 'jira_pool_size', 'circuit_breaker_enabled', 'jira_spool_file', 'metrics_enabled', 'metrics_host', 'metrics_port',
+                            'sharding_enabled', 'shard_count', 'shard_lease_file', 'shard_lease_ttl', 'shard_instance_id', 'runtime', 'async_max_in_flight_requests',
+                            'adaptive_polling_enabled')
+
+server_config: ServerConfig = None #Configuration shared by every module of the app. Created on init_app and updated in place on every config reload
+loaded_server_config: ServerConfig = None #Configuration as read from the config.ini file on the last (re)load, to find the options changed by the next reload
+config_file: str = None #Location of the config.ini file read by init_app
+app_init_lock = threading.Lock()
+config_reload_lock = threading.Lock()
+config_reload_event = threading.Event() #Set by SIGHUP to wake up the config reloader thread
+config_reload_callbacks: List[Callable[[ServerConfig], None]] = [] #Called after every config reload, so components that copied config values when they were created apply the new ones
 
 ########################################LOGGERS CONFIGURATION!!!!!##################################################
 
+SAMPLED_LOG = {"sampled": True} #Pass as extra on high-volume per-offense INFO/DEBUG messages. Only 1 out of log_sampling_rate of them is logged
+
+class LazyJson:
+    '''Wraps an object to log it as JSON. The object is only serialized if the log record is actually emitted, on the logging listener thread.'''
+    def __init__(self, value:any):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, default=str)
+
+class JsonFormatter(logging.Formatter):
+    '''Formats every log record as a single line JSON object (structured logging).'''
+    def __init__(self, logger_identifier:str):
+        super().__init__()
+        self.logger_identifier = logger_identifier
+
+    def format(self, record:logging.LogRecord) -> str:
+        log_entry = {
+            "time": self.formatTime(record),
+            "logger": self.logger_identifier,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "function": record.funcName,
+            "line": record.lineno,
+            "file": record.filename,
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(log_entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    '''Lets through only 1 out of every sampling_rate INFO/DEBUG records logged with extra=SAMPLED_LOG. Warnings and errors are never sampled.'''
+    def __init__(self, sampling_rate:int):
+        super().__init__()
+        self.sampling_rate = sampling_rate
+        self.sampled_count = 0
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        if self.sampling_rate <= 1 or not getattr(record, 'sampled', False) or record.levelno >= logging.WARNING:
+            return True
+        self.sampled_count += 1 #Not locked: a lost increment only shifts which record is sampled
+        return self.sampled_count % self.sampling_rate == 1
+
+class BoundedQueueHandler(QueueHandler):
+    '''Puts the log records on the bounded logging queue instead of writing them, so the calling thread never waits for the disk or the console.
+    When the queue is full, records are dropped (and counted) with the drop policy, or the calling thread waits for free space with the block policy.
+    Records are not formatted here: messages and their arguments are rendered by the listener thread, only for the records actually written.'''
+    def __init__(self, log_queue:queue.Queue, block_when_full:bool):
+        super().__init__(log_queue)
+        self.block_when_full = block_when_full
+        self.dropped_count = 0
+        self.dropped_lock = threading.Lock()
+
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record:logging.LogRecord) -> None:
+        if self.block_when_full:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped_count += 1
+            return
+        if self.dropped_count:
+            with self.dropped_lock:
+                dropped_count, self.dropped_count = self.dropped_count, 0
+            try:
+                self.queue.put_nowait(logging.makeLogRecord({"name": record.name, "levelno": logging.WARNING, "levelname": "WARNING", "funcName": "enqueue", "filename": "app_config.py",
+                                                             "msg": "%d log records were dropped because the logging queue was full", "args": (dropped_count,)}))
+            except queue.Full:
+                with self.dropped_lock:
+                    self.dropped_count += dropped_count
+
+log_queue: queue.Queue = None #Bounded queue between the app threads and the logging listener thread. Created on init_app
+log_listener: QueueListener = None #Logging listener thread. Started on init_app
+log_listener_handlers = [] #File and console handlers, written by the logging listener thread
+sampling_filters: List[SamplingFilter] = [] #Sampling filter of every logger, updated on config reloads
+
 def get_formatter_for_logger(formatter_identifier:str = None):
-    '''Generates a formatter for a handler inside a logger. Pass a formatter identifier to identify the handler in a unique way
+    '''Generates a formatter for a handler inside a logger. Pass a formatter identifier to identify the handler in a unique way. If the log format is json, the logs are formatted as JSON objects.
     
     :param str formatter_identifier: Identifier to add at the start of the formatted log
     :return: Formatter to be used when generating logs in the file
     :rtype: Formatter
     '''
+    if server_config.log_format == 'json':
+        return JsonFormatter(formatter_identifier.strip('[]') if formatter_identifier else None)
     if formatter_identifier:
         formatter = logging.Formatter(formatter_identifier  + ' %(asctime)s %(levelname)s: %(message)s [in %(funcName)s():%(lineno)d] [%(filename)s]')
     else:
@@ -135,6 +431,7 @@ def get_formatter_for_logger(formatter_identifier:str = None):
 def configure_logger(logger_to_config:logging.Logger, handler_formatter_identifier:str,log_file_name:str):
     '''
     Configures a logger. Pass a Logger Instance, an identifier to use on the handler formatter and the file name where to store the logs.
+    The logger only puts its records on the bounded logging queue. The file and console handlers are written by the logging listener thread (see start_log_listener).
     
     :param  Logger logger_to_config: Logger to configure.
     :param str handler_formatter_identifier:  Handler formatter identifier to add in the logger configured. get_formatter_for_logger(formatter) is called to configure the format of the logs for the affected logger.
@@ -143,37 +440,57 @@ def configure_logger(logger_to_config:logging.Logger, handler_formatter_identifi
     :rtype: None
     '''
     handler_formatter = get_formatter_for_logger(handler_formatter_identifier)
+    logger_filter = logging.Filter(logger_to_config.name) #The listener is shared by every logger, so every handler only writes the records of its logger
     #By default files will have a max of 15MB and rotate when reached. 3 historical rotated files will be stored.
     handler = RotatingFileHandler('logs/' + log_file_name, maxBytes=15728640, backupCount=3)
     handler.setLevel(server_config.logging_level)
     handler.setFormatter(handler_formatter)
-    logger_to_config.addHandler(handler)
+    handler.addFilter(logger_filter)
+    log_listener_handlers.append(handler)
 
     if (server_config.cli_logging_enabled == True):
         print("Logging seems to be enabled...")
         stream_handler = logging.StreamHandler()
         stream_handler.setLevel(server_config.logging_level)
         stream_handler.setFormatter(handler_formatter)
-        logger_to_config.addHandler(stream_handler)
+        stream_handler.addFilter(logger_filter)
+        log_listener_handlers.append(stream_handler)
     else:
         print("You seem to have disabled CLI logging. Most logs will no longer appear on the CLI. Check log files for log information.")
+
+    queue_handler = BoundedQueueHandler(log_queue, server_config.log_queue_full_policy == 'block')
+    sampling_filter = SamplingFilter(server_config.log_sampling_rate)
+    sampling_filters.append(sampling_filter)
+    queue_handler.addFilter(sampling_filter)
+    logger_to_config.addHandler(queue_handler)
     #Test handler
     logger_to_config.debug(f'{handler_formatter_identifier} is properly configured and working.')
 
+def start_log_listener() -> QueueListener:
+    '''Starts the logging listener thread, which writes the queued log records to the file and console handlers. It is stopped on exit, once every queued record has been written.
+
+    :return: The started listener.
+    :rtype: QueueListener
+    '''
+    listener = QueueListener(log_queue, *log_listener_handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 # Defined loggers for different server processes
 app_bootstrap_logger = logging.getLogger("app_bootstraping")
 offenses_to_jira_logger = logging.getLogger("offenses_to_jira_logger")
 failed_offenses_to_jira_retries_logger = logging.getLogger("failed_offenses_to_jira_retries_logger")
+offense_updates_to_jira_logger = logging.getLogger("offense_updates_to_jira_logger")
+backfill_logger = logging.getLogger("backfill_logger")
 
-logging.getLogger().setLevel(server_config.logging_level)
-
-configure_logger(app_bootstrap_logger, '[app_bootstrap_logger]','app_bootstrap.log')
-configure_logger(offenses_to_jira_logger, '[offenses_to_jira_logger]','offenses_to_jira.log')
-configure_logger(failed_offenses_to_jira_retries_logger, '[failed_offenses_to_jira_retries_logger]','failed_offenses_to_jira.log')
-
-###FINAL MESSAGE:
+def log_startup_banner() -> None:
+    '''Logs the startup banner with the configuration of the app.
 
-app_bootstrap_logger.critical(f'''
+    :return: None
+    :rtype: None
+    '''
+    app_bootstrap_logger.critical(f'''
    ___  ____      _    ____    _    ____    ____        _              
   / _ \|  _ \    / \  |  _ \  / \  |  _ \  |___ \      | (_)_ __ __ _ 
  | | | | |_) |  / _ \ | | | |/ _ \ | |_) |   __) |  _  | | | '__/ _` |
@@ -182,17 +499,141 @@ app_bootstrap_logger.critical(f'''
                                                                                                                                                                                                                                                                                                                                       
 Developed by cvivasf
 ''')
-app_bootstrap_logger.critical(f"#######################################################################")
-app_bootstrap_logger.critical('[QRadar2Jira_Integration] Configuration of QRADAR 2 JIRA Application:')
-app_bootstrap_logger.critical(f"    Current LOG LEVEL: {server_config.logging_level}")
-app_bootstrap_logger.critical(f"    CLI Logging enabled?: {server_config.cli_logging_enabled}")
-app_bootstrap_logger.critical(f"    QRADAR URL: {server_config.qradar_url}")
-app_bootstrap_logger.critical(f"    Last Processed Offense ID file location: {server_config.last_processed_id_file}")
-app_bootstrap_logger.critical(f"    Failed Processed Offense IDs file location: {server_config.failed_processed_id_file}")
-app_bootstrap_logger.critical(f"    JIRA URL: {server_config.jira_url}")
-app_bootstrap_logger.critical(f"    JIRA USER: {server_config.jira_user}")
-app_bootstrap_logger.critical(f"    JIRA Project Key: {server_config.jira_project_key}")
-app_bootstrap_logger.critical(f"    Time to wait for polling new offenses from QRADAR and sending them to JIRA: {server_config.polling_rate_new_offenses_checking}")
-app_bootstrap_logger.critical(f"    Time to wait for sending new failed offenses from QRADAR to JIRA: {server_config.polling_rate_offenses_failure_reuploading}")
-app_bootstrap_logger.critical(f"Integrating QRADAR Offenses with JIRA Now!...")
-app_bootstrap_logger.critical(f"#######################################################################")
\ No newline at end of file
+    app_bootstrap_logger.critical(f"#######################################################################")
+    app_bootstrap_logger.critical('[QRadar2Jira_Integration] Configuration of QRADAR 2 JIRA Application:')
+    app_bootstrap_logger.critical(f"    Current LOG LEVEL: {server_config.logging_level}")
+    app_bootstrap_logger.critical(f"    CLI Logging enabled?: {server_config.cli_logging_enabled}")
+    app_bootstrap_logger.critical(f"    Log format: {server_config.log_format}, queue size: {server_config.log_queue_size} (when full: {server_config.log_queue_full_policy}), per-offense messages sampling rate: 1/{server_config.log_sampling_rate}")
+    app_bootstrap_logger.critical(f"    QRADAR URL: {server_config.qradar_url}")
+    app_bootstrap_logger.critical(f"    Last Processed Offense ID file location: {server_config.last_processed_id_file}")
+    app_bootstrap_logger.critical(f"    Failed Processed Offense IDs file location (legacy, imported on startup): {server_config.failed_processed_id_file}")
+    app_bootstrap_logger.critical(f"    Failed Offenses store location: {server_config.failed_offenses_store_file}")
+    app_bootstrap_logger.critical(f"    Offense to JIRA issue index location: {server_config.offense_issue_index_file} (cache size: {server_config.offense_issue_index_cache_size})")
+    app_bootstrap_logger.critical(f"    JIRA URL: {server_config.jira_url}")
+    app_bootstrap_logger.critical(f"    JIRA USER: {server_config.jira_user}")
+    app_bootstrap_logger.critical(f"    JIRA Project Key: {server_config.jira_project_key}")
+    app_bootstrap_logger.critical(f"    Time to wait for polling new offenses from QRADAR and sending them to JIRA: {server_config.polling_rate_new_offenses_checking}")
+    app_bootstrap_logger.critical(f"    Adaptive polling enabled?: {server_config.adaptive_polling_enabled} (max time to wait while idle: {server_config.max_polling_rate_new_offenses_checking}, backoff factor: {server_config.polling_backoff_factor}, new offenses probe enabled?: {server_config.new_offenses_probe_enabled})")
+    app_bootstrap_logger.critical(f"    Time to wait for rescanning the failed offenses store: {server_config.polling_rate_offenses_failure_reuploading}")
+    app_bootstrap_logger.critical(f"    Failed offenses retry backoff: base {server_config.retry_base_delay}s, max {server_config.retry_max_delay}s, max attempts {server_config.retry_max_attempts}")
+    app_bootstrap_logger.critical(f"    Failed offenses QRADAR lookup chunk size: {server_config.failed_offenses_lookup_chunk_size}")
+    app_bootstrap_logger.critical(f"    Offense updates sync enabled?: {server_config.offense_updates_sync_enabled} (polling rate: {server_config.polling_rate_offense_updates_sync}, min update interval: {server_config.min_update_interval}, max pending updates: {server_config.max_pending_offense_updates}, max attempts: {server_config.max_offense_update_attempts}, watermark file: {server_config.last_updated_time_file})")
+    app_bootstrap_logger.critical(f"    Drain mode enabled?: {server_config.drain_mode_enabled}")
+    app_bootstrap_logger.critical(f"    Offenses page size: {server_config.offenses_page_size} (streaming JSON parsing enabled?: {server_config.streaming_json_parsing_enabled})")
+    app_bootstrap_logger.critical(f"    JIRA upload workers: {server_config.jira_upload_workers}")
+    app_bootstrap_logger.critical(f"    Last processed offense ID saved every {server_config.checkpoint_flush_every} offenses or {server_config.checkpoint_flush_interval} seconds")
+    app_bootstrap_logger.critical(f"    JIRA bulk creation enabled?: {server_config.jira_bulk_enabled} (batch size: {server_config.jira_bulk_batch_size}, max linger: {server_config.jira_bulk_max_linger})")
+    app_bootstrap_logger.critical(f"    Offense coalescing enabled?: {server_config.coalescing_enabled} (key fields: {server_config.coalescing_key_fields}, window: {server_config.coalescing_window}s)")
+    app_bootstrap_logger.critical(f"    Address IPs cache: size {server_config.address_cache_size}, TTL {server_config.address_cache_ttl}s, QRADAR lookup chunk size {server_config.address_lookup_chunk_size}")
+    app_bootstrap_logger.critical(f"    QRADAR / JIRA connection pool sizes: {server_config.qradar_pool_size} / {server_config.jira_pool_size}")
+    app_bootstrap_logger.critical(f"    JIRA rate limit: {server_config.jira_requests_per_second} requests/s (burst {server_config.jira_burst}), max concurrency {server_config.jira_max_concurrency}, latency target {server_config.jira_latency_target}s, max throttled retries {server_config.jira_throttle_max_retries}")
+    app_bootstrap_logger.critical(f"    JIRA circuit breaker enabled?: {server_config.circuit_breaker_enabled} (opens after {server_config.circuit_failure_threshold} failures in a row for {server_config.circuit_open_seconds}s, spool: {server_config.jira_spool_file})")
+    app_bootstrap_logger.critical(f"    Metrics endpoint enabled?: {server_config.metrics_enabled} (http://{server_config.metrics_host}:{server_config.metrics_port}/metrics, lag probe interval: {server_config.metrics_lag_probe_interval})")
+    app_bootstrap_logger.critical(f"    Sharding enabled?: {server_config.sharding_enabled} ({server_config.shard_count} shards, lease database: {server_config.shard_lease_file}, lease TTL: {server_config.shard_lease_ttl}s)")
+    app_bootstrap_logger.critical(f"    Runtime: {server_config.runtime}")
+    app_bootstrap_logger.critical(f"    Config reload: on SIGHUP{f' or when {config_file} changes (checked every {server_config.config_watch_interval}s)' if server_config.config_watch_interval else ''}")
+    app_bootstrap_logger.critical(f"    HTTP connect / read timeouts: {server_config.http_connect_timeout} / {server_config.http_read_timeout}")
+    app_bootstrap_logger.critical(f"Integrating QRADAR Offenses with JIRA Now!...")
+    app_bootstrap_logger.critical(f"#######################################################################")
+
+def init_app(passed_config_file:str = 'config.ini') -> ServerConfig:
+    '''Reads the config.ini file, configures the loggers, starts the logging listener thread and logs the startup banner. Nothing is done when this module is imported,
+    so the modules of the app can be imported (for example, by tests or tools) without a config.ini file. Only the first call initializes the app, later calls return the same configuration.
+
+    :param str passed_config_file: Location of the config.ini file.
+    :return: ServerConfig object with the configuration for the app, shared by every module.
+    :rtype: ServerConfig
+    '''
+    global server_config, loaded_server_config, config_file, log_queue, log_listener
+    with app_init_lock:
+        if server_config is not None:
+            return server_config
+        config_file = passed_config_file
+        loaded_server_config = init_server_config(config_file)
+        server_config = copy.copy(loaded_server_config) #Shared by every module and updated in place on reloads. loaded_server_config keeps the file values to detect the changes
+        log_queue = queue.Queue(maxsize=server_config.log_queue_size)
+
+        logging.getLogger().setLevel(server_config.logging_level)
+
+        configure_logger(app_bootstrap_logger, '[app_bootstrap_logger]','app_bootstrap.log')
+        configure_logger(offenses_to_jira_logger, '[offenses_to_jira_logger]','offenses_to_jira.log')
+        configure_logger(failed_offenses_to_jira_retries_logger, '[failed_offenses_to_jira_retries_logger]','failed_offenses_to_jira.log')
+        configure_logger(offense_updates_to_jira_logger, '[offense_updates_to_jira_logger]','offense_updates_to_jira.log')
+        configure_logger(backfill_logger, '[backfill_logger]','backfill.log')
+        log_listener = start_log_listener()
+
+        log_startup_banner()
+        return server_config
+
+def on_config_reload(callback:Callable[[ServerConfig], None]) -> None:
+    '''Registers a function called after every config reload with the updated configuration.
+
+    :param Callable[[ServerConfig], None] callback: Function applying the new configuration values to a running component.
+    :return: None
+    :rtype: None
+    '''
+    config_reload_callbacks.append(callback)
+
+def reload_server_config() -> List[str]:
+    '''Reads the config.ini file again and applies the changed options to the running app without restarting it: the new values are set in place on the shared ServerConfig
+    (read by the threads on every cycle), the log level and sampling rate are updated, and the registered callbacks apply them to the components that copied them (rate governor,
+    circuit breaker, retry scheduler, caches, sessions credentials...). Connection pools, queues and in-flight work are kept. Options of RESTART_REQUIRED_OPTIONS are not applied.
+
+    :return: Names of the options applied.
+    :rtype: List[str]
+    :raises configparser.Error: if the config.ini file is not valid (the running configuration is kept)
+    '''
+    global loaded_server_config
+    with config_reload_lock:
+        new_server_config = init_server_config(config_file)
+        changed_options = [option for option, value in vars(new_server_config).items() if getattr(loaded_server_config, option) != value]
+        loaded_server_config = new_server_config
+        applied_options = []
+        for option in changed_options:
+            if option in RESTART_REQUIRED_OPTIONS:
+                app_bootstrap_logger.warning(f"{option} changed on {config_file}. It will be applied when the app is restarted.")
+                continue
+            setattr(server_config, option, getattr(new_server_config, option))
+            applied_options.append(option)
+
+        logging.getLogger().setLevel(server_config.logging_level)
+        for handler in log_listener_handlers:
+            handler.setLevel(server_config.logging_level)
+        for sampling_filter in sampling_filters:
+            sampling_filter.sampling_rate = server_config.log_sampling_rate
+        for callback in config_reload_callbacks:
+            try:
+                callback(server_config)
+            except Exception as e:
+                app_bootstrap_logger.error(f"Error applying the reloaded configuration on {getattr(callback, '__qualname__', callback)}: {str(e)}")
+        app_bootstrap_logger.warning(f"{config_file} reloaded. Options applied: {', '.join(applied_options) if applied_options else 'none'}")
+        return applied_options
+
+def watch_config_file() -> None:
+    '''Config reloader loop: reloads the config.ini file when SIGHUP is received or, if config_watch_interval is not 0, when the modification time of the file changes.
+
+    :return: None
+    :rtype: None
+    '''
+    last_modified_time = os.stat(config_file).st_mtime if os.path.exists(config_file) else None
+    while True:
+        signal_received = config_reload_event.wait(server_config.config_watch_interval or None)
+        config_reload_event.clear()
+        modified_time = os.stat(config_file).st_mtime if os.path.exists(config_file) else None
+        if not signal_received and modified_time == last_modified_time:
+            continue
+        last_modified_time = modified_time
+        try:
+            reload_server_config()
+        except Exception as e:
+            app_bootstrap_logger.error(f"Error reloading {config_file}: {str(e)}. Keeping the running configuration.")
+
+def start_config_reloader() -> None:
+    '''Starts the config reloader on a daemon thread and makes SIGHUP trigger a config reload (on the platforms that have it). Must be called from the main thread, after init_app.
+
+    :return: None
+    :rtype: None
+    '''
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signal_number, frame: config_reload_event.set())
+    threading.Thread(target=watch_config_file, name="config_reloader", daemon=True).start()
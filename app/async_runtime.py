@@ -0,0 +1,515 @@
+import asyncio
+import signal
+import threading
+import time
+from typing import Dict, List, Tuple
+from app_config import SAMPLED_LOG, ServerConfig, app_bootstrap_logger, offenses_to_jira_logger, failed_offenses_to_jira_retries_logger
+import http_client
+from http_client import QRADAR_API_VERSION
+import address_resolver
+import metrics
+import jira_uploads
+from jira_circuit_breaker import JiraCircuitOpenError
+from offense_coalescing import GROUP_LOCKS_COUNT, get_group_lock, get_offense_fields
+from offense_issue_index import OffenseAlreadyClaimedError
+import qradar_siem_offenses_to_jira as offenses_to_jira
+import reupload_failed_offenses_to_jira as failed_offenses_to_jira
+import offense_updates_to_jira
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None #The asyncio runtime is optional. aiohttp is only required when it is selected on the config.ini file
+
+NEW_FAILED_OFFENSES_CHECK_SECONDS = 1 #Max time the retrier coroutine sleeps before checking if new failed offenses were added to the store
+GROUP_LOCK_POLL_SECONDS = 0.05 #Interval at which a group upload polls the lock of its group while the JIRA spool drainer thread holds it
+
+config: ServerConfig = None
+qradar_session = None #aiohttp ClientSession used for every QRadar API call
+jira_session = None #aiohttp ClientSession used for every JIRA API call
+in_flight_requests: asyncio.Semaphore = None #Bounds the number of QRadar and JIRA requests in flight at the same time
+group_locks: List[asyncio.Lock] = None #Serialize the uploads of the same coalescing group, so a group never gets two JIRA issues
+
+def is_available() -> bool:
+    '''Checks if the asyncio runtime can be used (aiohttp is installed).
+
+    :return: True if aiohttp could be imported.
+    :rtype: bool
+    '''
+    return aiohttp is not None
+
+def build_sessions() -> None:
+    '''Builds the aiohttp sessions for QRadar and JIRA with their keep-alive connection pools and default headers. Credentials and timeouts are set per request
+    (qradar_request_options and jira_request_options), so a config reload applies them without rebuilding the sessions.
+
+    :return: None
+    :rtype: None
+    '''
+    global qradar_session, jira_session
+    qradar_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=config.async_max_in_flight_requests, ssl=False),
+        headers={'Accept': 'application/json', 'VERSION': QRADAR_API_VERSION})
+    jira_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=config.async_max_in_flight_requests),
+        headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
+
+def qradar_request_options(headers:Dict[str,str]) -> Dict[str,any]:
+    '''Returns the options of a QRadar request with the current API key and timeouts.
+
+    :param Dict[str,str] headers: Headers of the request.
+    :return: Keyword arguments for the QRadar session request.
+    :rtype: Dict[str,any]
+    '''
+    return {"headers": {**headers, 'SEC': config.qradar_api_key}, "timeout": aiohttp.ClientTimeout(connect=config.http_connect_timeout, sock_read=config.http_read_timeout)}
+
+def jira_request_options() -> Dict[str,any]:
+    '''Returns the options of a JIRA request with the current credentials and timeouts.
+
+    :return: Keyword arguments for the JIRA session request.
+    :rtype: Dict[str,any]
+    '''
+    return {"auth": aiohttp.BasicAuth(config.jira_user, config.jira_api_token), "timeout": aiohttp.ClientTimeout(connect=config.http_connect_timeout, sock_read=config.http_read_timeout)}
+
+async def get_latest_offenses(page_size:int) -> List[Dict[any,any]]:
+    '''Retrieve a page of the latest open offenses from QRadar with an ID bigger than the last offense ID fetched, sorted by ID. Only the fields used by the JIRA tickets are requested.
+
+    :param int page_size: Maximum number of offenses to retrieve in the page.
+    :return: JSON response of the offenses obtained.
+    :rtype: List[Dict[any,any]]
+    :raises ClientResponseError: if an error occurred making the HTTP request
+    '''
+    params = { "filter": 'status=OPEN and id > ' + str(offenses_to_jira.last_fetched_id), "sort": "+id", "fields": get_offense_fields(config) }
+    start_time = time.monotonic()
+    try:
+        async with in_flight_requests:
+            async with qradar_session.get(config.qradar_url, params=params, **qradar_request_options({"RANGE": f"items=0-{page_size - 1}"})) as response:
+                response.raise_for_status()
+                return await response.json()
+    finally:
+        metrics.qradar_poll_duration.observe(time.monotonic() - start_time)
+
+async def get_newest_offense_id() -> int:
+    '''Retrieve the ID of the newest open offense from QRadar with a cheap call (a single offense with its ID only, sorted by ID in descendant mode).
+
+    :return: ID of the newest open offense, or None if there are no open offenses.
+    :rtype: int
+    :raises ClientResponseError: if an error occurred making the HTTP request
+    '''
+    params = { "filter": "status=OPEN", "sort": "-id", "fields": "id" }
+    async with in_flight_requests:
+        async with qradar_session.get(config.qradar_url, params=params, **qradar_request_options({"RANGE": "items=0-0"})) as response:
+            response.raise_for_status()
+            offenses = await response.json()
+    return offenses[0].get('id') if offenses else None
+
+async def refresh_newest_offense_id() -> None:
+    '''Coroutine version of the newest offense ID probe of the watermark lag metric, made on the polling cycle if it is due. A failed probe keeps the cached ID.
+
+    :return: None
+    :rtype: None
+    '''
+    if not offenses_to_jira.is_newest_offense_id_probe_due():
+        return
+    try:
+        offenses_to_jira.set_newest_offense_id(await get_newest_offense_id())
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        offenses_to_jira_logger.warning(f"Error probing the newest offense ID for the watermark lag metric: {str(e)}")
+
+async def has_new_offenses() -> bool:
+    '''Probes QRadar for new offenses with a cheap call (a single open offense with an ID bigger than the last offense ID fetched, with its ID only), so an idle poll skips the full fetch.
+
+    :return: True if there is at least one new open offense.
+    :rtype: bool
+    :raises ClientResponseError: if an error occurred making the HTTP request
+    '''
+    params = { "filter": 'status=OPEN and id > ' + str(offenses_to_jira.last_fetched_id), "fields": "id" }
+    async with in_flight_requests:
+        async with qradar_session.get(config.qradar_url, params=params, **qradar_request_options({"RANGE": "items=0-0"})) as response:
+            response.raise_for_status()
+            new_offenses = len(await response.json()) > 0
+    metrics.new_offenses_probes.inc(1, "new_offenses" if new_offenses else "empty")
+    return new_offenses
+
+async def get_open_offenses(offense_ids:List[int]) -> Dict[int,Dict[any,any]]:
+    '''Retrieve the open offenses of a chunk of offense IDs from QRADAR with a single filtered call, limited to the fields requested for the new offenses.
+
+    :param List[int] offense_ids: The IDs of the offenses to get their data from QRADAR.
+    :return: Dictionary with the offense ID as key and the offense as value. Closed or non-existent offenses are not on it.
+    :rtype: Dict[int,Dict[any,any]]
+    :raises ClientResponseError: if an error occurs obtaining the offenses info
+    '''
+    params = { "filter": f"status=OPEN and id in ({','.join(str(offense_id) for offense_id in offense_ids)})", "fields": get_offense_fields(config) }
+    async with in_flight_requests:
+        async with qradar_session.get(config.qradar_url, params=params, **qradar_request_options({"RANGE": f"items=0-{len(offense_ids) - 1}"})) as response:
+            response.raise_for_status()
+            return {offense.get('id'): offense for offense in await response.json()}
+
+async def resolve_addresses(endpoint:str, address_ids:List[int]) -> Dict[int,str]:
+    '''Resolves the IPs of several address IDs using the address IPs cache shared with the threads. The missing ones are looked up on QRADAR in chunks with a single filtered call per chunk.
+
+    :param str endpoint: SOURCE_ADDRESSES or LOCAL_DESTINATION_ADDRESSES.
+    :param List[int] address_ids: IDs of the addresses.
+    :return: Dictionary with the address ID as key and its IP as value. Non-existent addresses are not on it.
+    :rtype: Dict[int,str]
+    :raises ClientResponseError: if an error occurred making the HTTP request
+    '''
+    ips, missing_address_ids = address_resolver.address_resolver.get_cached(endpoint, address_ids)
+    for chunk in address_resolver.split_in_chunks(missing_address_ids, config.address_lookup_chunk_size):
+        params, headers = address_resolver.build_addresses_query(endpoint, chunk)
+        async with in_flight_requests:
+            async with qradar_session.get(address_resolver.get_addresses_url(config, endpoint), params=params, **qradar_request_options(headers)) as response:
+                response.raise_for_status()
+                resolved_ips = address_resolver.parse_addresses_response(endpoint, await response.json())
+        address_resolver.address_resolver.put(endpoint, resolved_ips)
+        ips.update(resolved_ips)
+    return ips
+
+async def resolve_offenses_addresses(offenses:List[Dict[any,any]]) -> Dict[str,Dict[int,str]]:
+    '''Resolves the source and local destination IPs of several offenses at once, looking up both addresses endpoints concurrently.
+
+    :param List[Dict[any,any]] offenses: The offenses obtained from QRADAR SIEM
+    :return: Dictionary with the addresses endpoint as key and the resolved IPs (address ID -> IP) as value.
+    :rtype: Dict[str,Dict[int,str]]
+    :raises ClientResponseError: if an error occurred making the HTTP request
+    '''
+    address_ids = address_resolver.get_offenses_address_ids(offenses)
+    resolved_ips = await asyncio.gather(*(resolve_addresses(endpoint, ids) for endpoint, ids in address_ids.items()))
+    return dict(zip(address_ids, resolved_ips))
+
+async def jira_post(url:str, json_body:Dict[any,any], accepted_error_status:int = None) -> any:
+    '''Makes a POST request to the JIRA API through the JIRA rate governor and circuit breaker shared with the threads, and returns its JSON body.
+    Throttled requests (429) wait for the time requested by JIRA and are sent again, up to jira_throttle_max_retries times, instead of failing.
+
+    :param str url: URL of the JIRA API endpoint.
+    :param Dict[any,any] json_body: Body of the request.
+    :param int accepted_error_status: Error status whose body is returned instead of raising (for example, 400 on bulk requests).
+    :return: The JSON body of the response.
+    :rtype: any
+    :raises ClientResponseError: if JIRA answered with an error status
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open
+    '''
+    http_client.check_jira_circuit()
+    attempt = 0
+    while True:
+        wait_seconds = http_client.jira_rate_governor.try_acquire()
+        while wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+            wait_seconds = http_client.jira_rate_governor.try_acquire()
+        http_client.acquire_jira_circuit()
+        start_time = time.monotonic()
+        status, headers = None, None
+        try:
+            async with in_flight_requests:
+                async with jira_session.post(url, json=json_body, **jira_request_options()) as response:
+                    status, headers = response.status, response.headers
+                    if status != 429 or attempt >= config.jira_throttle_max_retries:
+                        if status != accepted_error_status:
+                            response.raise_for_status()
+                        return await response.json()
+        finally:
+            latency = time.monotonic() - start_time
+            http_client.jira_rate_governor.release(status, headers, latency)
+            http_client.record_jira_outcome(status)
+            metrics.jira_request_duration.observe(latency, str(status) if status is not None else "error")
+        attempt += 1
+
+async def perform_upload_request(request:Tuple) -> any:
+    '''Performs a request of an upload (see jira_uploads) with the aiohttp sessions.
+
+    :param Tuple request: The request, RESOLVE_ADDRESSES or JIRA_POST
+    :return: The result of the request
+    :rtype: any
+    :raises ClientResponseError: if an error occurred making the HTTP request
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open
+    '''
+    if request[0] == jira_uploads.RESOLVE_ADDRESSES:
+        return await resolve_offenses_addresses(request[1])
+    _, url, body, accepted_error_status = request
+    return await jira_post(url, body, accepted_error_status)
+
+async def run_upload_steps(steps:jira_uploads.UploadSteps) -> any:
+    '''Runs an upload of the upload logic shared with the threads. Its QRadar and JIRA requests are made on the event loop, while the steps between them, which read and write
+    the SQLite offense issue index and JIRA spool, run on a worker thread so they never block the event loop.
+
+    :param UploadSteps steps: The upload
+    :return: The outcome of the upload
+    :rtype: any
+    :raises Exception: the error of the upload, if it failed
+    '''
+    result, error = None, None
+    while True:
+        done, value = await asyncio.to_thread(jira_uploads.advance_upload_steps, steps, result, error)
+        if done:
+            return value
+        result, error = None, None
+        try:
+            result = await perform_upload_request(value)
+        except asyncio.CancelledError:
+            steps.close() #Releases the offenses claimed by the upload
+            raise
+        except Exception as e:
+            error = e
+
+async def run_offense_upload(upload:Tuple[str,List[Dict[any,any]],str]) -> Dict[int,any]:
+    '''Runs a JIRA upload of the new offenses poller, holding the lock of its group if it is a group upload. The group lock of the coroutines is held first, so only one of them
+    polls the group lock shared with the JIRA spool drainer thread, without blocking the event loop.
+
+    :param Tuple[str,List[Dict[any,any]],str] upload: The upload, as returned by get_offense_uploads.
+    :return: Dictionary with the offense ID as key and the created (or already existing) issue, SPOOLED_ISSUE or the exception of the offense, as value.
+    :rtype: Dict[int,any]
+    :raises ClientResponseError: if the whole upload failed
+    '''
+    steps = offenses_to_jira.get_upload_steps(upload)
+    if upload[0] == offenses_to_jira.GROUP_UPLOAD:
+        async with group_locks[hash(upload[2]) % GROUP_LOCKS_COUNT]:
+            group_lock = get_group_lock(upload[2])
+            while not group_lock.acquire(blocking=False):
+                await asyncio.sleep(GROUP_LOCK_POLL_SECONDS)
+            try:
+                return await run_upload_steps(steps)
+            finally:
+                group_lock.release()
+    return await run_upload_steps(steps)
+
+async def upload_and_commit(uploads:List[Tuple[str,List[Dict[any,any]],str]], fetched_id:int = None) -> None:
+    '''Runs JIRA uploads concurrently and commits the outcome of their offenses in offense ID order once they are all done, so the last processed ID only moves past an offense once
+    every lower offense ID has been uploaded or stored as failed. The commit writes the failed offenses store and the last processed ID file, so it runs on a worker thread.
+
+    :param List[Tuple[str,List[Dict[any,any]],str]] uploads: The uploads, as returned by get_offense_uploads.
+    :param int fetched_id: Last fetched offense ID of the page of the uploads, as returned by select_new_offenses. It is moved up right before the commit. None for a bulk batch upload.
+    :return: None
+    :rtype: None
+    '''
+    upload_tasks = []
+    for upload in uploads:
+        upload_task = asyncio.create_task(run_offense_upload(upload))
+        upload_tasks.extend((offense.get('id'), upload_task) for offense in upload[1])
+    upload_tasks.sort(key=lambda offense_upload: offense_upload[0])
+    try:
+        outcomes = []
+        for offense_id, upload_task in upload_tasks:
+            try:
+                outcomes.append((offense_id, (await upload_task)[offense_id]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                outcomes.append((offense_id, e))
+        offenses_to_jira.advance_last_fetched_id(fetched_id)
+        await asyncio.to_thread(offenses_to_jira.commit_upload_outcomes, outcomes)
+    finally:
+        for _, upload_task in upload_tasks:
+            upload_task.cancel()
+
+async def process_offenses_page(latest_offenses:List[Dict[any,any]]) -> None:
+    '''Creates the JIRA tickets of a page of offenses concurrently, with the same uploads as the threads: one request per offense, bulk requests or one request per group of correlated offenses, as configured.
+    Offenses waiting on a bulk batch that is not full yet are uploaded on a later page or polling cycle.
+
+    :param List[Dict[any,any]] latest_offenses: Page of offenses obtained from QRADAR SIEM, sorted by ID.
+    :return: None
+    :rtype: None
+    '''
+    if offenses_to_jira.jira_bulk_batcher is None:
+        try:
+            await resolve_offenses_addresses(latest_offenses) #Warms the address IPs cache with one lookup per addresses endpoint for the whole page, instead of one per offense
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            offenses_to_jira_logger.warning(f"Error resolving the addresses of the offenses page: {str(e)}. They will be resolved on every ticket creation.")
+    new_offenses, fetched_id = offenses_to_jira.select_new_offenses(latest_offenses)
+    await upload_and_commit(offenses_to_jira.get_offense_uploads(new_offenses), fetched_id)
+
+async def sleep_with_heartbeat(name:str, seconds:float) -> None:
+    '''Coroutine version of metrics.sleep_with_heartbeat. Sleeps the given time, recording a heartbeat at least every HEARTBEAT_INTERVAL_SECONDS.
+
+    :param str name: Name of the sleeping coroutine.
+    :param float seconds: Time to sleep in seconds.
+    :return: None
+    :rtype: None
+    '''
+    deadline = time.time() + seconds
+    while True:
+        metrics.heartbeat(name)
+        remaining_seconds = deadline - time.time()
+        if remaining_seconds <= 0:
+            return
+        await asyncio.sleep(min(remaining_seconds, metrics.HEARTBEAT_INTERVAL_SECONDS))
+
+async def poll_new_offenses() -> None:
+    '''Coroutine version of the new offenses thread. Drains the new offenses from QRadar and uploads them to JIRA, waiting the polling rate (or the adaptive polling scheduler wait) between cycles.
+    A JIRA bulk batch that is not full is uploaded once it has waited more than the max linger time.
+
+    :return: None
+    :rtype: None
+    '''
+    while True:
+        metrics.heartbeat("offenses_to_jira")
+        polling_interval = config.polling_rate_new_offenses_checking
+        try:
+            await asyncio.to_thread(offenses_to_jira.load_watermarks)
+            offenses_count = 0
+            page_full = False
+            if offenses_to_jira.should_probe_new_offenses() and not await has_new_offenses():
+                offenses_to_jira_logger.info("No new offenses on QRADAR SIEM (probe).")
+            else:
+                while True:
+                    offenses_to_jira_logger.info("Last processed Offense ID stored on memory file: " + str(offenses_to_jira.last_processed_id) + " . Getting offenses from QRADAR SIEM...")
+                    latest_offenses = await get_latest_offenses(config.offenses_page_size)
+                    offenses_to_jira_logger.info(f"Call succesfully made to QRADAR SIEM. {len(latest_offenses)} offenses obtained.")
+                    offenses_count += len(latest_offenses)
+                    page_full = len(latest_offenses) >= config.offenses_page_size
+                    if not latest_offenses:
+                        offenses_to_jira_logger.info("No offenses obtained from QRADAR SIEM.")
+                        break
+                    await process_offenses_page(latest_offenses)
+                    if not config.drain_mode_enabled or not page_full:
+                        break
+            expired_bulk_upload = offenses_to_jira.get_expired_bulk_upload()
+            if expired_bulk_upload:
+                await upload_and_commit([expired_bulk_upload])
+            await asyncio.to_thread(offenses_to_jira.last_processed_id_checkpoint.flush_if_due)
+            await refresh_newest_offense_id()
+            polling_interval = offenses_to_jira.get_next_polling_interval(offenses_count, page_full)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            offenses_to_jira_logger.error(f"Error pulling and/or sending tickets to JIRA from QRADAR SIEM Offenses obtention: {str(e)}")
+        await sleep_with_heartbeat("offenses_to_jira", polling_interval)
+
+async def reupload_failed_offense(offense:Dict[any,any]) -> None:
+    '''Coroutine version of the failed offense processing. Uploads the open offense to JIRA (unless it already has an issue on the offense issue index), removing it from the failed offenses store on success.
+
+    :param Dict[any,any] offense: Receives the open offense obtained from QRADAR to upload to JIRA
+    :return: None
+    :rtype: None
+    '''
+    offense_id = offense.get('id')
+    failed_offenses_to_jira_retries_logger.info("Processing offense with ID. About to create ticket on JIRA!: %s", offense_id, extra=SAMPLED_LOG)
+    try:
+        await run_upload_steps(jira_uploads.upload_offense_steps(offense, None, failed_offenses_to_jira_retries_logger))
+    except asyncio.CancelledError:
+        raise
+    except OffenseAlreadyClaimedError:
+        failed_offenses_to_jira.reschedule_claimed_offense(offense_id)
+        return
+    except JiraCircuitOpenError as e:
+        failed_offenses_to_jira.postpone_failed_retry(offense_id, e)
+        return
+    except Exception as e:
+        failed_offenses_to_jira_retries_logger.error(f"Error creating ticket on JIRA for offense with id {offense_id} . Error: {str(e)}" )
+        await asyncio.to_thread(failed_offenses_to_jira.record_failed_retry, offense_id, str(e))
+        return
+    failed_offenses_to_jira_retries_logger.info("Ticket created succesfully for offense with ID: %s . Proceeding to delete the ID of the offense from the failed offenses store.", offense_id, extra=SAMPLED_LOG)
+    metrics.retry_attempts.inc(1, "created")
+    await asyncio.to_thread(failed_offenses_to_jira.remove_offense_from_failed_offenses_store, offense_id)
+
+async def reupload_failed_offenses_chunk(offense_ids:List[int]) -> None:
+    '''Retrieves a chunk of failed offenses from QRADAR with a single call, removes at once the closed or non-existent ones from the failed offenses store and uploads the open ones to JIRA concurrently.
+
+    :param List[int] offense_ids: Receives the Offense IDs of the chunk
+    :return: None
+    :rtype: None
+    '''
+    failed_offenses_to_jira_retries_logger.info(f"Processing and sending to JIRA {len(offense_ids)} old failed-to-upload offenses with IDs: {offense_ids}")
+    jira_keys = await asyncio.to_thread(offenses_to_jira.offense_issue_index.get_jira_keys, offense_ids)
+    if jira_keys:
+        failed_offenses_to_jira_retries_logger.warning(f"Offenses {list(jira_keys)} already have a JIRA issue. Removing the offense IDs from the store.")
+        await asyncio.to_thread(failed_offenses_to_jira.remove_offenses_from_failed_offenses_store, list(jira_keys))
+        offense_ids = [offense_id for offense_id in offense_ids if offense_id not in jira_keys]
+        if not offense_ids:
+            return
+    try:
+        open_offenses = await get_open_offenses(offense_ids)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        failed_offenses_to_jira_retries_logger.error(f"Error pulling previously failed offenses from QRADAR with IDs {offense_ids}: {e}. Advancing to next chunk.")
+        for offense_id in offense_ids:
+            await asyncio.to_thread(failed_offenses_to_jira.record_failed_retry, offense_id, str(e))
+        return
+    pruned_offense_ids = [offense_id for offense_id in offense_ids if offense_id not in open_offenses]
+    if pruned_offense_ids:
+        failed_offenses_to_jira_retries_logger.warning(f"Offenses {pruned_offense_ids} are closed or non-existent in QRADAR. Removing the offense IDs from the store.")
+        await asyncio.to_thread(failed_offenses_to_jira.remove_offenses_from_failed_offenses_store, pruned_offense_ids)
+    await asyncio.gather(*[reupload_failed_offense(offense) for offense in open_offenses.values()])
+
+async def retry_failed_offenses() -> None:
+    '''Coroutine version of the failed offenses thread. Retries concurrently every failed offense whose next attempt is due, looking them up on QRADAR in chunks.
+    The failed offenses store is read and written on worker threads, so it never blocks the event loop.
+
+    :return: None
+    :rtype: None
+    '''
+    await asyncio.to_thread(failed_offenses_to_jira.load_failed_offenses_into_scheduler)
+    while True:
+        metrics.heartbeat("failed_offenses_to_jira")
+        await asyncio.to_thread(failed_offenses_to_jira.refresh_scheduler_if_needed)
+        circuit_wait_seconds = http_client.get_jira_circuit_wait()
+        if circuit_wait_seconds > 0: #No failed offense is retried while the JIRA circuit breaker is open, so no attempt is wasted
+            await asyncio.sleep(min(circuit_wait_seconds, NEW_FAILED_OFFENSES_CHECK_SECONDS))
+            continue
+        due_offense_ids = failed_offenses_to_jira.retry_scheduler.pop_due()
+        if due_offense_ids:
+            await asyncio.gather(*[reupload_failed_offenses_chunk(offense_ids) for offense_ids in failed_offenses_to_jira.split_in_chunks(due_offense_ids)])
+        seconds_until_next_retry = failed_offenses_to_jira.retry_scheduler.seconds_until_next()
+        if seconds_until_next_retry is None or seconds_until_next_retry > NEW_FAILED_OFFENSES_CHECK_SECONDS:
+            seconds_until_next_retry = NEW_FAILED_OFFENSES_CHECK_SECONDS
+        await asyncio.sleep(seconds_until_next_retry)
+
+async def run(passedconfig: ServerConfig) -> None:
+    '''Runs the new offenses poller and the failed offenses retrier as coroutines on the same event loop until a stop signal is received. In-flight work is cancelled, the JIRA bulk batch is uploaded and the sessions are closed on shutdown.
+
+    :param ServerConfig passedconfig: Configuration received from the config.ini file
+    :return: None
+    :rtype: None
+    '''
+    global config, in_flight_requests
+    config = passedconfig
+    offenses_to_jira.init_vars(config)
+    failed_offenses_to_jira.init_vars(config)
+    in_flight_requests = asyncio.Semaphore(config.async_max_in_flight_requests)
+    global group_locks
+    group_locks = [asyncio.Lock() for _ in range(GROUP_LOCKS_COUNT)]
+    build_sessions()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_to_handle in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_to_handle, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass #Not supported on this platform. KeyboardInterrupt will cancel the run instead
+
+    if config.offense_updates_sync_enabled:
+        #The offense updates sync is low volume (throttled per offense), so it keeps running on its own daemon thread
+        threading.Thread(target=offense_updates_to_jira.main, args=(config,), daemon=True).start()
+
+    tasks = [asyncio.create_task(poll_new_offenses(), name="offenses_to_jira"), asyncio.create_task(retry_failed_offenses(), name="failed_offenses_to_jira")]
+    app_bootstrap_logger.info("asyncio runtime started. Running the new offenses poller and the failed offenses retrier as coroutines.")
+    try:
+        await stop_event.wait()
+        app_bootstrap_logger.info("Stop signal received. Cancelling in-flight work...")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        pending_bulk_upload = offenses_to_jira.get_pending_bulk_upload()
+        if pending_bulk_upload:
+            try:
+                await upload_and_commit([pending_bulk_upload]) #Offenses still waiting on the JIRA bulk batcher are not left behind
+            except Exception as e:
+                offenses_to_jira_logger.error(f"Error uploading the JIRA bulk batch on shutdown: {str(e)}")
+        await qradar_session.close()
+        await jira_session.close()
+        app_bootstrap_logger.info("asyncio runtime stopped.")
+
+def main(passedconfig: ServerConfig):
+    '''Entry point of the asyncio runtime.
+
+    :param ServerConfig passedconfig: Configuration received from the config.ini file
+    '''
+    try:
+        asyncio.run(run(passedconfig))
+    except KeyboardInterrupt:
+        print("Program interrupted! Exiting...")
@@ -0,0 +1,285 @@
+'''Backfill (replay) of historical offenses to JIRA. Runs alongside the live app without touching its last processed offense ID.
+The requested offense ID or start_time range is split into sub-ranges fetched in parallel from QRADAR, and the tickets are created with the JIRA upload worker pool (one request per offense, bulk requests or one request per group of correlated offenses, as configured).
+Offenses that already have a JIRA issue on the offense issue index are skipped, and the ones that fail are stored on the failed offenses store, so the failed offenses thread of the live app retries them.
+The progress of every sub-range is saved on a progress file, so an interrupted backfill is resumed by running the same command again. Run it from the folder of the config.ini file, like the app. Examples:
+
+    python backfill_offenses_to_jira.py --from-id 1000 --to-id 5000
+    python backfill_offenses_to_jira.py --from-time 2024-01-01T00:00:00 --to-time 2024-02-01T00:00:00 --all-statuses --dry-run
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List
+from app_config import ServerConfig, backfill_logger, init_app
+from checkpoint import write_file_atomically
+from failed_offenses_store import FailedOffensesStore
+from http_client import init_http_clients, qradar_get
+from address_resolver import resolve_offenses_addresses
+from offense_coalescing import get_coalescing_key_fields, get_offense_fields, group_offenses
+from offense_issue_index import OffenseIssueIndex
+from sharding import get_shard_file
+import qradar_siem_offenses_to_jira as offenses_to_jira
+
+DEFAULT_PROGRESS_FILE = "backfill_progress.json"
+
+config: ServerConfig = None #Created on main
+progress: Dict[str,any] = None #Backfill progress, saved on the progress file after every page
+progress_lock = threading.Lock()
+shard_failed_offenses_stores: Dict[int,FailedOffensesStore] = {} #Failed offenses store of every shard, if sharding is enabled
+offense_issue_index: OffenseIssueIndex = None #Offense issue index of the live app. Opened read-only on dry runs, and None if it does not exist yet
+
+def parse_time(value:str) -> int:
+    '''Parses a start_time bound given as epoch milliseconds or as an ISO 8601 date (UTC unless it has a timezone).
+
+    :param str value: The bound as given on the command line.
+    :return: Epoch time in milliseconds.
+    :rtype: int
+    :raises ArgumentTypeError: if the value is not a valid time
+    '''
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        parsed_time = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not epoch milliseconds or an ISO 8601 date")
+    if parsed_time.tzinfo is None:
+        parsed_time = parsed_time.replace(tzinfo=timezone.utc)
+    return int(parsed_time.timestamp() * 1000)
+
+def parse_arguments(arguments:List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Creates the JIRA tickets of the QRADAR offenses of an offense ID or start_time range, without touching the last processed offense ID of the live app.")
+    parser.add_argument("--from-id", type=int, help="First offense ID of the range (included).")
+    parser.add_argument("--to-id", type=int, help="Last offense ID of the range (included).")
+    parser.add_argument("--from-time", type=parse_time, help="Start of the offense start_time range (included), as epoch milliseconds or ISO 8601 date.")
+    parser.add_argument("--to-time", type=parse_time, help="End of the offense start_time range (excluded), as epoch milliseconds or ISO 8601 date.")
+    parser.add_argument("--all-statuses", action="store_true", help="Backfill closed and hidden offenses too. By default only OPEN offenses are backfilled, like the live app does.")
+    parser.add_argument("--sub-ranges", type=int, default=16, help="Number of sub-ranges the range is split into. Defaults to 16.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of sub-ranges fetched from QRADAR in parallel. The JIRA uploads use the jira_upload_workers of config.ini. Defaults to 4.")
+    parser.add_argument("--page-size", type=int, help="Number of offenses requested to QRADAR on every page. Defaults to offenses_page_size of config.ini.")
+    parser.add_argument("--progress-file", default=DEFAULT_PROGRESS_FILE, help=f"File where the progress is saved, to resume an interrupted backfill. Defaults to {DEFAULT_PROGRESS_FILE}.")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the offenses of the range and the ones that already have a JIRA issue. Nothing is created and no progress is saved.")
+    parsed_arguments = parser.parse_args(arguments)
+    id_range = parsed_arguments.from_id is not None or parsed_arguments.to_id is not None
+    time_range = parsed_arguments.from_time is not None or parsed_arguments.to_time is not None
+    if id_range == time_range:
+        parser.error("Provide either --from-id and --to-id or --from-time and --to-time.")
+    if id_range and (parsed_arguments.from_id is None or parsed_arguments.to_id is None or parsed_arguments.from_id > parsed_arguments.to_id):
+        parser.error("--from-id and --to-id are both required, and --from-id must be lower or equal than --to-id.")
+    if time_range and (parsed_arguments.from_time is None or parsed_arguments.to_time is None or parsed_arguments.from_time >= parsed_arguments.to_time):
+        parser.error("--from-time and --to-time are both required, and --from-time must be lower than --to-time.")
+    if parsed_arguments.sub_ranges < 1 or parsed_arguments.workers < 1 or (parsed_arguments.page_size is not None and parsed_arguments.page_size < 1):
+        parser.error("--sub-ranges, --workers and --page-size must be bigger or equal than 1.")
+    return parsed_arguments
+
+def split_range(start:int, end:int, sub_ranges_count:int) -> List[Dict[str,int]]:
+    '''Splits a range into contiguous sub-ranges of the same size.
+
+    :param int start: Start of the range (included).
+    :param int end: End of the range (excluded).
+    :param int sub_ranges_count: Number of sub-ranges. Less are returned if the range is smaller.
+    :return: The sub-ranges, with their start (included), end (excluded), the last offense ID done (cursor) and if they are done.
+    :rtype: List[Dict[str,int]]
+    '''
+    sub_ranges_count = min(sub_ranges_count, end - start)
+    bounds = [start + (end - start) * index // sub_ranges_count for index in range(sub_ranges_count + 1)]
+    return [{"start": bounds[index], "end": bounds[index + 1], "cursor": None, "done": False} for index in range(sub_ranges_count)]
+
+def load_progress(arguments:argparse.Namespace) -> Dict[str,any]:
+    '''Builds the progress of the requested backfill, resuming it from the progress file if it belongs to the same backfill.
+
+    :param Namespace arguments: Parsed command line arguments.
+    :return: The backfill progress.
+    :rtype: Dict[str,any]
+    :raises ValueError: if the progress file belongs to a different backfill
+    '''
+    if arguments.from_id is not None:
+        backfill = {"field": "id", "start": arguments.from_id, "end": arguments.to_id + 1, "all_statuses": arguments.all_statuses}
+    else:
+        backfill = {"field": "start_time", "start": arguments.from_time, "end": arguments.to_time, "all_statuses": arguments.all_statuses}
+    if not arguments.dry_run and os.path.exists(arguments.progress_file):
+        with open(arguments.progress_file, 'r') as file:
+            saved_progress = json.load(file)
+        if any(saved_progress.get(name) != value for name, value in backfill.items()):
+            raise ValueError(f"The progress file {arguments.progress_file} belongs to another backfill ({saved_progress.get('field')} from {saved_progress.get('start')} to {saved_progress.get('end')})."
+                             " Use another --progress-file or delete it.")
+        backfill_logger.info(f"Resuming the backfill from {arguments.progress_file}. {sum(1 for sub_range in saved_progress['sub_ranges'] if sub_range['done'])} of {len(saved_progress['sub_ranges'])} sub-ranges are already done.")
+        return saved_progress
+    backfill.update({"sub_ranges": split_range(backfill["start"], backfill["end"], arguments.sub_ranges), "found": 0, "existing": 0, "created": 0, "failed": 0})
+    return backfill
+
+def save_progress(progress_file:str) -> None:
+    with progress_lock:
+        content = json.dumps(progress, indent=2)
+    write_file_atomically(progress_file, content)
+
+def get_offenses_page(sub_range:Dict[str,int], page_size:int) -> List[Dict[any,any]]:
+    """Retrieve the next page of offenses of a sub-range from QRadar, sorted by ID and starting after the cursor of the sub-range.
+
+    :param Dict[str,int] sub_range: The sub-range to fetch.
+    :param int page_size: Maximum number of offenses to retrieve in the page.
+    :return: JSON response of the offenses obtained.
+    :rtype: List[Dict[any,any]]
+    :raises HttpError: if an error occurred making the HTTP request"""
+    filters = [] if progress["all_statuses"] else ["status=OPEN"]
+    if progress["field"] == "id":
+        filters.append(f"id >= {sub_range['start']} and id < {sub_range['end']}")
+    else:
+        filters.append(f"start_time >= {sub_range['start']} and start_time < {sub_range['end']}")
+    if sub_range["cursor"] is not None:
+        filters.append(f"id > {sub_range['cursor']}")
+    params = { "filter": " and ".join(filters), "sort": "+id", "fields": get_offense_fields(config) }
+    response = qradar_get(config.qradar_url, params=params, headers={"RANGE": f"items=0-{page_size - 1}"})
+    response.raise_for_status()
+    return response.json()
+
+def save_failed_offense(offense_id:int, error:str) -> None:
+    '''Stores an offense that failed to be uploaded on the failed offenses store (the one of its shard if sharding is enabled), so the live app retries it.
+
+    :param int offense_id: ID of the offense that failed.
+    :param str error: Error obtained when uploading the offense.
+    :return: None
+    :rtype: None
+    '''
+    if not config.sharding_enabled:
+        offenses_to_jira.save_failed_offense_update_on_jira(offense_id, error)
+        return
+    shard_index = offense_id % config.shard_count
+    with progress_lock:
+        if shard_index not in shard_failed_offenses_stores:
+            shard_failed_offenses_stores[shard_index] = FailedOffensesStore(get_shard_file(config.failed_offenses_store_file, shard_index, config.shard_count))
+        failed_offenses_store = shard_failed_offenses_stores[shard_index]
+    failed_offenses_store.add(offense_id, error, time.time() + config.retry_base_delay)
+
+def upload_offenses_page(offenses:List[Dict[any,any]]) -> Dict[str,int]:
+    '''Creates the JIRA tickets of a page of offenses with the JIRA upload worker pool (one upload per group of correlated offenses if coalescing is enabled), and stores the ones that fail on the failed offenses store.
+
+    :param List[Dict[any,any]] offenses: Offenses of the page that do not have a JIRA issue yet.
+    :return: Number of created and failed tickets.
+    :rtype: Dict[str,int]
+    '''
+    if config.coalescing_enabled:
+        uploads = [(offenses_to_jira.GROUP_UPLOAD, group, group_key) for group_key, group in group_offenses(offenses, get_coalescing_key_fields(config), config.coalescing_window)]
+    elif config.jira_bulk_enabled:
+        uploads = [(offenses_to_jira.BULK_UPLOAD, offenses[start:start + config.jira_bulk_batch_size], None) for start in range(0, len(offenses), config.jira_bulk_batch_size)]
+    else:
+        try:
+            resolve_offenses_addresses(offenses) #Warms the address IPs cache with one lookup per addresses endpoint for the whole page, instead of one per offense
+        except Exception as e:
+            backfill_logger.warning(f"Error resolving the addresses of the offenses page: {str(e)}. They will be resolved on every ticket creation.")
+        uploads = [(offenses_to_jira.SINGLE_UPLOAD, [offense], None) for offense in offenses]
+
+    outcomes = {}
+    submitted_uploads = [(upload, offenses_to_jira.jira_upload_executor.submit(offenses_to_jira.run_offense_upload, upload)) for upload in uploads]
+    for upload, future in submitted_uploads:
+        try:
+            outcomes.update(future.result())
+        except Exception as e:
+            outcomes.update({offense.get('id'): e for offense in upload[1]})
+
+    counts = {"created": 0, "failed": 0}
+    for offense_id, outcome in outcomes.items():
+        if isinstance(outcome, Exception):
+            backfill_logger.error(f"Exception creating JIRA ticket for offense with ID: {str(offense_id)}: {str(outcome)}")
+            save_failed_offense(offense_id, str(outcome))
+            counts["failed"] += 1
+        else:
+            counts["created"] += 1
+    return counts
+
+def backfill_sub_range(sub_range:Dict[str,int], arguments:argparse.Namespace) -> None:
+    '''Fetches the offenses of a sub-range page by page and creates their JIRA tickets, saving the progress after every page.
+
+    :param Dict[str,int] sub_range: The sub-range to backfill.
+    :param Namespace arguments: Parsed command line arguments.
+    :return: None
+    :rtype: None
+    '''
+    page_size = arguments.page_size or config.offenses_page_size
+    while True:
+        offenses = get_offenses_page(sub_range, page_size)
+        if offenses:
+            jira_keys = offense_issue_index.get_jira_keys([offense.get('id') for offense in offenses]) if offense_issue_index else {}
+            offenses_to_create = [offense for offense in offenses if offense.get('id') not in jira_keys]
+            counts = {"found": len(offenses), "existing": len(jira_keys)}
+            if arguments.dry_run:
+                backfill_logger.info(f"[Dry run] {len(offenses)} offenses from ID {offenses[0].get('id')} to ID {offenses[-1].get('id')}: {len(offenses_to_create)} JIRA tickets would be created, {len(jira_keys)} offenses already have one.")
+            elif offenses_to_create:
+                counts.update(upload_offenses_page(offenses_to_create))
+            with progress_lock:
+                for name, count in counts.items():
+                    progress[name] += count
+                sub_range["cursor"] = offenses[-1].get('id')
+        if len(offenses) < page_size:
+            with progress_lock:
+                sub_range["done"] = True
+        if not arguments.dry_run:
+            save_progress(arguments.progress_file)
+        if sub_range["done"]:
+            return
+
+def get_live_watermark() -> int:
+    '''Reads the last processed offense ID of the live app, without loading it into the live app checkpoint.
+
+    :return: The last processed offense ID, or None if it is not known.
+    :rtype: int
+    '''
+    try:
+        with open(config.last_processed_id_file, 'r') as file:
+            return int(file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def run_backfill(arguments:argparse.Namespace) -> bool:
+    '''Backfills every sub-range that is not done yet, with --workers sub-ranges in parallel.
+
+    :param Namespace arguments: Parsed command line arguments.
+    :return: True if every sub-range is done.
+    :rtype: bool
+    '''
+    global progress, offense_issue_index
+    progress = load_progress(arguments)
+    if arguments.dry_run: #Nothing is written: the failed offenses store and the offense issue index are neither created nor migrated
+        init_http_clients(config)
+        if os.path.exists(config.offense_issue_index_file):
+            offense_issue_index = OffenseIssueIndex(config.offense_issue_index_file, config.offense_issue_index_cache_size, read_only=True)
+    else:
+        offenses_to_jira.init_vars(config, jira_spool_enabled=False) #The backfill exits once done, so nothing is left on the JIRA spool: offenses are stored as failed while the JIRA circuit breaker is open
+        offense_issue_index = offenses_to_jira.offense_issue_index
+    live_watermark = get_live_watermark()
+    if progress["field"] == "id" and live_watermark is not None and progress["end"] - 1 > live_watermark:
+        backfill_logger.warning(f"The backfill range goes past the last processed offense ID of the live app ({live_watermark}). Offenses above it may get a duplicated ticket if the live app processes them at the same time.")
+
+    pending_sub_ranges = [sub_range for sub_range in progress["sub_ranges"] if not sub_range["done"]]
+    backfill_logger.info(f"Backfilling offenses with {progress['field']} from {progress['start']} to {progress['end']} (excluded){' (dry run)' if arguments.dry_run else ''}. {len(pending_sub_ranges)} sub-ranges pending, {arguments.workers} in parallel.")
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=arguments.workers, thread_name_prefix="backfill_worker") as executor:
+        backfills = [(sub_range, executor.submit(backfill_sub_range, sub_range, arguments)) for sub_range in pending_sub_ranges]
+        for sub_range, backfill in backfills:
+            try:
+                backfill.result()
+            except Exception as e:
+                backfill_logger.error(f"Error backfilling the sub-range from {sub_range['start']} to {sub_range['end']} (last offense ID done: {sub_range['cursor']}): {str(e)}. Run the backfill again to resume it.")
+
+    elapsed_seconds = time.monotonic() - start_time
+    done = all(sub_range["done"] for sub_range in progress["sub_ranges"])
+    backfill_logger.info(f"Backfill {'finished' if done else 'interrupted'} in {elapsed_seconds:.1f}s. Offenses found: {progress['found']}, already with a JIRA issue: {progress['existing']}, created: {progress['created']}, failed (stored for retrying): {progress['failed']}.")
+    return done
+
+def main(arguments:List[str] = None):
+    parsed_arguments = parse_arguments(arguments)
+    global config
+    config = init_app()
+    try:
+        done = run_backfill(parsed_arguments)
+    except (OSError, ValueError) as e:
+        backfill_logger.error(f"Error starting the backfill: {str(e)}")
+        sys.exit(2)
+    sys.exit(0 if done else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import tempfile
+import threading
+import time
+
+def write_file_atomically(file_path:str, content:str) -> None:
+    '''Replaces the content of a file atomically: the content is written and fsynced to a temporary file on the same folder, which is then renamed over the file.
+    A crash at any point leaves either the previous content or the new one, never an empty or half written file.
+
+    :param str file_path: Path of the file to replace.
+    :param str content: New content of the file.
+    :return: None
+    :rtype: None
+    :raises OSError: if an error occurs when writing or renaming the file
+    '''
+    folder = os.path.dirname(os.path.abspath(file_path))
+    file_descriptor, temp_file_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + '.', suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(file_descriptor, 'w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_file_path)
+        except OSError:
+            pass
+        raise
+    try:
+        folder_descriptor = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return #Folders cannot be opened on some platforms (Windows). The rename is still atomic
+    try:
+        os.fsync(folder_descriptor) #Persists the rename itself
+    except OSError:
+        pass
+    finally:
+        os.close(folder_descriptor)
+
+class Checkpoint:
+    '''In-memory watermark persisted on a file. Updates are coalesced: the file is only rewritten (atomically) once flush_every updates are pending or flush_interval seconds
+    have passed since the last write, and on flush. The file is only read once, on load at startup.'''
+
+    def __init__(self, file_path:str, flush_every:int, flush_interval:float):
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.value: int = None
+        self.flushed_value: int = None
+        self.pending_updates = 0
+        self.last_flush_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def load(self) -> int:
+        '''Reads the watermark from the file.
+
+        :return: The stored watermark, or None if the file does not exist or is empty.
+        :rtype: int
+        :raises OSError,ValueError: if an error occurs when opening/reading the file
+        '''
+        with self.lock:
+            if os.path.exists(self.file_path):
+                with open(self.file_path, 'r') as file:
+                    content = file.read().strip()
+                if content:
+                    self.value = self.flushed_value = int(content)
+            return self.value
+
+    def update(self, value:int) -> None:
+        '''Moves the watermark in memory and writes it to the file if enough updates are pending or enough time passed since the last write.
+
+        :param int value: New watermark.
+        :return: None
+        :rtype: None
+        :raises OSError: if an error occurs when writing the file
+        '''
+        with self.lock:
+            self.value = value
+            self.pending_updates += 1
+            if self.pending_updates >= self.flush_every or time.monotonic() - self.last_flush_time >= self.flush_interval:
+                self._flush()
+
+    def flush_if_due(self) -> None:
+        '''Writes the watermark to the file if it changed and flush_interval seconds passed since the last write. Meant to be called when no more updates may come for a while.
+
+        :return: None
+        :rtype: None
+        :raises OSError: if an error occurs when writing the file
+        '''
+        with self.lock:
+            if time.monotonic() - self.last_flush_time >= self.flush_interval:
+                self._flush()
+
+    def flush(self) -> None:
+        '''Writes the watermark to the file right away if it changed since the last write (on shutdown).
+
+        :return: None
+        :rtype: None
+        :raises OSError: if an error occurs when writing the file
+        '''
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.value is not None and self.value != self.flushed_value:
+            write_file_atomically(self.file_path, str(self.value))
+            self.flushed_value = self.value
+        self.pending_updates = 0
+        self.last_flush_time = time.monotonic()
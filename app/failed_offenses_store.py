@@ -0,0 +1,200 @@
+import os
+import time
+import sqlite3
+import threading
+from typing import List, NamedTuple, Tuple
+from app_config import ServerConfig
+
+class FailedOffense(NamedTuple):
+    '''Entry of the failed offenses store.'''
+    offense_id: int
+    attempts: int
+    last_error: str
+    next_attempt_time: float
+    created_time: float
+    dead_letter: bool
+
+class FailedOffensesStore:
+    '''SQLite backed store of the offenses that failed to be uploaded to JIRA. Offense IDs are the primary key of the table, so inserting and deleting an offense is O(1) (indexed) instead of rewriting a whole file.
+    The store can be shared by every thread of the app: all the calls are serialized with a lock over a single connection.
+    Offenses that reached the max retry attempts are kept on the store as dead letter entries, and are no longer retried.'''
+
+    def __init__(self, db_file:str):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.new_offense_event = threading.Event() #Set every time an offense is added, so the retry thread can schedule it without waiting for its next store scan
+        self.new_offenses: List[Tuple[int,float]] = [] #(offense ID, next attempt time) of the offenses added since the retry thread last took them
+        self.new_offenses_tracked = False #Only processes running the retry thread take the new offenses, so they are not kept otherwise (a backfill would keep them forever)
+        self.connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS failed_offenses (
+                offense_id INTEGER PRIMARY KEY,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                next_attempt_time REAL NOT NULL,
+                created_time REAL NOT NULL,
+                dead_letter INTEGER NOT NULL DEFAULT 0)''')
+            columns = [column[1] for column in self.connection.execute("PRAGMA table_info(failed_offenses)").fetchall()]
+            if 'dead_letter' not in columns:
+                self.connection.execute("ALTER TABLE failed_offenses ADD COLUMN dead_letter INTEGER NOT NULL DEFAULT 0")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS failed_offenses_next_attempt_time ON failed_offenses (next_attempt_time)")
+
+    def add(self, offense_id:int, error:str = None, next_attempt_time:float = None) -> None:
+        '''Adds an offense to the store. If the offense is already stored, it failed again on a new upload (a new offense, spool drain or backfill), not on a retry:
+        it starts a new retry cycle, so its attempts are reset, it leaves the dead letter offenses and its next attempt time is replaced.
+
+        :param int offense_id: ID of the offense that failed to be uploaded to JIRA.
+        :param str error: Error obtained when uploading the offense.
+        :param float next_attempt_time: Epoch time when the offense can be retried. Defaults to now.
+        :return: None
+        :rtype: None
+        '''
+        now = time.time()
+        with self.lock:
+            self.connection.execute('''INSERT INTO failed_offenses (offense_id, attempts, last_error, next_attempt_time, created_time) VALUES (?, 0, ?, ?, ?)
+                ON CONFLICT(offense_id) DO UPDATE SET attempts = 0, last_error = excluded.last_error, next_attempt_time = excluded.next_attempt_time, dead_letter = 0''', (offense_id, error, next_attempt_time or now, now))
+            if self.new_offenses_tracked:
+                self.new_offenses.append((offense_id, next_attempt_time or now))
+        self.new_offense_event.set()
+
+    def track_new_offenses(self) -> None:
+        '''Starts keeping the offenses added to the store, to be returned by take_new_offenses. Called by the retry thread, the only consumer of the new offenses.
+
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.new_offenses_tracked = True
+
+    def take_new_offenses(self) -> List[Tuple[int,float]]:
+        '''Returns the offenses added since the last call and clears the new offense event, so the retry thread schedules only them instead of reloading the whole store.
+
+        :return: List of (offense ID, next attempt time) of the added offenses.
+        :rtype: List[Tuple[int,float]]
+        '''
+        with self.lock:
+            self.new_offense_event.clear()
+            new_offenses = self.new_offenses
+            self.new_offenses = []
+        return new_offenses
+
+    def remove(self, offense_id:int) -> None:
+        '''Removes an offense from the store.
+
+        :param int offense_id: ID of the offense to remove.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute("DELETE FROM failed_offenses WHERE offense_id = ?", (offense_id,))
+
+    def remove_many(self, offense_ids:List[int]) -> None:
+        '''Removes several offenses from the store in a single transaction.
+
+        :param List[int] offense_ids: IDs of the offenses to remove.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("DELETE FROM failed_offenses WHERE offense_id = ?", [(offense_id,) for offense_id in offense_ids])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def record_attempt(self, offense_id:int, error:str, next_attempt_time:float) -> None:
+        '''Records a failed retry of an offense: increases its attempts and stores the error and the time of the next attempt.
+
+        :param int offense_id: ID of the offense that failed again.
+        :param str error: Error obtained when retrying the offense.
+        :param float next_attempt_time: Epoch time when the offense can be retried again.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute("UPDATE failed_offenses SET attempts = attempts + 1, last_error = ?, next_attempt_time = ? WHERE offense_id = ?", (error, next_attempt_time, offense_id))
+
+    def mark_dead_letter(self, offense_id:int, error:str) -> None:
+        '''Moves an offense to the dead letter state after its last failed attempt. Dead letter offenses are kept on the store but never retried again.
+
+        :param int offense_id: ID of the offense.
+        :param str error: Error obtained on the last attempt.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute("UPDATE failed_offenses SET attempts = attempts + 1, last_error = ?, dead_letter = 1 WHERE offense_id = ?", (error, offense_id))
+
+    def get(self, offense_id:int) -> FailedOffense:
+        '''Returns an offense of the store.
+
+        :param int offense_id: ID of the offense.
+        :return: The stored failed offense, or None if it is not on the store.
+        :rtype: FailedOffense
+        '''
+        with self.lock:
+            row = self.connection.execute("SELECT offense_id, attempts, last_error, next_attempt_time, created_time, dead_letter FROM failed_offenses WHERE offense_id = ?", (offense_id,)).fetchone()
+        return FailedOffense(*row) if row else None
+
+    def get_all(self, include_dead_letter:bool = False) -> List[FailedOffense]:
+        '''Returns every offense of the store, sorted by the time of their next attempt.
+
+        :param bool include_dead_letter: If true, dead letter offenses are returned too.
+        :return: The stored failed offenses.
+        :rtype: List[FailedOffense]
+        '''
+        query = "SELECT offense_id, attempts, last_error, next_attempt_time, created_time, dead_letter FROM failed_offenses"
+        if not include_dead_letter:
+            query += " WHERE dead_letter = 0"
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY next_attempt_time").fetchall()
+        return [FailedOffense(*row) for row in rows]
+
+    def count(self, dead_letter:bool = False) -> int:
+        '''Returns the number of offenses in the store.
+
+        :param bool dead_letter: If true, counts the dead letter offenses instead of the ones pending to be retried.
+        :return: Number of failed offenses.
+        :rtype: int
+        '''
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM failed_offenses WHERE dead_letter = ?", (1 if dead_letter else 0,)).fetchone()[0]
+
+    def import_legacy_file(self, legacy_file:str) -> int:
+        '''Imports the offense IDs of the old comma separated failed offenses file and empties it, so no failed offense is lost when upgrading.
+
+        :param str legacy_file: Location of the old comma separated failed offenses file.
+        :return: Number of offense IDs imported.
+        :rtype: int
+        '''
+        if not legacy_file or not os.path.exists(legacy_file):
+            return 0
+        with open(legacy_file, 'r') as file:
+            ids_as_string = file.read().strip().split(",")
+        offense_ids = {int(id_str) for id_str in ids_as_string if id_str.strip().isdigit()}
+        for offense_id in offense_ids:
+            self.add(offense_id, "Imported from the legacy failed offenses file")
+        with open(legacy_file, 'w') as file:
+            file.write("")
+        return len(offense_ids)
+
+failed_offenses_store: FailedOffensesStore = None #Store shared by every thread of the app. Created on init_failed_offenses_store
+failed_offenses_store_lock = threading.Lock()
+
+def init_failed_offenses_store(config:ServerConfig) -> FailedOffensesStore:
+    '''Initializates the failed offenses store shared by the app threads, importing the old failed offenses file if it has any offense ID. The store is only created once.
+
+    :param ServerConfig config: Configuration received from the config.ini file
+    :return: The shared failed offenses store.
+    :rtype: FailedOffensesStore
+    '''
+    global failed_offenses_store
+    with failed_offenses_store_lock:
+        if failed_offenses_store is None:
+            failed_offenses_store = FailedOffensesStore(config.failed_offenses_store_file)
+            failed_offenses_store.import_legacy_file(config.failed_processed_id_file)
+        return failed_offenses_store
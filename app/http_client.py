@@ -0,0 +1,169 @@
+import threading
+import time
+from typing import Dict
+import requests
+from requests.adapters import HTTPAdapter
+from app_config import ServerConfig, on_config_reload
+from jira_circuit_breaker import CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, JiraCircuitBreaker, JiraCircuitOpenError
+from jira_rate_governor import JiraRateGovernor
+import metrics
+
+QRADAR_API_VERSION = "20.0" #Version of the QRadar API used on every call
+QRADAR_OFFENSE_FIELDS = "id,description,offense_type,status,start_time,last_updated_time,source_address_ids,local_destination_address_ids" #Fields projection of the offenses, limited to the ones used to build the JIRA tickets
+
+config: ServerConfig = None
+qradar_session: requests.Session = None #Shared keep-alive session used for every QRadar API call
+jira_session: requests.Session = None #Shared keep-alive session used for every JIRA API call
+jira_rate_governor: JiraRateGovernor = None #Rate governor shared by every JIRA API call, including the asyncio runtime ones
+jira_circuit_breaker: JiraCircuitBreaker = None #Circuit breaker shared by every JIRA API call, including the asyncio runtime ones. Only created if the JIRA circuit breaker is enabled
+http_clients_lock = threading.Lock()
+
+def build_session(pool_size:int, default_headers:Dict[str,str]) -> requests.Session:
+    '''Builds a requests Session with a keep-alive connection pool of the given size and the default headers set once.
+
+    :param int pool_size: Maximum number of connections kept alive for the host.
+    :param Dict[str,str] default_headers: Headers sent on every request made with the session.
+    :return: The configured session.
+    :rtype: Session
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(default_headers)
+    return session
+
+def get_timeout() -> tuple:
+    '''Returns the (connect, read) timeout tuple to use on every HTTP call.
+
+    :return: Connect and read timeouts in seconds.
+    :rtype: tuple
+    '''
+    return (config.http_connect_timeout, config.http_read_timeout)
+
+def check_jira_circuit() -> None:
+    '''Fails fast while the JIRA circuit breaker is open, before waiting on the JIRA rate governor. Does nothing if the circuit breaker is disabled.
+
+    :return: None
+    :rtype: None
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open
+    '''
+    if jira_circuit_breaker is not None:
+        seconds_until_probe = jira_circuit_breaker.seconds_until_probe()
+        if seconds_until_probe > 0:
+            raise JiraCircuitOpenError(seconds_until_probe)
+
+def acquire_jira_circuit() -> None:
+    '''Asks the JIRA circuit breaker to send a request that already got a slot of the JIRA rate governor (the circuit may have opened meanwhile). If it is refused, the governor slot is given back.
+
+    :return: None
+    :rtype: None
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open, or half-open with its probe already in flight
+    '''
+    if jira_circuit_breaker is not None and not jira_circuit_breaker.try_acquire():
+        jira_rate_governor.release(None, None, 0)
+        raise JiraCircuitOpenError(jira_circuit_breaker.seconds_until_probe())
+
+def record_jira_outcome(status:int) -> None:
+    '''Records the outcome of a JIRA request on the JIRA circuit breaker: connection errors, timeouts and 5xx responses are failures, any other answer means JIRA is available.
+
+    :param int status: HTTP status of the response, or None if no response was received.
+    :return: None
+    :rtype: None
+    '''
+    if jira_circuit_breaker is None:
+        return
+    if status is None or status >= 500:
+        jira_circuit_breaker.record_failure()
+    else:
+        jira_circuit_breaker.record_success()
+
+def get_jira_circuit_wait() -> float:
+    '''Returns the seconds left until the JIRA circuit breaker lets a probe request through.
+
+    :return: 0 if JIRA requests can be sent (or the circuit breaker is disabled), otherwise the seconds left of the open time.
+    :rtype: float
+    '''
+    return jira_circuit_breaker.seconds_until_probe() if jira_circuit_breaker is not None else 0
+
+def qradar_get(url:str, params:Dict[str,str] = None, headers:Dict[str,str] = None, stream:bool = False) -> requests.Response:
+    '''Makes a GET request to the QRadar API using the shared QRadar session.
+
+    :param str url: URL of the QRadar API endpoint.
+    :param Dict[str,str] params: Query parameters of the request.
+    :param Dict[str,str] headers: Extra headers for this request only (for example, RANGE). Default headers are already set on the session.
+    :param bool stream: If true, the body is not downloaded until it is read, so it can be parsed incrementally. The response must be closed once read.
+    :return: The response obtained from QRadar.
+    :rtype: Response
+    :raises RequestException: if the request could not be made or timed out
+    '''
+    return qradar_session.get(url, params=params, headers=headers, timeout=get_timeout(), stream=stream)
+
+def jira_post(url:str, json:Dict[any,any]) -> requests.Response:
+    '''Makes a POST request to the JIRA API using the shared JIRA session, through the JIRA rate governor.
+    Throttled requests (429) wait for the time requested by JIRA and are sent again, up to jira_throttle_max_retries times, instead of failing.
+    While the JIRA circuit breaker is open, no request is sent.
+
+    :param str url: URL of the JIRA API endpoint.
+    :param Dict[any,any] json: Body of the request.
+    :return: The response obtained from JIRA.
+    :rtype: Response
+    :raises RequestException: if the request could not be made or timed out
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open
+    '''
+    check_jira_circuit()
+    attempt = 0
+    while True:
+        jira_rate_governor.acquire()
+        acquire_jira_circuit()
+        start_time = time.monotonic()
+        response = None
+        try:
+            response = jira_session.post(url, json=json, timeout=get_timeout())
+        finally:
+            latency = time.monotonic() - start_time
+            jira_rate_governor.release(response.status_code if response is not None else None, response.headers if response is not None else None, latency)
+            record_jira_outcome(response.status_code if response is not None else None)
+            metrics.jira_request_duration.observe(latency, str(response.status_code) if response is not None else "error")
+        if response.status_code != 429 or attempt >= config.jira_throttle_max_retries:
+            return response
+        attempt += 1
+
+def apply_reloaded_config(reloaded_config:ServerConfig) -> None:
+    '''Applies a reloaded configuration to the shared sessions (credentials), JIRA rate governor and JIRA circuit breaker, keeping their connection pools and state.
+
+    :param ServerConfig reloaded_config: Configuration updated by the config reload
+    :return: None
+    :rtype: None
+    '''
+    qradar_session.headers['SEC'] = reloaded_config.qradar_api_key
+    jira_session.auth = (reloaded_config.jira_user, reloaded_config.jira_api_token)
+    jira_rate_governor.reconfigure(reloaded_config.jira_requests_per_second, reloaded_config.jira_burst, reloaded_config.jira_max_concurrency, reloaded_config.jira_latency_target)
+    if jira_circuit_breaker is not None:
+        jira_circuit_breaker.reconfigure(reloaded_config.circuit_failure_threshold, reloaded_config.circuit_open_seconds)
+
+def init_http_clients(passedconfig: ServerConfig):
+    '''
+    Initializates the shared QRadar and JIRA sessions. Both app threads call it, but the sessions are only built once.
+
+    :param ServerConfig passedconfig: Configuration received from the config.ini file
+    :return: None
+    :rtype: None
+    '''
+    global config, qradar_session, jira_session, jira_rate_governor, jira_circuit_breaker
+    with http_clients_lock:
+        if qradar_session is not None and jira_session is not None:
+            return
+        config = passedconfig
+        qradar_session = build_session(config.qradar_pool_size, {'SEC': config.qradar_api_key, 'Accept': 'application/json', 'VERSION': QRADAR_API_VERSION})
+        qradar_session.verify = False
+        jira_session = build_session(config.jira_pool_size, {'Accept': 'application/json', 'Content-Type': 'application/json'})
+        jira_session.auth = (config.jira_user, config.jira_api_token)
+        jira_rate_governor = JiraRateGovernor(config.jira_requests_per_second, config.jira_burst, 1, config.jira_max_concurrency, config.jira_latency_target)
+        metrics.register(metrics.Gauge("qradar2jira_jira_concurrency_limit", "Current limit of JIRA requests in flight set by the JIRA rate governor.", callback=lambda: int(jira_rate_governor.concurrency_limit)))
+        metrics.register(metrics.Gauge("qradar2jira_jira_requests_in_flight", "JIRA requests in flight.", callback=lambda: jira_rate_governor.in_flight))
+        if config.circuit_breaker_enabled:
+            jira_circuit_breaker = JiraCircuitBreaker(config.circuit_failure_threshold, config.circuit_open_seconds)
+            metrics.register(metrics.Gauge("qradar2jira_jira_circuit_state", "State of the JIRA circuit breaker (0 closed, 1 half-open, 2 open).",
+                                           callback=lambda: 0 if jira_circuit_breaker.state == CIRCUIT_CLOSED else 1 if jira_circuit_breaker.state == CIRCUIT_HALF_OPEN else 2))
+        on_config_reload(apply_reloaded_config)
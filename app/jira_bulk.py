@@ -0,0 +1,108 @@
+import time
+import threading
+from typing import Dict, List
+from app_config import ServerConfig
+
+JIRA_BULK_MAX_ISSUES = 50 #Maximum number of issues accepted by JIRA on a single bulk creation request
+
+class JiraBulkItemError(Exception):
+    '''Raised (or stored as the outcome) for an offense whose issue was rejected inside a JIRA bulk creation response.'''
+    def __init__(self, offense_id:int, status:int, element_errors:Dict[any,any]):
+        super().__init__(f"JIRA rejected the issue of offense {offense_id} on the bulk request with status {status}: {element_errors}")
+        self.offense_id = offense_id
+        self.status = status
+        self.element_errors = element_errors
+
+class JiraBulkBatcher:
+    '''Collects pending offenses into JIRA bulk creation batches. A batch is released when it reaches the batch size or when its oldest offense has waited more than the max linger time.'''
+    def __init__(self, batch_size:int, max_linger_seconds:int):
+        self.batch_size = min(batch_size, JIRA_BULK_MAX_ISSUES)
+        self.max_linger_seconds = max_linger_seconds
+        self.pending_offenses: List[Dict[any,any]] = []
+        self.oldest_offense_time = None
+        self.lock = threading.Lock()
+
+    def add(self, offense:Dict[any,any]) -> List[Dict[any,any]]:
+        '''Adds an offense to the current batch.
+
+        :param Dict[any,any] offense: The offense obtained from QRADAR SIEM
+        :return: The full batch to upload if the batch size was reached, None otherwise.
+        :rtype: List[Dict[any,any]]
+        '''
+        with self.lock:
+            if not self.pending_offenses:
+                self.oldest_offense_time = time.monotonic()
+            self.pending_offenses.append(offense)
+            if len(self.pending_offenses) >= self.batch_size:
+                return self._take()
+            return None
+
+    def take_expired(self) -> List[Dict[any,any]]:
+        '''Releases the current batch if its oldest offense has waited more than the max linger time.
+
+        :return: The batch to upload, or None if there is nothing to flush yet.
+        :rtype: List[Dict[any,any]]
+        '''
+        with self.lock:
+            if self.pending_offenses and time.monotonic() - self.oldest_offense_time >= self.max_linger_seconds:
+                return self._take()
+            return None
+
+    def take_all(self) -> List[Dict[any,any]]:
+        '''Releases the current batch whatever its size or age.
+
+        :return: The batch to upload, or None if it is empty.
+        :rtype: List[Dict[any,any]]
+        '''
+        with self.lock:
+            return self._take() if self.pending_offenses else None
+
+    def is_empty(self) -> bool:
+        '''Checks if there is no offense waiting on the current batch.
+
+        :return: True if the current batch is empty.
+        :rtype: bool
+        '''
+        with self.lock:
+            return not self.pending_offenses
+
+    def _take(self) -> List[Dict[any,any]]:
+        batch = self.pending_offenses
+        self.pending_offenses = []
+        self.oldest_offense_time = None
+        return batch
+
+def get_jira_bulk_url(config:ServerConfig) -> str:
+    '''Returns the JIRA bulk issue creation URL (/rest/api/3/issue/bulk) derived from the configured JIRA issue URL.
+
+    :param ServerConfig config: Configuration received from the config.ini file
+    :return: URL of the bulk endpoint.
+    :rtype: str
+    '''
+    return config.jira_url.rstrip('/') + '/bulk'
+
+def parse_jira_bulk_response(offenses:List[Dict[any,any]], response_body:Dict[any,any]) -> Dict[int,any]:
+    '''Maps a JIRA bulk creation response to the outcome of every offense of the batch.
+    JIRA reports rejected elements by their position on the request (failedElementNumber) and lists the created issues in request order.
+
+    :param List[Dict[any,any]] offenses: Offenses sent on the bulk request, in request order.
+    :param Dict[any,any] response_body: JSON body of the bulk response.
+    :return: Dictionary with the offense ID as key and the created issue (dict) or a JiraBulkItemError as value.
+    :rtype: Dict[int,any]
+    '''
+    failed_elements = {}
+    for error in response_body.get('errors', []):
+        failed_elements[error.get('failedElementNumber')] = error
+
+    created_issues = iter(response_body.get('issues', []))
+    outcomes = {}
+    for element_number, offense in enumerate(offenses):
+        offense_id = offense.get('id')
+        if element_number in failed_elements:
+            error = failed_elements[element_number]
+            outcomes[offense_id] = JiraBulkItemError(offense_id, error.get('status'), error.get('elementErrors'))
+        else:
+            outcomes[offense_id] = next(created_issues, None)
+            if outcomes[offense_id] is None:
+                outcomes[offense_id] = JiraBulkItemError(offense_id, None, "Issue missing on the bulk response")
+    return outcomes
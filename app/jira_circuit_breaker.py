@@ -0,0 +1,112 @@
+import threading
+import time
+from app_config import offenses_to_jira_logger
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+class JiraCircuitOpenError(Exception):
+    '''Raised instead of sending a JIRA request while the JIRA circuit breaker is open.'''
+    def __init__(self, seconds_until_probe:float):
+        super().__init__(f"JIRA is unavailable (circuit breaker open). Next probe in {seconds_until_probe:.1f} seconds")
+        self.seconds_until_probe = seconds_until_probe
+
+class JiraCircuitBreaker:
+    '''Circuit breaker placed in front of every JIRA call, so the app stops waiting for timeouts while JIRA is down.
+
+    - Closed: requests are sent. After failure_threshold consecutive failures (connection errors, timeouts or 5xx responses) the circuit opens.
+    - Open: requests fail right away with JiraCircuitOpenError for open_seconds.
+    - Half-open: a single probe request is let through. If it succeeds the circuit closes, otherwise it opens again.
+
+    Like the rate governor, it never blocks, so it is shared by the threads and by the asyncio runtime.'''
+
+    def __init__(self, failure_threshold:int, open_seconds:int):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self.opened_time = 0.0
+        self.probe_in_flight = False
+        self.closed_event = threading.Event() #Set while the circuit is closed, so waiters wake up as soon as JIRA recovers
+        self.closed_event.set()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        '''Checks if a request can be sent to JIRA. Once the open time is over, only one probe request is let through until its outcome is recorded.
+
+        :return: True if the request can be sent (its outcome must be recorded with record_success or record_failure).
+        :rtype: bool
+        '''
+        with self.lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and time.monotonic() - self.opened_time >= self.open_seconds:
+                self.state = CIRCUIT_HALF_OPEN
+                self.probe_in_flight = False
+                offenses_to_jira_logger.info("JIRA circuit breaker half-open. Probing JIRA...")
+            if self.state == CIRCUIT_HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        '''Records a request answered by JIRA (any status but 5xx). Closes the circuit if it was a probe.
+
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.consecutive_failures = 0
+            if self.state != CIRCUIT_CLOSED:
+                self.state = CIRCUIT_CLOSED
+                self.probe_in_flight = False
+                self.closed_event.set()
+                offenses_to_jira_logger.warning("JIRA is available again. JIRA circuit breaker closed.")
+
+    def record_failure(self) -> None:
+        '''Records a request that failed (connection error, timeout or 5xx response). Opens the circuit once failure_threshold failures happen in a row, or right away if it was a probe.
+
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or (self.state == CIRCUIT_CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.state = CIRCUIT_OPEN
+                self.opened_time = time.monotonic()
+                self.probe_in_flight = False
+                self.closed_event.clear()
+                offenses_to_jira_logger.error(f"JIRA failed {self.consecutive_failures} requests in a row. JIRA circuit breaker open for {self.open_seconds} seconds.")
+
+    def reconfigure(self, failure_threshold:int, open_seconds:int) -> None:
+        '''Applies a new failure threshold and open time (on a config reload). An open circuit uses the new open time right away.
+
+        :param int failure_threshold: Number of failures in a row that open the circuit.
+        :param int open_seconds: Seconds the circuit stays open before a probe is sent.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.failure_threshold = failure_threshold
+            self.open_seconds = open_seconds
+
+    def seconds_until_probe(self) -> float:
+        '''Returns the seconds left until the next probe can be sent.
+
+        :return: 0 if the circuit is not open anymore, otherwise the seconds left of the open time.
+        :rtype: float
+        '''
+        with self.lock:
+            if self.state != CIRCUIT_OPEN:
+                return 0
+            return max(0, self.open_seconds - (time.monotonic() - self.opened_time))
+
+    def is_closed(self) -> bool:
+        '''Checks if the circuit is closed (JIRA is considered available).
+
+        :return: True if the circuit is closed.
+        :rtype: bool
+        '''
+        with self.lock:
+            return self.state == CIRCUIT_CLOSED
@@ -0,0 +1,158 @@
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Mapping
+
+CONCURRENCY_WAIT_SECONDS = 0.05 #Max time to wait before checking again for a free concurrency slot when every slot is in use
+THROTTLED_DEFAULT_PAUSE_SECONDS = 1 #Pause applied when JIRA throttles a request without telling for how long
+THROTTLE_DECREASE_COOLDOWN_SECONDS = 1 #Throttled responses received within this time of the last decrease belong to the same storm and only decrease the concurrency once
+
+class JiraRateGovernor:
+    '''Client-side rate governor placed in front of every JIRA call. It combines:
+
+    - A token bucket limiting the requests per second sent to JIRA, with a burst capacity.
+    - A pause of every call until the time given by the Retry-After or X-RateLimit-Reset headers of a throttled response.
+    - An adaptive (AIMD) limit of the requests in flight: it grows by one request per round of successful fast responses, and it is halved when JIRA throttles a request or the latency goes over the target.
+
+    It never blocks on its own: try_acquire returns the seconds to wait, so it can be shared by the threads (see acquire) and by the asyncio runtime.'''
+
+    def __init__(self, requests_per_second:float, burst:int, min_concurrency:int, max_concurrency:int, latency_target:float):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.tokens = float(burst)
+        self.last_refill_time = time.monotonic()
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0 #Monotonic time until which JIRA asked us not to send more requests
+        self.last_decrease_time = 0.0
+        self.throttled_count = 0
+        self.condition = threading.Condition()
+
+    def _refill(self, now:float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill_time) * self.requests_per_second)
+        self.last_refill_time = now
+
+    def try_acquire(self) -> float:
+        '''Tries to take a token and a concurrency slot to send a request to JIRA. It never blocks.
+
+        :return: 0 if the request can be sent now (release must be called once it finishes), otherwise the seconds to wait before trying again.
+        :rtype: float
+        '''
+        with self.condition:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= int(self.concurrency_limit):
+                return CONCURRENCY_WAIT_SECONDS
+            self._refill(now)
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.requests_per_second
+            self.tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    def acquire(self) -> None:
+        '''Blocks the calling thread until a request can be sent to JIRA. Release must be called once the request finishes.
+
+        :return: None
+        :rtype: None
+        '''
+        while True:
+            wait_seconds = self.try_acquire()
+            if wait_seconds <= 0:
+                return
+            with self.condition:
+                self.condition.wait(wait_seconds)
+
+    def reconfigure(self, requests_per_second:float, burst:int, max_concurrency:int, latency_target:float) -> None:
+        '''Applies new limits to the governor (on a config reload). The current concurrency limit is capped to the new max concurrency, and the tokens to the new burst.
+
+        :param float requests_per_second: Maximum number of requests per second.
+        :param int burst: Maximum number of requests that can be sent at once after an idle period.
+        :param int max_concurrency: Maximum number of requests in flight.
+        :param float latency_target: Seconds a request should take at most.
+        :return: None
+        :rtype: None
+        '''
+        with self.condition:
+            self._refill(time.monotonic())
+            self.requests_per_second = requests_per_second
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+            self.max_concurrency = max_concurrency
+            self.concurrency_limit = min(self.concurrency_limit, max_concurrency)
+            self.latency_target = latency_target
+            self.condition.notify_all()
+
+    def release(self, status_code:int, headers:Mapping[str,str], latency:float) -> None:
+        '''Frees the concurrency slot of a finished request and adapts the governor to the JIRA response.
+
+        :param int status_code: HTTP status of the response, or None if the request failed without response.
+        :param Mapping[str,str] headers: Headers of the response.
+        :param float latency: Seconds taken by the request.
+        :return: None
+        :rtype: None
+        '''
+        with self.condition:
+            now = time.monotonic()
+            self.in_flight = max(0, self.in_flight - 1)
+            pause_seconds = get_pause_seconds(status_code, headers or {})
+            if not pause_seconds and status_code in (429, 503):
+                pause_seconds = THROTTLED_DEFAULT_PAUSE_SECONDS
+            if pause_seconds:
+                self.paused_until = max(self.paused_until, now + pause_seconds)
+            if status_code in (429, 503):
+                self.throttled_count += 1
+                self._decrease(now)
+            elif (headers or {}).get('X-RateLimit-NearLimit', '').lower() == 'true' or latency > self.latency_target:
+                self._decrease(now)
+            elif status_code is not None and status_code < 400:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+            self.condition.notify_all()
+
+    def _decrease(self, now:float) -> None:
+        if now - self.last_decrease_time >= THROTTLE_DECREASE_COOLDOWN_SECONDS:
+            self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+            self.last_decrease_time = now
+
+def parse_http_time(value:str) -> float:
+    '''Parses an HTTP date (Retry-After) or an ISO 8601 timestamp (X-RateLimit-Reset) into an epoch time.
+
+    :param str value: Value of the header.
+    :return: Epoch time, or None if the value could not be parsed.
+    :rtype: float
+    '''
+    for parse in (parsedate_to_datetime, lambda text: datetime.fromisoformat(text.replace('Z', '+00:00'))):
+        try:
+            parsed_time = parse(value)
+        except (TypeError, ValueError, IndexError):
+            continue
+        if parsed_time.tzinfo is None:
+            parsed_time = parsed_time.replace(tzinfo=timezone.utc)
+        return parsed_time.timestamp()
+    return None
+
+def get_pause_seconds(status_code:int, headers:Mapping[str,str]) -> float:
+    '''Returns for how long JIRA asked to stop sending requests, from the Retry-After header (seconds or HTTP date) or, once the rate limit is exhausted, from the X-RateLimit-Reset header.
+
+    :param int status_code: HTTP status of the response.
+    :param Mapping[str,str] headers: Headers of the response.
+    :return: Seconds to pause every JIRA call, or 0 if no pause was requested.
+    :rtype: float
+    '''
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        if retry_after.strip().isdigit():
+            return float(retry_after.strip())
+        retry_time = parse_http_time(retry_after)
+        if retry_time is not None:
+            return max(0.0, retry_time - time.time())
+    if headers.get('X-RateLimit-Remaining', '').strip() == '0' or status_code == 429:
+        reset_time = parse_http_time(headers.get('X-RateLimit-Reset', ''))
+        if reset_time is not None:
+            return max(0.0, reset_time - time.time())
+    return 0.0
@@ -0,0 +1,316 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import requests
+from app_config import SAMPLED_LOG, ServerConfig, offenses_to_jira_logger
+import http_client
+from failed_offenses_store import FailedOffensesStore, init_failed_offenses_store
+from jira_bulk import JIRA_BULK_MAX_ISSUES, get_jira_bulk_url, parse_jira_bulk_response
+from jira_circuit_breaker import JiraCircuitOpenError
+from offense_coalescing import get_group_lock, get_open_group_jira_key
+from offense_issue_index import OffenseIssueIndex, init_offense_issue_index
+import metrics
+
+SPOOLED_ISSUE = {"key": None, "spooled": True} #Upload outcome of an offense whose JIRA issue was spooled instead of created. Must not be modified
+DRAIN_IDLE_SECONDS = 5 #Max time the drainer sleeps while the spool is empty. It is woken up as soon as an issue is spooled
+DRAIN_RETRY_SECONDS = 1 #Pause of the drainer after a drain round that could not create any spooled issue
+
+class JiraSpool:
+    '''SQLite backed spool of the rendered JIRA issues of the offenses processed while the JIRA circuit breaker is open. The issues are stored as zlib compressed compact JSON,
+    keyed by offense ID, and are created on JIRA by the spool drainer once JIRA is available again. Groups of correlated offenses are spooled on their own table, keyed by their first offense ID. The spool can be shared by every thread of the app: all the calls are serialized with a lock over a single connection.'''
+
+    def __init__(self, db_file:str):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.new_issue_event = threading.Event() #Set every time an issue is spooled, so the drainer wakes up right away
+        self.connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS jira_spool (
+                offense_id INTEGER PRIMARY KEY,
+                issue_data BLOB NOT NULL,
+                spooled_time REAL NOT NULL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS jira_spool_groups (
+                offense_id INTEGER PRIMARY KEY,
+                group_data BLOB NOT NULL,
+                offenses_count INTEGER NOT NULL,
+                spooled_time REAL NOT NULL)''')
+
+    def add_many(self, issues:Dict[int,Dict[any,any]]) -> None:
+        '''Spools the rendered JIRA issues of several offenses in a single transaction. An offense already on the spool gets its issue replaced.
+
+        :param Dict[int,Dict[any,any]] issues: Dictionary with the offense ID as key and the JIRA issue creation body as value.
+        :return: None
+        :rtype: None
+        '''
+        now = time.time()
+        rows = [(offense_id, zlib.compress(json.dumps(issue_data, separators=(',', ':')).encode('utf-8')), now) for offense_id, issue_data in issues.items()]
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("INSERT OR REPLACE INTO jira_spool (offense_id, issue_data, spooled_time) VALUES (?, ?, ?)", rows)
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        self.new_issue_event.set()
+
+    def add_group(self, group:Dict[any,any]) -> None:
+        '''Spools a group of correlated offenses with both its rendered JIRA issue and its rendered comment: the drainer comments on the issue of the current group of the coalescing key,
+        or creates the issue, depending on the group found once JIRA is available again.
+
+        :param Dict[any,any] group: The group: group_key, offense_ids (sorted), window_start_time, issue_data and comment_data.
+        :return: None
+        :rtype: None
+        '''
+        row = (group["offense_ids"][0], zlib.compress(json.dumps(group, separators=(',', ':')).encode('utf-8')), len(group["offense_ids"]), time.time())
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO jira_spool_groups (offense_id, group_data, offenses_count, spooled_time) VALUES (?, ?, ?, ?)", row)
+        self.new_issue_event.set()
+
+    def take_groups(self, limit:int) -> List[Dict[any,any]]:
+        '''Returns the spooled groups of the oldest offenses. They stay on the spool until they are removed.
+
+        :param int limit: Max number of groups to return.
+        :return: The spooled groups, sorted by their first offense ID.
+        :rtype: List[Dict[any,any]]
+        '''
+        with self.lock:
+            rows = self.connection.execute("SELECT group_data FROM jira_spool_groups ORDER BY offense_id LIMIT ?", (limit,)).fetchall()
+        return [json.loads(zlib.decompress(group_data)) for (group_data,) in rows]
+
+    def remove_group(self, offense_id:int) -> None:
+        '''Removes a spooled group.
+
+        :param int offense_id: First offense ID of the group.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute("DELETE FROM jira_spool_groups WHERE offense_id = ?", (offense_id,))
+
+    def take(self, limit:int) -> List[Tuple[int,Dict[any,any]]]:
+        '''Returns the spooled issues of the oldest offenses. They stay on the spool until they are removed.
+
+        :param int limit: Max number of issues to return.
+        :return: List of (offense ID, JIRA issue creation body), sorted by offense ID.
+        :rtype: List[Tuple[int,Dict[any,any]]]
+        '''
+        with self.lock:
+            rows = self.connection.execute("SELECT offense_id, issue_data FROM jira_spool ORDER BY offense_id LIMIT ?", (limit,)).fetchall()
+        return [(offense_id, json.loads(zlib.decompress(issue_data))) for offense_id, issue_data in rows]
+
+    def remove_many(self, offense_ids:List[int]) -> None:
+        '''Removes the spooled issues of several offenses in a single transaction.
+
+        :param List[int] offense_ids: IDs of the offenses to remove.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("DELETE FROM jira_spool WHERE offense_id = ?", [(offense_id,) for offense_id in offense_ids])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def count(self) -> int:
+        '''Returns the number of spooled offenses, alone or in a group.
+
+        :return: Number of spooled offenses.
+        :rtype: int
+        '''
+        with self.lock:
+            return self.connection.execute("SELECT (SELECT COUNT(*) FROM jira_spool) + (SELECT COALESCE(SUM(offenses_count), 0) FROM jira_spool_groups)").fetchone()[0]
+
+config: ServerConfig = None
+jira_spool: JiraSpool = None #Spool shared by every thread of the app. Created on init_jira_spool
+jira_spool_lock = threading.Lock()
+failed_offenses_store: FailedOffensesStore = None #Spooled issues rejected by JIRA are moved to the failed offenses store
+offense_issue_index: OffenseIssueIndex = None
+drain_executor: ThreadPoolExecutor = None #Worker pool creating the spooled issues in parallel once JIRA recovers
+
+def is_jira_unavailable_error(error:requests.HTTPError) -> bool:
+    '''Checks if a JIRA error means that JIRA is still unavailable (no response, throttling or 5xx response), so the spooled issues have to be kept, instead of being rejected.
+
+    :param HTTPError error: Error raised by the JIRA request.
+    :return: True if the spooled issues have to be kept on the spool.
+    :rtype: bool
+    '''
+    return error.response is None or error.response.status_code >= 500 or error.response.status_code == 429
+
+def create_spooled_issues(issues:List[Tuple[int,Dict[any,any]]]) -> Dict[int,any]:
+    '''Creates spooled JIRA issues with a single request: a bulk request if JIRA bulk creation is enabled, or a single issue creation otherwise.
+
+    :param List[Tuple[int,Dict[any,any]]] issues: List of (offense ID, JIRA issue creation body). Only one issue if JIRA bulk creation is disabled.
+    :return: Dictionary with the offense ID as key and the created issue or a JiraBulkItemError as value
+    :rtype: Dict[int,any]
+    :raises HttpError: if the whole request failed
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open
+    '''
+    if not config.jira_bulk_enabled:
+        offense_id, issue_data = issues[0]
+        response = http_client.jira_post(config.jira_url, issue_data)
+        response.raise_for_status()
+        return {offense_id: response.json()}
+    response = http_client.jira_post(get_jira_bulk_url(config), {"issueUpdates": [issue_data for _, issue_data in issues]})
+    if response.status_code != 400: #JIRA answers 400 when every issue of the bulk request was rejected, with the per-issue errors on the body
+        response.raise_for_status()
+    return parse_jira_bulk_response([{"id": offense_id} for offense_id, _ in issues], response.json())
+
+def drain_spooled_issues(issues:List[Tuple[int,Dict[any,any]]]) -> int:
+    '''Creates spooled JIRA issues and removes them from the spool. Offenses that already have an issue on the offense issue index are only removed, and issues rejected by JIRA are moved to the failed offenses store.
+    If JIRA is still unavailable (circuit breaker open, connection error, timeout, throttling or 5xx response) the issues are kept on the spool.
+
+    :param List[Tuple[int,Dict[any,any]]] issues: List of (offense ID, JIRA issue creation body), sorted by offense ID.
+    :return: Number of offenses removed from the spool.
+    :rtype: int
+    '''
+    claimed_issues = [(offense_id, issue_data) for offense_id, issue_data in issues if offense_issue_index.claim(offense_id)]
+    if not claimed_issues:
+        return 0
+    try:
+        jira_keys = offense_issue_index.get_jira_keys([offense_id for offense_id, _ in claimed_issues])
+        issues_to_create = [(offense_id, issue_data) for offense_id, issue_data in claimed_issues if offense_id not in jira_keys]
+        outcomes = {}
+        if issues_to_create:
+            try:
+                outcomes = create_spooled_issues(issues_to_create)
+            except requests.HTTPError as e:
+                if is_jira_unavailable_error(e):
+                    offenses_to_jira_logger.warning(f"JIRA is still unavailable: {str(e)}. Keeping {len(claimed_issues)} offenses on the JIRA spool.")
+                    return 0
+                outcomes = {offense_id: e for offense_id, _ in issues_to_create}
+            except (JiraCircuitOpenError, requests.RequestException) as e:
+                offenses_to_jira_logger.debug(f"JIRA is still unavailable: {str(e)}. Keeping {len(claimed_issues)} offenses on the JIRA spool.")
+                return 0
+            offense_issue_index.record_many({offense_id: issue.get('key') for offense_id, issue in outcomes.items() if not isinstance(issue, Exception)})
+        for offense_id, outcome in outcomes.items():
+            if isinstance(outcome, Exception):
+                offenses_to_jira_logger.error(f"Exception creating the spooled JIRA ticket of offense with ID: {str(offense_id)}: {str(outcome)}")
+                failed_offenses_store.add(offense_id, str(outcome))
+                metrics.spooled_offenses_drained.inc(1, "failed")
+            else:
+                offenses_to_jira_logger.info("Spooled ticket created succesfully on JIRA for offense with ID: %s", offense_id, extra=SAMPLED_LOG)
+                metrics.spooled_offenses_drained.inc(1, "created")
+        jira_spool.remove_many([offense_id for offense_id, _ in claimed_issues])
+        return len(claimed_issues)
+    finally:
+        for offense_id, _ in claimed_issues:
+            offense_issue_index.release(offense_id)
+
+def drain_spooled_group(group:Dict[any,any]) -> int:
+    '''Uploads a spooled group of correlated offenses and removes it from the spool. Holding the lock of the group, it comments on the issue of the current group of the coalescing key
+    if the offenses fall within its window, or creates the issue of the group and records it otherwise. Members that already have an issue on the offense issue index are only removed, and a group
+    rejected by JIRA is moved to the failed offenses store (every member is then retried on its own). If JIRA is still unavailable the group is kept on the spool.
+
+    :param Dict[any,any] group: The spooled group, as returned by take_groups.
+    :return: Number of offenses removed from the spool.
+    :rtype: int
+    '''
+    offense_ids = group["offense_ids"]
+    claimed_offense_ids = [offense_id for offense_id in offense_ids if offense_issue_index.claim(offense_id)]
+    try:
+        if len(claimed_offense_ids) < len(offense_ids):
+            return 0 #A member is being uploaded by another thread. The group is drained on a later round
+        jira_keys = offense_issue_index.get_jira_keys(offense_ids)
+        offense_ids_to_add = [offense_id for offense_id in offense_ids if offense_id not in jira_keys]
+        error = None
+        if offense_ids_to_add:
+            with get_group_lock(group["group_key"]):
+                jira_key = get_open_group_jira_key(offense_issue_index, group["group_key"], group["window_start_time"], config.coalescing_window)
+                try:
+                    if jira_key:
+                        http_client.jira_post(f"{config.jira_url.rstrip('/')}/{jira_key}/comment", group["comment_data"]).raise_for_status()
+                        offense_issue_index.add_group_offenses(group["group_key"], len(offense_ids_to_add))
+                    else:
+                        response = http_client.jira_post(config.jira_url, group["issue_data"])
+                        response.raise_for_status()
+                        jira_key = response.json().get('key')
+                        offense_issue_index.record_group(group["group_key"], jira_key, group["window_start_time"], len(offense_ids_to_add))
+                    offense_issue_index.record_many({offense_id: jira_key for offense_id in offense_ids_to_add})
+                except requests.HTTPError as e:
+                    if is_jira_unavailable_error(e):
+                        offenses_to_jira_logger.warning(f"JIRA is still unavailable: {str(e)}. Keeping a group of {len(offense_ids)} offenses on the JIRA spool.")
+                        return 0
+                    error = e
+                except (JiraCircuitOpenError, requests.RequestException) as e:
+                    offenses_to_jira_logger.debug(f"JIRA is still unavailable: {str(e)}. Keeping a group of {len(offense_ids)} offenses on the JIRA spool.")
+                    return 0
+        for offense_id in offense_ids_to_add:
+            if error is not None:
+                offenses_to_jira_logger.error(f"Exception uploading the spooled group of offense with ID: {str(offense_id)}: {str(error)}")
+                failed_offenses_store.add(offense_id, str(error))
+                metrics.spooled_offenses_drained.inc(1, "failed")
+            else:
+                offenses_to_jira_logger.info("Spooled group uploaded succesfully on JIRA for offense with ID: %s", offense_id, extra=SAMPLED_LOG)
+                metrics.spooled_offenses_drained.inc(1, "created")
+        jira_spool.remove_group(offense_ids[0])
+        return len(offense_ids)
+    finally:
+        for offense_id in claimed_offense_ids:
+            offense_issue_index.release(offense_id)
+
+def drain_jira_spool_round() -> int:
+    '''Creates the oldest spooled issues with one request per upload worker (bulk requests if JIRA bulk creation is enabled), leaving the pace to the JIRA rate governor.
+    Spooled groups of correlated offenses take the workers left, one request per group. While the circuit breaker is half-open, a single request is sent as the probe.
+
+    :return: Number of offenses removed from the spool.
+    :rtype: int
+    '''
+    chunk_size = min(config.jira_bulk_batch_size, JIRA_BULK_MAX_ISSUES) if config.jira_bulk_enabled else 1
+    chunks_count = config.jira_upload_workers if http_client.jira_circuit_breaker.is_closed() else 1
+    issues = jira_spool.take(chunk_size * chunks_count)
+    chunks = [issues[start:start + chunk_size] for start in range(0, len(issues), chunk_size)]
+    groups = jira_spool.take_groups(chunks_count - len(chunks)) if len(chunks) < chunks_count else []
+    drains = [drain_executor.submit(drain_spooled_issues, chunk) for chunk in chunks] + [drain_executor.submit(drain_spooled_group, group) for group in groups]
+    return sum(drain.result() for drain in drains)
+
+def drain_jira_spool_forever() -> None:
+    '''Drainer loop: waits while the spool is empty or the JIRA circuit breaker is open, and drains the spool at full speed as soon as JIRA is available again.
+
+    :return: None
+    :rtype: None
+    '''
+    circuit_breaker = http_client.jira_circuit_breaker
+    while True:
+        try:
+            jira_spool.new_issue_event.clear()
+            if jira_spool.count() == 0:
+                jira_spool.new_issue_event.wait(DRAIN_IDLE_SECONDS)
+                continue
+            seconds_until_probe = circuit_breaker.seconds_until_probe()
+            if seconds_until_probe > 0:
+                circuit_breaker.closed_event.wait(seconds_until_probe) #A probe sent by another thread can close the circuit earlier
+                continue
+            if drain_jira_spool_round() == 0:
+                time.sleep(DRAIN_RETRY_SECONDS)
+        except Exception as e:
+            offenses_to_jira_logger.error(f"Error draining the JIRA spool: {str(e)}")
+            time.sleep(DRAIN_RETRY_SECONDS)
+
+def init_jira_spool(passedconfig:ServerConfig) -> JiraSpool:
+    '''Initializates the JIRA spool shared by the app threads and starts its drainer on a daemon thread. The spool is only created once.
+
+    :param ServerConfig passedconfig: Configuration received from the config.ini file
+    :return: The shared JIRA spool.
+    :rtype: JiraSpool
+    '''
+    global config, jira_spool, failed_offenses_store, offense_issue_index, drain_executor
+    with jira_spool_lock:
+        if jira_spool is None:
+            config = passedconfig
+            failed_offenses_store = init_failed_offenses_store(config)
+            offense_issue_index = init_offense_issue_index(config)
+            drain_executor = ThreadPoolExecutor(max_workers=config.jira_upload_workers, thread_name_prefix="jira_spool_drainer")
+            jira_spool = JiraSpool(config.jira_spool_file)
+            metrics.register(metrics.Gauge("qradar2jira_jira_spooled_offenses", "Offenses whose JIRA issue is waiting on the JIRA spool.", callback=lambda: jira_spool.count()))
+            threading.Thread(target=drain_jira_spool_forever, name="jira_spool_drainer", daemon=True).start()
+        return jira_spool
@@ -0,0 +1,336 @@
+import time
+from logging import Logger
+from typing import Dict, Generator, List, Tuple
+from app_config import ServerConfig, offenses_to_jira_logger
+import http_client
+from address_resolver import LOCAL_DESTINATION_ADDRESSES, SOURCE_ADDRESSES, format_offense_ips, resolve_offenses_addresses
+from jira_bulk import get_jira_bulk_url, parse_jira_bulk_response
+from jira_circuit_breaker import JiraCircuitOpenError
+from jira_spool import SPOOLED_ISSUE, JiraSpool
+from offense_coalescing import get_open_group_jira_key
+from offense_issue_index import OffenseAlreadyClaimedError, OffenseIssueIndex, init_offense_issue_index
+
+#The uploads are written once as generators of the QRADAR and JIRA requests they need, so the threads and the asyncio runtime share the same upload logic and only perform the requests
+#with their own HTTP client. Every request is a tuple whose first item is its type:
+RESOLVE_ADDRESSES = "resolve_addresses" #(RESOLVE_ADDRESSES, offenses): resolve the source and local destination IPs of the offenses. Sent back: resolve_offenses_addresses result
+JIRA_POST = "jira_post" #(JIRA_POST, url, body, accepted error status): POST to the JIRA API. Sent back: the JSON body of the response
+
+UploadSteps = Generator[Tuple, any, any]
+
+config: ServerConfig = None
+offense_issue_index: OffenseIssueIndex = None #Offense to JIRA issue index shared by every upload. Created on init_jira_uploads
+
+def build_jira_issue_data(offense:Dict[any,any], ips:Dict[str,Dict[int,str]]) -> Dict[any,any]:
+    """Builds the body of the JIRA issue creation request for the given offense.
+
+    :param Dict[any,any] offense: The offense obtained from QRADAR SIEM
+    :param Dict[str,Dict[int,str]] ips: Resolved source and local destination IPs of the offense, as returned by resolve_offenses_addresses
+    :return: The JIRA issue fields for the offense
+    :rtype: Dict[any,any]"""
+    return {
+        "fields": {
+            "project": {
+                "key": config.jira_project_key
+            },
+            "summary": f"QRadar Offense {offense['id']}: {offense['description']}",
+            "description": (
+                f"Offense ID: {offense['id']}\n"
+                f"Offense Description: {offense['description']}\n"
+                f"Offense Type: {offense['offense_type']}\n"
+                f"Source IPs: {format_offense_ips(offense, ips, SOURCE_ADDRESSES)}\n"
+                f"Destination IPs: {format_offense_ips(offense, ips, LOCAL_DESTINATION_ADDRESSES)}\n"
+                f"Start Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(offense['start_time'] / 1000))}\n"
+                f"Last Updated: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(offense['last_updated_time'] / 1000))}\n"
+            ),
+            "issuetype": {
+                "name": "Task"
+            }
+        }
+    }
+
+
+
+def build_jira_group_issue_data(group_key:str, offenses:List[Dict[any,any]], ips:Dict[str,Dict[int,str]]) -> Dict[any,any]:
+    """Builds the body of the JIRA issue creation request for a new group of correlated offenses: the ticket of its first offense, plus the coalescing key and the member offense IDs.
+
+    :param str group_key: The coalescing key of the group
+    :param List[Dict[any,any]] offenses: The offenses of the group obtained from QRADAR SIEM, sorted by ID
+    :param Dict[str,Dict[int,str]] ips: Resolved source and local destination IPs of the offenses, as returned by resolve_offenses_addresses
+    :return: The JIRA issue fields for the group
+    :rtype: Dict[any,any]"""
+    issue_data = build_jira_issue_data(offenses[0], ips)
+    if len(offenses) > 1:
+        issue_data["fields"]["summary"] = f"QRadar Offense {offenses[0]['id']} and {len(offenses) - 1} correlated offenses: {offenses[0]['description']}"
+    issue_data["fields"]["description"] += (
+        f"Coalescing group: {group_key}\n"
+        f"Member offense IDs: {', '.join(str(offense['id']) for offense in offenses)}\n"
+    )
+    return issue_data
+
+
+
+def build_jira_group_comment(offenses:List[Dict[any,any]], ips:Dict[str,Dict[int,str]]) -> Dict[any,any]:
+    """Builds the body of the JIRA comment listing the offenses added to an existing group (Atlassian Document Format, as required by the JIRA API v3).
+
+    :param List[Dict[any,any]] offenses: The offenses added to the group, sorted by ID
+    :param Dict[str,Dict[int,str]] ips: Resolved source and local destination IPs of the offenses, as returned by resolve_offenses_addresses
+    :return: Body of the JIRA comment creation request
+    :rtype: Dict[any,any]"""
+    text = f"{len(offenses)} correlated QRadar offenses joined this group. Member offense IDs: {', '.join(str(offense['id']) for offense in offenses)}\n"
+    for offense in offenses:
+        text += (
+            f"Offense {offense['id']}: {offense['description']} "
+            f"(Source IPs: {format_offense_ips(offense, ips, SOURCE_ADDRESSES)}, "
+            f"Destination IPs: {format_offense_ips(offense, ips, LOCAL_DESTINATION_ADDRESSES)}, "
+            f"Start Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(offense['start_time'] / 1000))})\n"
+        )
+    return {"body": {"type": "doc", "version": 1, "content": [{"type": "paragraph", "content": [{"type": "text", "text": text}]}]}}
+
+
+
+def get_jira_comment_url(jira_key:str) -> str:
+    """Returns the URL of the comments of a JIRA issue, derived from the configured JIRA issue URL.
+
+    :param str jira_key: Key of the JIRA issue
+    :return: URL of the comments endpoint of the issue
+    :rtype: str"""
+    return f"{config.jira_url.rstrip('/')}/{jira_key}/comment"
+
+
+
+def spool_jira_tickets(spool:JiraSpool, offenses:List[Dict[any,any]], ips:Dict[str,Dict[int,str]]) -> Dict[int,any]:
+    """Stores the rendered JIRA issues of offenses on the JIRA spool, to be created by the spool drainer once JIRA is available again.
+
+    :param JiraSpool spool: The JIRA spool
+    :param List[Dict[any,any]] offenses: The offenses obtained from QRADAR SIEM
+    :param Dict[str,Dict[int,str]] ips: Resolved source and local destination IPs of the offenses, as returned by resolve_offenses_addresses
+    :return: Dictionary with the offense ID as key and SPOOLED_ISSUE as value
+    :rtype: Dict[int,any]
+    :raises sqlite3.Error: if an error occurs when inserting the issues on the spool"""
+    spool.add_many({offense.get('id'): build_jira_issue_data(offense, ips) for offense in offenses})
+    return {offense.get('id'): SPOOLED_ISSUE for offense in offenses}
+
+
+
+def spool_jira_group(spool:JiraSpool, group_key:str, offenses:List[Dict[any,any]], ips:Dict[str,Dict[int,str]]) -> Dict[int,any]:
+    """Stores the rendered JIRA issue and comment of a group of correlated offenses on the JIRA spool. Once JIRA is available again, the spool drainer comments on the issue of the current group
+    of the coalescing key if the offenses fall within its window, or creates the issue of the group otherwise.
+
+    :param JiraSpool spool: The JIRA spool
+    :param str group_key: The coalescing key of the group
+    :param List[Dict[any,any]] offenses: The offenses of the group obtained from QRADAR SIEM, sorted by ID
+    :param Dict[str,Dict[int,str]] ips: Resolved source and local destination IPs of the offenses, as returned by resolve_offenses_addresses
+    :return: Dictionary with the offense ID as key and SPOOLED_ISSUE as value
+    :rtype: Dict[int,any]
+    :raises sqlite3.Error: if an error occurs when inserting the group on the spool"""
+    spool.add_group({
+        "group_key": group_key,
+        "offense_ids": [offense.get('id') for offense in offenses],
+        "window_start_time": offenses[0].get('start_time', 0),
+        "issue_data": build_jira_group_issue_data(group_key, offenses, ips),
+        "comment_data": build_jira_group_comment(offenses, ips)
+    })
+    return {offense.get('id'): SPOOLED_ISSUE for offense in offenses}
+
+
+
+def claim_offenses(offenses:List[Dict[any,any]], logger:Logger) -> Tuple[List[Dict[any,any]],List[Dict[any,any]],Dict[int,any]]:
+    """Claims offenses on the offense issue index for an upload, and looks up the ones that already have an issue.
+
+    :param List[Dict[any,any]] offenses: The offenses obtained from QRADAR SIEM
+    :param Logger logger: Logger of the upload
+    :return: (claimed offenses, to release once the upload ends; claimed offenses without an issue, to upload; outcome of the rest of the offenses: their existing issue or OffenseAlreadyClaimedError)
+    :rtype: Tuple[List[Dict[any,any]],List[Dict[any,any]],Dict[int,any]]
+    :raises sqlite3.Error: if an error occurs when reading the index"""
+    outcomes = {}
+    claimed_offenses = []
+    for offense in offenses:
+        if offense_issue_index.claim(offense.get('id')):
+            claimed_offenses.append(offense)
+        else:
+            outcomes[offense.get('id')] = OffenseAlreadyClaimedError(offense.get('id'))
+    try:
+        jira_keys = offense_issue_index.get_jira_keys([offense.get('id') for offense in claimed_offenses])
+    except Exception:
+        release_offenses(claimed_offenses)
+        raise
+    for offense_id, jira_key in jira_keys.items():
+        logger.warning(f"Offense {offense_id} already has the JIRA issue {jira_key}. Skipping the ticket creation.")
+        outcomes[offense_id] = {"key": jira_key}
+    return claimed_offenses, [offense for offense in claimed_offenses if offense.get('id') not in jira_keys], outcomes
+
+
+
+def release_offenses(offenses:List[Dict[any,any]]) -> None:
+    """Releases the claims of the offenses of an upload on the offense issue index.
+
+    :param List[Dict[any,any]] offenses: The claimed offenses
+    :return: Nothing.
+    :rtype: None"""
+    for offense in offenses:
+        offense_issue_index.release(offense.get('id'))
+
+
+
+def upload_offenses_steps(offenses:List[Dict[any,any]], bulk:bool = False, spool:JiraSpool = None, logger:Logger = offenses_to_jira_logger) -> UploadSteps:
+    """Creates the JIRA tickets of offenses unless the offense issue index already has an issue for them, and records the created issues on the index.
+    While the JIRA circuit breaker is open, the rendered issues are spooled instead if a spool is given.
+
+    :param List[Dict[any,any]] offenses: The offenses obtained from QRADAR SIEM. A single offense unless bulk is set (50 at most)
+    :param bool bulk: If true, the tickets are created with a single request to the JIRA bulk creation endpoint
+    :param JiraSpool spool: The JIRA spool, or None to raise JiraCircuitOpenError instead of spooling
+    :param Logger logger: Logger of the upload
+    :return: Generator of the upload requests, returning a dictionary with the offense ID as key and the created (or already existing) issue, SPOOLED_ISSUE or the exception of the offense, as value
+    :rtype: UploadSteps
+    :raises HttpError,ClientResponseError: if the whole creation request failed
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open and no spool is given"""
+    claimed_offenses, offenses_to_create, outcomes = claim_offenses(offenses, logger)
+    try:
+        if offenses_to_create:
+            ips = yield (RESOLVE_ADDRESSES, offenses_to_create)
+            try:
+                if bulk:
+                    #JIRA answers 400 when every issue of the bulk request was rejected, with the per-issue errors on the body
+                    response_body = yield (JIRA_POST, get_jira_bulk_url(config), {"issueUpdates": [build_jira_issue_data(offense, ips) for offense in offenses_to_create]}, 400)
+                    created_issues = parse_jira_bulk_response(offenses_to_create, response_body)
+                else:
+                    offense = offenses_to_create[0]
+                    created_issues = {offense.get('id'): (yield (JIRA_POST, config.jira_url, build_jira_issue_data(offense, ips), None))}
+            except JiraCircuitOpenError:
+                if spool is None:
+                    raise
+                outcomes.update(spool_jira_tickets(spool, offenses_to_create, ips))
+                return outcomes
+            offense_issue_index.record_many({offense_id: issue.get('key') for offense_id, issue in created_issues.items() if not isinstance(issue, Exception)})
+            outcomes.update(created_issues)
+        return outcomes
+    finally:
+        release_offenses(claimed_offenses)
+
+
+
+def upload_offense_steps(offense:Dict[any,any], spool:JiraSpool = None, logger:Logger = offenses_to_jira_logger) -> UploadSteps:
+    """Creates the JIRA ticket of an offense unless the offense issue index already has an issue for it, and records the created issue on the index.
+    While the JIRA circuit breaker is open, the rendered issue is spooled instead if a spool is given.
+
+    :param Dict[any,any] offense: The offense obtained from QRADAR SIEM
+    :param JiraSpool spool: The JIRA spool, or None to raise JiraCircuitOpenError instead of spooling
+    :param Logger logger: Logger of the upload
+    :return: Generator of the upload requests, returning the created (or already existing) JIRA issue, or SPOOLED_ISSUE
+    :rtype: UploadSteps
+    :raises OffenseAlreadyClaimedError: if the offense is being uploaded by another thread
+    :raises HttpError,ClientResponseError: if an error occurred making the HTTP request
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open and no spool is given"""
+    outcome = (yield from upload_offenses_steps([offense], False, spool, logger))[offense.get('id')]
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome
+
+
+
+def upload_offense_group_steps(group_key:str, offenses:List[Dict[any,any]], spool:JiraSpool = None, logger:Logger = offenses_to_jira_logger) -> UploadSteps:
+    """Uploads a group of correlated offenses with a single JIRA call: a comment on the issue of the current group of the coalescing key if the offenses fall within its window,
+    or a new issue for the group otherwise. Offenses that already have an issue on the offense issue index are skipped, and every member is recorded on the index with the issue of the group.
+    While the JIRA circuit breaker is open, the rendered group is spooled instead if a spool is given.
+    The caller must hold the lock of the group for the whole upload, so the group is never created twice nor recorded out of order.
+
+    :param str group_key: The coalescing key of the group
+    :param List[Dict[any,any]] offenses: The offenses of the group obtained from QRADAR SIEM, sorted by ID
+    :param JiraSpool spool: The JIRA spool, or None to raise JiraCircuitOpenError instead of spooling
+    :param Logger logger: Logger of the upload
+    :return: Generator of the upload requests, returning a dictionary with the offense ID as key and the issue of its group, SPOOLED_ISSUE or the exception of the offense, as value
+    :rtype: UploadSteps
+    :raises HttpError,ClientResponseError: if an error occurred making the HTTP request
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open and no spool is given"""
+    claimed_offenses, offenses_to_add, outcomes = claim_offenses(offenses, logger)
+    try:
+        if offenses_to_add:
+            ips = yield (RESOLVE_ADDRESSES, offenses_to_add)
+            jira_key = get_open_group_jira_key(offense_issue_index, group_key, offenses_to_add[0].get('start_time', 0), config.coalescing_window)
+            group_open = jira_key is not None
+            try:
+                if group_open:
+                    yield (JIRA_POST, get_jira_comment_url(jira_key), build_jira_group_comment(offenses_to_add, ips), None)
+                else:
+                    jira_key = (yield (JIRA_POST, config.jira_url, build_jira_group_issue_data(group_key, offenses_to_add, ips), None)).get('key')
+            except JiraCircuitOpenError:
+                if spool is None:
+                    raise
+                outcomes.update(spool_jira_group(spool, group_key, offenses_to_add, ips))
+                return outcomes
+            if group_open:
+                offense_issue_index.add_group_offenses(group_key, len(offenses_to_add))
+            else:
+                offense_issue_index.record_group(group_key, jira_key, offenses_to_add[0].get('start_time', 0), len(offenses_to_add))
+            offense_issue_index.record_many({offense.get('id'): jira_key for offense in offenses_to_add})
+            outcomes.update({offense.get('id'): {"key": jira_key} for offense in offenses_to_add})
+        return outcomes
+    finally:
+        release_offenses(claimed_offenses)
+
+
+
+def advance_upload_steps(steps:UploadSteps, result:any = None, error:Exception = None) -> Tuple[bool,any]:
+    """Runs an upload until its next request, sending it the result (or raising the error) of the previous one.
+
+    :param UploadSteps steps: The upload
+    :param any result: Result of the previous request of the upload
+    :param Exception error: Error raised by the previous request of the upload, if it failed
+    :return: (True, outcome of the upload) once the upload is done, or (False, next request of the upload)
+    :rtype: Tuple[bool,any]
+    :raises Exception: the error of the upload, if it failed"""
+    try:
+        return False, (steps.throw(error) if error is not None else steps.send(result))
+    except StopIteration as stop:
+        return True, stop.value
+
+
+
+def perform_upload_request(request:Tuple) -> any:
+    """Performs a request of an upload with the HTTP clients of the threads.
+
+    :param Tuple request: The request, RESOLVE_ADDRESSES or JIRA_POST
+    :return: The result of the request
+    :rtype: any
+    :raises HttpError: if an error occurred making the HTTP request
+    :raises JiraCircuitOpenError: if the JIRA circuit breaker is open"""
+    if request[0] == RESOLVE_ADDRESSES:
+        return resolve_offenses_addresses(request[1])
+    _, url, body, accepted_error_status = request
+    response = http_client.jira_post(url, body)
+    if response.status_code != accepted_error_status:
+        response.raise_for_status()
+    return response.json()
+
+
+
+def run_upload_steps(steps:UploadSteps) -> any:
+    """Runs an upload on the calling thread.
+
+    :param UploadSteps steps: The upload
+    :return: The outcome of the upload
+    :rtype: any
+    :raises Exception: the error of the upload, if it failed"""
+    result, error = None, None
+    while True:
+        done, value = advance_upload_steps(steps, result, error)
+        if done:
+            return value
+        result, error = None, None
+        try:
+            result = perform_upload_request(value)
+        except Exception as e:
+            error = e
+
+
+
+def init_jira_uploads(passedconfig:ServerConfig) -> None:
+    '''Initializates the shared upload logic. The HTTP clients and the address resolver must be initializated too.
+
+    :param ServerConfig passedconfig: Configuration received from the config.ini file
+    :return: None
+    :rtype: None
+    '''
+    global config, offense_issue_index
+    config = passedconfig
+    offense_issue_index = init_offense_issue_index(config)
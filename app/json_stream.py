@@ -0,0 +1,81 @@
+import codecs
+import json
+from typing import Dict, Iterator, List
+import requests
+
+JSON_STREAM_CHUNK_SIZE = 64 * 1024 #Bytes read from the response on every iteration when parsing a JSON array incrementally
+
+class JsonArrayStreamParser:
+    '''Incremental parser of a JSON array of objects. The text of the array is fed in chunks and every complete item is returned as soon as it is parsed, so only the item being parsed is kept as raw text.'''
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+
+    def _skip_separators(self, position:int) -> int:
+        while position < len(self.buffer) and (self.buffer[position].isspace() or (self.started and self.buffer[position] == ',')):
+            position += 1
+        return position
+
+    def feed(self, text:str) -> List[Dict[any,any]]:
+        '''Adds a chunk of text of the JSON array and parses the items completed with it.
+
+        :param str text: Next chunk of the JSON array text.
+        :return: The items completed with the chunk, in order.
+        :rtype: List[Dict[any,any]]
+        :raises ValueError: if the text is not a JSON array
+        '''
+        items = []
+        self.buffer += text
+        position = 0
+        while not self.finished:
+            position = self._skip_separators(position)
+            if position >= len(self.buffer):
+                break
+            if not self.started:
+                if self.buffer[position] != '[':
+                    raise ValueError(f"Expected a JSON array, found: {self.buffer[position:position + 20]!r}")
+                self.started = True
+                position += 1
+                continue
+            if self.buffer[position] == ']':
+                self.finished = True
+                position += 1
+                break
+            try:
+                item, position = self.decoder.raw_decode(self.buffer, position)
+            except json.JSONDecodeError:
+                break #The item is not complete yet. It is parsed again once the next chunk arrives
+            items.append(item)
+        self.buffer = self.buffer[position:]
+        return items
+
+    def close(self) -> None:
+        '''Checks that the whole JSON array was fed.
+
+        :return: None
+        :rtype: None
+        :raises ValueError: if the JSON array is truncated or malformed
+        '''
+        if not self.finished or self.buffer.strip():
+            raise ValueError(f"Truncated or malformed JSON array. Unparsed text: {self.buffer[:100]!r}")
+
+def iter_json_array(response:requests.Response) -> Iterator[Dict[any,any]]:
+    '''Parses the JSON array of a streamed response incrementally, yielding one item at a time instead of building the whole list. The response is closed once the array is consumed.
+
+    :param Response response: Response of a request made with stream=True.
+    :return: Iterator over the items of the array.
+    :rtype: Iterator[Dict[any,any]]
+    :raises ValueError: if the response body is not a valid JSON array
+    '''
+    parser = JsonArrayStreamParser()
+    text_decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    try:
+        for chunk in response.iter_content(chunk_size=JSON_STREAM_CHUNK_SIZE):
+            yield from parser.feed(text_decoder.decode(chunk))
+        yield from parser.feed(text_decoder.decode(b'', final=True))
+        parser.close()
+    finally:
+        response.close()
@@ -0,0 +1,208 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+from app_config import ServerConfig, app_bootstrap_logger
+
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) #Upper bounds in seconds of the latency histograms buckets
+HEARTBEAT_INTERVAL_SECONDS = 15 #Max time an idle thread or coroutine waits without recording a heartbeat
+
+def format_labels(label_names:Tuple[str,...], label_values:Tuple[str,...], extra:str = "") -> str:
+    '''Formats the labels of a sample in the Prometheus text format ({name="value",...}).
+
+    :param Tuple[str,...] label_names: Names of the labels of the metric.
+    :param Tuple[str,...] label_values: Values of the labels of the sample.
+    :param str extra: Already formatted label added at the end (for example, the le label of a histogram bucket).
+    :return: The formatted labels, or an empty string if there are none.
+    :rtype: str
+    '''
+    labels = [f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+class Metric:
+    '''Base class of the metrics exposed on the metrics endpoint. Recording a value only takes an uncontended lock and a dictionary update, so it can be done on the hot path.'''
+
+    metric_type = "untyped"
+
+    def __init__(self, name:str, description:str, label_names:Tuple[str,...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values: Dict[Tuple[str,...],float] = {}
+        self.lock = threading.Lock()
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{format_labels(self.label_names, label_values)} {value}" for label_values, value in self.values.items()]
+
+    def render(self) -> str:
+        '''Renders the metric in the Prometheus text format.
+
+        :return: HELP and TYPE lines followed by the samples of the metric.
+        :rtype: str
+        '''
+        return "\n".join([f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"] + self.samples())
+
+class Counter(Metric):
+    '''Monotonic counter.'''
+
+    metric_type = "counter"
+
+    def inc(self, amount:float = 1, *label_values:str) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    '''Value that can go up and down. If a callback is given, it is called on every scrape to get the current values instead.'''
+
+    metric_type = "gauge"
+
+    def __init__(self, name:str, description:str, label_names:Tuple[str,...] = (), callback:Callable[[],any] = None):
+        super().__init__(name, description, label_names)
+        self.callback = callback
+
+    def set(self, value:float, *label_values:str) -> None:
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self) -> List[str]:
+        if self.callback is None:
+            return super().samples()
+        try:
+            values = self.callback()
+        except Exception as e:
+            app_bootstrap_logger.warning(f"Error computing the metric {self.name}: {str(e)}")
+            return []
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{format_labels(self.label_names, label_values)} {value}" for label_values, value in values.items() if value is not None]
+
+class Histogram(Metric):
+    '''Distribution of observed values (latencies) in cumulative buckets, with their sum and count.'''
+
+    metric_type = "histogram"
+
+    def __init__(self, name:str, description:str, label_names:Tuple[str,...] = (), buckets:Tuple[float,...] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = buckets
+        self.histograms: Dict[Tuple[str,...],List[float]] = {} #Per labels: non cumulative count of every bucket plus the +Inf one, followed by the sum
+
+    def observe(self, value:float, *label_values:str) -> None:
+        with self.lock:
+            histogram = self.histograms.get(label_values)
+            if histogram is None:
+                histogram = self.histograms[label_values] = [0] * (len(self.buckets) + 2)
+            histogram[bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            histograms = {label_values: list(histogram) for label_values, histogram in self.histograms.items()}
+        for label_values, histogram in histograms.items():
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(list(self.buckets) + ["+Inf"], histogram[:-1]):
+                cumulative_count += bucket_count
+                bucket_label = 'le="' + str(upper_bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, label_values, bucket_label)} {cumulative_count}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, label_values)} {histogram[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, label_values)} {cumulative_count}")
+        return lines
+
+registry: Dict[str,Metric] = {} #Every metric exposed on the metrics endpoint, by name
+registry_lock = threading.Lock()
+
+def register(metric:Metric) -> Metric:
+    '''Adds a metric to the metrics endpoint. A metric registered again with the same name replaces the previous one.
+
+    :param Metric metric: The metric to expose.
+    :return: The registered metric.
+    :rtype: Metric
+    '''
+    with registry_lock:
+        registry[metric.name] = metric
+    return metric
+
+def render_metrics() -> str:
+    '''Renders every registered metric in the Prometheus text format.
+
+    :return: Body of the metrics endpoint response.
+    :rtype: str
+    '''
+    with registry_lock:
+        metrics = list(registry.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+qradar_poll_duration = register(Histogram("qradar2jira_qradar_poll_duration_seconds", "Time taken by the QRADAR calls polling new offenses."))
+jira_request_duration = register(Histogram("qradar2jira_jira_request_duration_seconds", "Time taken by the JIRA calls, by JIRA response status.", ("status",)))
+offenses_processed = register(Counter("qradar2jira_offenses_processed_total", "New offenses processed, by outcome (created, spooled or failed). Use rate() to get the offenses processed per second.", ("outcome",)))
+spooled_offenses_drained = register(Counter("qradar2jira_jira_spool_drained_total", "Offenses drained from the JIRA spool once JIRA recovered, by outcome (created or failed).", ("outcome",)))
+new_offenses_probes = register(Counter("qradar2jira_qradar_probes_total", "Cheap QRADAR probes for new offenses sent by the adaptive polling scheduler while idle, by result (new_offenses or empty).", ("result",)))
+offense_updates_pushed = register(Counter("qradar2jira_offense_updates_pushed_total", "Offense updates pushed to JIRA, by outcome (pushed, failed or dead_letter).", ("outcome",)))
+retry_attempts = register(Counter("qradar2jira_retry_attempts_total", "Retries of failed offenses, by outcome (created, failed or dead_letter).", ("outcome",)))
+heartbeats: Dict[str,float] = {} #Epoch time of the last heartbeat of every long-lived thread and coroutine of the app
+
+def heartbeat(name:str) -> None:
+    '''Records that a long-lived thread or coroutine of the app is alive. It is recorded on every loop and at least every HEARTBEAT_INTERVAL_SECONDS while waiting, so only a stuck loop gets old.
+
+    :param str name: Name of the thread or coroutine.
+    :return: None
+    :rtype: None
+    '''
+    heartbeats[name] = time.time()
+
+def sleep_with_heartbeat(name:str, seconds:float) -> None:
+    '''Sleeps the given time, recording a heartbeat at least every HEARTBEAT_INTERVAL_SECONDS.
+
+    :param str name: Name of the sleeping thread.
+    :param float seconds: Time to sleep in seconds.
+    :return: None
+    :rtype: None
+    '''
+    deadline = time.time() + seconds
+    while True:
+        heartbeat(name)
+        remaining_seconds = deadline - time.time()
+        if remaining_seconds <= 0:
+            return
+        time.sleep(min(remaining_seconds, HEARTBEAT_INTERVAL_SECONDS))
+
+register(Gauge("qradar2jira_heartbeat_age_seconds", "Seconds since the last heartbeat of every long-lived thread and coroutine of the app. Idle ones record a heartbeat at least every 15 seconds.", ("thread",),
+               callback=lambda: {(name,): round(time.time() - last_heartbeat, 3) for name, last_heartbeat in list(heartbeats.items())}))
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    '''Serves the registered metrics on /metrics.'''
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass #Scrapes are not logged
+
+def start_metrics_server(config:ServerConfig) -> ThreadingHTTPServer:
+    '''Starts the metrics endpoint on a daemon thread, if enabled on the config.ini file.
+
+    :param ServerConfig config: Configuration received from the config.ini file
+    :return: The started server, or None if the metrics endpoint is disabled.
+    :rtype: ThreadingHTTPServer
+    '''
+    if not config.metrics_enabled:
+        return None
+    server = ThreadingHTTPServer((config.metrics_host, config.metrics_port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics_server", daemon=True).start()
+    app_bootstrap_logger.info(f"Metrics endpoint listening on http://{config.metrics_host}:{config.metrics_port}/metrics")
+    return server
@@ -0,0 +1,90 @@
+import threading
+from typing import Dict, List, Tuple
+from app_config import ServerConfig
+from http_client import QRADAR_OFFENSE_FIELDS
+from offense_issue_index import OffenseIssueIndex
+
+GROUP_LOCKS_COUNT = 64 #Number of locks the coalescing groups are spread over. Uploads of the same group are serialized, so a group never gets two JIRA issues
+
+group_locks = [threading.Lock() for _ in range(GROUP_LOCKS_COUNT)]
+
+def get_coalescing_key_fields(config:ServerConfig) -> List[str]:
+    '''Returns the offense fields correlated offenses are grouped by.
+
+    :param ServerConfig config: Configuration received from the config.ini file
+    :return: Names of the offense fields of the coalescing key.
+    :rtype: List[str]
+    '''
+    return [field.strip() for field in config.coalescing_key_fields.split(',') if field.strip()]
+
+def get_offense_fields(config:ServerConfig) -> str:
+    '''Returns the fields projection of the new offenses requested to QRADAR: the fields used by the JIRA tickets plus, if coalescing is enabled, the fields of the coalescing key.
+
+    :param ServerConfig config: Configuration received from the config.ini file
+    :return: Comma separated offense fields.
+    :rtype: str
+    '''
+    fields = QRADAR_OFFENSE_FIELDS.split(',')
+    if config.coalescing_enabled:
+        fields += [field for field in get_coalescing_key_fields(config) if field not in fields]
+    return ','.join(fields)
+
+def get_coalescing_key(offense:Dict[any,any], key_fields:List[str]) -> str:
+    '''Builds the coalescing key of an offense from the values of the key fields (for example: offense_type=3|offense_source=10.0.0.1). List values (destination_networks) are sorted.
+
+    :param Dict[any,any] offense: The offense obtained from QRADAR SIEM
+    :param List[str] key_fields: Names of the offense fields of the coalescing key.
+    :return: The coalescing key of the offense.
+    :rtype: str
+    '''
+    key_values = []
+    for field in key_fields:
+        value = offense.get(field)
+        if isinstance(value, list):
+            value = ','.join(sorted(str(item) for item in value))
+        key_values.append(f"{field}={value}")
+    return '|'.join(key_values)
+
+def group_offenses(offenses:List[Dict[any,any]], key_fields:List[str], window_seconds:int) -> List[Tuple[str,List[Dict[any,any]]]]:
+    '''Groups offenses with the same coalescing key whose start_time is within the coalescing window of the first offense of the group.
+
+    :param List[Dict[any,any]] offenses: Offenses obtained from QRADAR SIEM, sorted by ID.
+    :param List[str] key_fields: Names of the offense fields of the coalescing key.
+    :param int window_seconds: Max seconds between the start_time of the first offense of a group and the rest of its offenses.
+    :return: List of (coalescing key, offenses of the group sorted by ID), in the order the groups were started.
+    :rtype: List[Tuple[str,List[Dict[any,any]]]]
+    '''
+    groups: List[Tuple[str,List[Dict[any,any]]]] = []
+    open_groups: Dict[str,Tuple[str,List[Dict[any,any]]]] = {}
+    for offense in offenses:
+        group_key = get_coalescing_key(offense, key_fields)
+        group = open_groups.get(group_key)
+        if group is None or abs(offense.get('start_time', 0) - group[1][0].get('start_time', 0)) >= window_seconds * 1000:
+            group = open_groups[group_key] = (group_key, [])
+            groups.append(group)
+        group[1].append(offense)
+    return groups
+
+def get_open_group_jira_key(offense_issue_index:OffenseIssueIndex, group_key:str, offense_time:int, window_seconds:int) -> str:
+    '''Returns the JIRA issue of the current group of a coalescing key, if an offense started at the given time falls within its window.
+
+    :param OffenseIssueIndex offense_issue_index: Index holding the group of every coalescing key.
+    :param str group_key: The coalescing key.
+    :param int offense_time: start_time of the offense in milliseconds.
+    :param int window_seconds: Max seconds between the start_time of the first offense of a group and the rest of its offenses.
+    :return: Key of the JIRA issue of the group, or None if a new group has to be created.
+    :rtype: str
+    '''
+    group = offense_issue_index.get_group(group_key)
+    if group is None or abs(offense_time - group[1]) >= window_seconds * 1000:
+        return None
+    return group[0]
+
+def get_group_lock(group_key:str) -> threading.Lock:
+    '''Returns the lock serializing the uploads of a coalescing group.
+
+    :param str group_key: The coalescing key of the group.
+    :return: The lock of the group.
+    :rtype: Lock
+    '''
+    return group_locks[hash(group_key) % GROUP_LOCKS_COUNT]
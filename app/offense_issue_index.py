@@ -0,0 +1,262 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Tuple
+from app_config import ServerConfig
+
+class OffenseIssueIndex:
+    '''Persistent index of the JIRA issue created for every offense, stored on an SQLite table with the offense ID as primary key and fronted by an in-memory LRU cache.
+    It is checked before posting an offense to JIRA, so crash recoveries, replays and retries never create a duplicated ticket.
+    It also keeps the offenses being uploaded right now (claims), so two threads never post the same offense at the same time, when the updates of every offense were last pushed to its JIRA issue,
+    the offense updates that could not be pushed (dead letters), and the JIRA issue of the current group of every offense coalescing key.'''
+
+    def __init__(self, db_file:str, cache_size:int, read_only:bool = False):
+        self.db_file = db_file
+        self.cache_size = cache_size
+        self.cache: OrderedDict = OrderedDict() #LRU cache of offense ID -> JIRA issue key. Only offenses with an issue are cached
+        self.claimed_offense_ids = set()
+        self.lock = threading.Lock()
+        if read_only: #Only for lookups (backfill dry runs): the database file must exist and is never created nor written
+            self.connection = sqlite3.connect(Path(db_file).absolute().as_uri() + "?mode=ro", uri=True, check_same_thread=False, isolation_level=None)
+            return
+        self.connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS offense_jira_issues (
+                offense_id INTEGER PRIMARY KEY,
+                jira_key TEXT NOT NULL,
+                created_time REAL NOT NULL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS offense_update_syncs (
+                offense_id INTEGER PRIMARY KEY,
+                last_synced_time REAL NOT NULL,
+                last_synced_updated_time INTEGER NOT NULL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS offense_update_dead_letters (
+                offense_id INTEGER PRIMARY KEY,
+                jira_key TEXT NOT NULL,
+                last_updated_time INTEGER NOT NULL,
+                last_error TEXT,
+                dead_letter_time REAL NOT NULL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS offense_groups (
+                group_key TEXT PRIMARY KEY,
+                jira_key TEXT NOT NULL,
+                window_start_time INTEGER NOT NULL,
+                offenses_count INTEGER NOT NULL)''')
+
+    def _cache_put(self, offense_id:int, jira_key:str) -> None:
+        self.cache[offense_id] = jira_key
+        self.cache.move_to_end(offense_id)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get_jira_key(self, offense_id:int) -> str:
+        '''Returns the key of the JIRA issue created for an offense.
+
+        :param int offense_id: ID of the offense.
+        :return: The JIRA issue key, or None if no issue was created for the offense.
+        :rtype: str
+        '''
+        return self.get_jira_keys([offense_id]).get(offense_id)
+
+    def get_jira_keys(self, offense_ids:List[int]) -> Dict[int,str]:
+        '''Returns the keys of the JIRA issues created for several offenses, looking up the ones missing on the cache with a single query.
+
+        :param List[int] offense_ids: IDs of the offenses.
+        :return: Dictionary with the offense ID as key and the JIRA issue key as value. Offenses without issue are not on it.
+        :rtype: Dict[int,str]
+        '''
+        jira_keys = {}
+        with self.lock:
+            missing_offense_ids = []
+            for offense_id in offense_ids:
+                if offense_id in self.cache:
+                    self.cache.move_to_end(offense_id)
+                    jira_keys[offense_id] = self.cache[offense_id]
+                else:
+                    missing_offense_ids.append(offense_id)
+            if missing_offense_ids:
+                placeholders = ",".join("?" * len(missing_offense_ids))
+                for offense_id, jira_key in self.connection.execute(f"SELECT offense_id, jira_key FROM offense_jira_issues WHERE offense_id IN ({placeholders})", missing_offense_ids):
+                    jira_keys[offense_id] = jira_key
+                    self._cache_put(offense_id, jira_key)
+        return jira_keys
+
+    def record(self, offense_id:int, jira_key:str) -> None:
+        '''Stores the key of the JIRA issue created for an offense.
+
+        :param int offense_id: ID of the offense.
+        :param str jira_key: Key of the JIRA issue created for the offense.
+        :return: None
+        :rtype: None
+        '''
+        self.record_many({offense_id: jira_key})
+
+    def record_many(self, jira_keys:Dict[int,str]) -> None:
+        '''Stores the keys of the JIRA issues created for several offenses in a single transaction.
+
+        :param Dict[int,str] jira_keys: Dictionary with the offense ID as key and the JIRA issue key as value.
+        :return: None
+        :rtype: None
+        '''
+        if not jira_keys:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("INSERT OR REPLACE INTO offense_jira_issues (offense_id, jira_key, created_time) VALUES (?, ?, ?)", [(offense_id, jira_key, now) for offense_id, jira_key in jira_keys.items()])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            for offense_id, jira_key in jira_keys.items():
+                self._cache_put(offense_id, jira_key)
+
+    def get_last_synced_times(self, offense_ids:List[int]) -> Dict[int,float]:
+        '''Returns when the updates of several offenses were last pushed to their JIRA issues. The creation of the JIRA issue counts as the first sync.
+
+        :param List[int] offense_ids: IDs of the offenses.
+        :return: Dictionary with the offense ID as key and the epoch time of its last update sync as value. Offenses without JIRA issue are not on it.
+        :rtype: Dict[int,float]
+        '''
+        if not offense_ids:
+            return {}
+        placeholders = ",".join("?" * len(offense_ids))
+        with self.lock:
+            return dict(self.connection.execute(f'''SELECT issues.offense_id, MAX(issues.created_time, COALESCE(syncs.last_synced_time, 0))
+                FROM offense_jira_issues issues LEFT JOIN offense_update_syncs syncs ON syncs.offense_id = issues.offense_id
+                WHERE issues.offense_id IN ({placeholders})''', offense_ids).fetchall())
+
+    def get_handled_updated_times(self, offense_ids:List[int]) -> Dict[int,int]:
+        '''Returns the latest QRADAR last_updated_time of several offenses that was already handled: pushed to their JIRA issues or moved to the dead letters.
+        Updates up to it are not pushed again when QRADAR returns them again.
+
+        :param List[int] offense_ids: IDs of the offenses.
+        :return: Dictionary with the offense ID as key and the last handled last_updated_time (milliseconds) as value. Offenses never handled are not on it.
+        :rtype: Dict[int,int]
+        '''
+        if not offense_ids:
+            return {}
+        placeholders = ",".join("?" * len(offense_ids))
+        with self.lock:
+            return dict(self.connection.execute(f'''SELECT offense_id, MAX(updated_time) FROM (
+                SELECT offense_id, last_synced_updated_time AS updated_time FROM offense_update_syncs WHERE offense_id IN ({placeholders})
+                UNION ALL SELECT offense_id, last_updated_time AS updated_time FROM offense_update_dead_letters WHERE offense_id IN ({placeholders}))
+                GROUP BY offense_id''', offense_ids + offense_ids).fetchall())
+
+    def record_update_dead_letter(self, offense_id:int, jira_key:str, updated_time:int, error:str) -> None:
+        '''Stores an offense update that failed to be pushed to its JIRA issue too many times. It is not retried anymore, but a later update of the offense is pushed again.
+
+        :param int offense_id: ID of the offense.
+        :param str jira_key: Key of the JIRA issue of the offense.
+        :param int updated_time: QRADAR last_updated_time (milliseconds) of the update.
+        :param str error: Error obtained on the last push.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO offense_update_dead_letters (offense_id, jira_key, last_updated_time, last_error, dead_letter_time) VALUES (?, ?, ?, ?, ?)",
+                                    (offense_id, jira_key, updated_time, error, time.time()))
+
+    def record_synced(self, updated_times:Dict[int,int]) -> None:
+        '''Stores that the updates of several offenses were pushed to their JIRA issues now.
+
+        :param Dict[int,int] updated_times: Dictionary with the offense ID as key and the QRADAR last_updated_time pushed to JIRA as value.
+        :return: None
+        :rtype: None
+        '''
+        if not updated_times:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("INSERT OR REPLACE INTO offense_update_syncs (offense_id, last_synced_time, last_synced_updated_time) VALUES (?, ?, ?)", [(offense_id, now, updated_time) for offense_id, updated_time in updated_times.items()])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def get_group(self, group_key:str) -> Tuple[str,int]:
+        '''Returns the JIRA issue of the current group of a coalescing key.
+
+        :param str group_key: The coalescing key.
+        :return: (JIRA issue key, start_time of the first offense of the group in milliseconds), or None if the key has no group yet.
+        :rtype: Tuple[str,int]
+        '''
+        with self.lock:
+            return self.connection.execute("SELECT jira_key, window_start_time FROM offense_groups WHERE group_key = ?", (group_key,)).fetchone()
+
+    def record_group(self, group_key:str, jira_key:str, window_start_time:int, offenses_count:int) -> None:
+        '''Stores the JIRA issue created for a new group of a coalescing key. It replaces the previous group of the key, whose window is over, unless the stored group is newer
+        (an older group created late, for example from the JIRA spool), so the key never moves back to an older issue.
+
+        :param str group_key: The coalescing key.
+        :param str jira_key: Key of the JIRA issue created for the group.
+        :param int window_start_time: start_time of the first offense of the group in milliseconds.
+        :param int offenses_count: Number of offenses of the group.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute('''INSERT INTO offense_groups (group_key, jira_key, window_start_time, offenses_count) VALUES (?, ?, ?, ?)
+                ON CONFLICT(group_key) DO UPDATE SET jira_key = excluded.jira_key, window_start_time = excluded.window_start_time, offenses_count = excluded.offenses_count
+                WHERE excluded.window_start_time >= offense_groups.window_start_time''', (group_key, jira_key, window_start_time, offenses_count))
+
+    def add_group_offenses(self, group_key:str, offenses_count:int) -> None:
+        '''Counts the offenses added to the current group of a coalescing key.
+
+        :param str group_key: The coalescing key.
+        :param int offenses_count: Number of offenses added to the group.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.connection.execute("UPDATE offense_groups SET offenses_count = offenses_count + ? WHERE group_key = ?", (offenses_count, group_key))
+
+    def claim(self, offense_id:int) -> bool:
+        '''Marks an offense as being uploaded to JIRA by the calling thread.
+
+        :param int offense_id: ID of the offense.
+        :return: True if the offense was claimed, False if another thread is already uploading it.
+        :rtype: bool
+        '''
+        with self.lock:
+            if offense_id in self.claimed_offense_ids:
+                return False
+            self.claimed_offense_ids.add(offense_id)
+            return True
+
+    def release(self, offense_id:int) -> None:
+        '''Releases the claim of an offense once its upload has finished (successfully or not).
+
+        :param int offense_id: ID of the offense.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.claimed_offense_ids.discard(offense_id)
+
+class OffenseAlreadyClaimedError(Exception):
+    '''Raised when an offense is being uploaded to JIRA by another thread at the same time.'''
+    def __init__(self, offense_id:int):
+        super().__init__(f"Offense {offense_id} is already being uploaded to JIRA by another thread")
+        self.offense_id = offense_id
+
+offense_issue_index: OffenseIssueIndex = None #Index shared by every thread of the app. Created on init_offense_issue_index
+offense_issue_index_lock = threading.Lock()
+
+def init_offense_issue_index(config:ServerConfig) -> OffenseIssueIndex:
+    '''Initializates the offense to JIRA issue index shared by the app threads. The index is only created once.
+
+    :param ServerConfig config: Configuration received from the config.ini file
+    :return: The shared offense to JIRA issue index.
+    :rtype: OffenseIssueIndex
+    '''
+    global offense_issue_index
+    with offense_issue_index_lock:
+        if offense_issue_index is None:
+            offense_issue_index = OffenseIssueIndex(config.offense_issue_index_file, config.offense_issue_index_cache_size)
+        return offense_issue_index
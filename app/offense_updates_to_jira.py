@@ -0,0 +1,245 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from app_config import ServerConfig, offense_updates_to_jira_logger
+from http_client import init_http_clients, jira_post, qradar_get
+from jira_circuit_breaker import JiraCircuitOpenError
+from checkpoint import write_file_atomically
+from sharding import offense_in_shard
+from offense_issue_index import OffenseIssueIndex, init_offense_issue_index
+import metrics
+
+QRADAR_OFFENSE_UPDATE_FIELDS = "id,description,status,last_updated_time,event_count,flow_count,magnitude,severity" #Fields projection of the offenses, limited to the ones pushed to JIRA as updates
+
+config: ServerConfig = None
+offense_issue_index: OffenseIssueIndex = None #Offense to JIRA issue index shared with the other threads. Created on init_vars
+jira_update_executor: ThreadPoolExecutor = None #Worker pool used to push the updates to JIRA in parallel. Created on init_vars
+last_updated_time: int = None #Watermark: highest QRADAR last_updated_time (milliseconds) already fetched
+saved_updated_time: int = None #Watermark saved on the file. Held at the oldest pending update, so the pending updates are fetched again after a restart
+throttled_updates: Dict[int,Dict[any,any]] = {} #Latest pending update of the offenses that were synced less than min_update_interval seconds ago or failed to be pushed. Bounded by max_pending_offense_updates
+update_attempts: Dict[int,int] = {} #Failed pushes of the pending update of every offense
+
+def load_last_updated_time() -> int:
+    """Load the last synced offense last_updated_time from a file. If the file does not exist, the sync starts from now (previous updates are not pushed).
+
+    :return: The last synced last_updated_time in milliseconds.
+    :rtype: int
+    :raises OSError,ValueError: if an error occurs when opening/reading the file
+    """
+    global saved_updated_time
+    if os.path.exists(config.last_updated_time_file):
+        with open(config.last_updated_time_file, 'r') as file:
+            content = file.read().strip()
+            if content:
+                saved_updated_time = int(content)
+                return saved_updated_time
+    return int(time.time() * 1000)
+
+
+
+def save_last_updated_time(updated_time:int) -> None:
+    """Updates the script variable with the last fetched offense last_updated_time and saves it to a file (atomically, so a crash never leaves it empty).
+    The saved value is held at the oldest last_updated_time of the pending updates, as they only live in memory: after a restart they are fetched again, and the ones already pushed are skipped.
+
+    :param int updated_time: The last fetched last_updated_time (milliseconds).
+    :return: Nothing.
+    :rtype: None
+    :raises OSError: if an error occurs when opening/writing the file"""
+    global last_updated_time, saved_updated_time
+    last_updated_time = updated_time
+    checkpoint_time = min([updated_time] + [offense.get('last_updated_time') for offense in throttled_updates.values()])
+    if checkpoint_time != saved_updated_time:
+        write_file_atomically(config.last_updated_time_file, str(checkpoint_time))
+        saved_updated_time = checkpoint_time
+
+
+
+def get_updated_offenses_page(after:Tuple[int,int], page_size:int) -> List[Dict[any,any]]:
+    """Retrieve a page of the open offenses updated after the given (last_updated_time, id) position, sorted by last_updated_time and ID so pages never skip offenses updated on the same millisecond.
+    The first page starts at the watermark millisecond itself, as the offenses updated on it after the last page of the previous cycle are not known. The updates already handled are skipped when pushed.
+
+    :param Tuple[int,int] after: (last_updated_time, offense ID) of the last offense of the previous page. The ID is None on the first page.
+    :param int page_size: Maximum number of offenses to retrieve in the page.
+    :return: JSON response of the offenses obtained.
+    :rtype: List[Dict[any,any]]
+    :raises HttpError: if an error occurred making the HTTP request"""
+    updated_time, offense_id = after
+    if offense_id is None:
+        updated_filter = f"last_updated_time >= {updated_time}"
+    else:
+        updated_filter = f"(last_updated_time > {updated_time} or (last_updated_time = {updated_time} and id > {offense_id}))"
+    params = { "filter": f"status=OPEN and {updated_filter}", "sort": "+last_updated_time,+id", "fields": QRADAR_OFFENSE_UPDATE_FIELDS }
+    response = qradar_get(config.qradar_url, params=params, headers={"RANGE": f"items=0-{page_size - 1}"})
+    response.raise_for_status()
+    return response.json()
+
+
+
+def build_jira_update_comment(offenses:List[Dict[any,any]]) -> Dict[any,any]:
+    """Builds the body of the JIRA comment with the updates of the offenses of an issue, one paragraph per offense (Atlassian Document Format, as required by the JIRA API v3).
+
+    :param List[Dict[any,any]] offenses: The updated offenses obtained from QRADAR SIEM. Several offenses share an issue if they were coalesced into a group.
+    :return: Body of the JIRA comment creation request
+    :rtype: Dict[any,any]"""
+    content = []
+    for offense in offenses:
+        text = (
+            f"QRadar Offense {offense['id']} was updated.\n"
+            f"Offense Description: {offense.get('description')}\n"
+            f"Event Count: {offense.get('event_count')}\n"
+            f"Flow Count: {offense.get('flow_count')}\n"
+            f"Magnitude: {offense.get('magnitude')}\n"
+            f"Severity: {offense.get('severity')}\n"
+            f"Last Updated: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(offense['last_updated_time'] / 1000))}\n"
+        )
+        content.append({"type": "paragraph", "content": [{"type": "text", "text": text}]})
+    return {"body": {"type": "doc", "version": 1, "content": content}}
+
+
+
+def push_update_to_jira(jira_key:str, offenses:List[Dict[any,any]]) -> Dict[any,any]:
+    """Adds a single comment with the updates of the offenses to their JIRA issue.
+
+    :param str jira_key: Key of the JIRA issue of the offenses.
+    :param List[Dict[any,any]] offenses: The updated offenses obtained from QRADAR SIEM
+    :return: The json response from creating the JIRA comment
+    :rtype: Dict[any,any]
+    :raises HttpError: if an error occurred making the HTTP request"""
+    response = jira_post(f"{config.jira_url.rstrip('/')}/{jira_key}/comment", build_jira_update_comment(offenses))
+    response.raise_for_status()
+    return response.json()
+
+
+
+def record_failed_update(offense_id:int, jira_key:str, offense:Dict[any,any], error:Exception) -> None:
+    """Keeps the update of an offense that failed to be pushed aside, to retry it on the next cycle. Once it failed max_offense_update_attempts times, it is moved to the dead letters instead.
+
+    :param int offense_id: ID of the offense.
+    :param str jira_key: Key of the JIRA issue of the offense.
+    :param Dict[any,any] offense: The updated offense obtained from QRADAR SIEM
+    :param Exception error: Error obtained when pushing the update.
+    :return: Nothing.
+    :rtype: None
+    :raises sqlite3.Error: if an error occurs when storing the dead letter"""
+    attempts = update_attempts.get(offense_id, 0) + 1
+    if attempts >= config.max_offense_update_attempts:
+        offense_updates_to_jira_logger.error(f"Error pushing the update of offense {offense_id} to the JIRA issue {jira_key}: {str(error)}. It failed {attempts} times. Moving it to the dead letters.")
+        offense_issue_index.record_update_dead_letter(offense_id, jira_key, offense.get('last_updated_time'), str(error))
+        throttled_updates.pop(offense_id, None)
+        update_attempts.pop(offense_id, None)
+        metrics.offense_updates_pushed.inc(1, "dead_letter")
+        return
+    offense_updates_to_jira_logger.error(f"Error pushing the update of offense {offense_id} to the JIRA issue {jira_key}: {str(error)}. Retrying it on the next cycle.")
+    throttled_updates[offense_id] = offense
+    update_attempts[offense_id] = attempts
+    metrics.offense_updates_pushed.inc(1, "failed")
+
+
+
+def push_updates_to_jira(updated_offenses:Dict[int,Dict[any,any]]) -> None:
+    """Pushes the updates of the offenses that have a JIRA issue, in parallel, with a single comment per JIRA issue (coalesced offenses share their issue).
+    Updates already pushed or moved to the dead letters are skipped. Offenses synced less than min_update_interval seconds ago, the ones that failed and the ones not pushed because the JIRA circuit breaker is open, are kept aside and pushed on a later cycle with their latest update.
+
+    :param Dict[int,Dict[any,any]] updated_offenses: Dictionary with the offense ID as key and its latest update as value.
+    :return: Nothing.
+    :rtype: None"""
+    offense_ids = list(updated_offenses)
+    jira_keys = offense_issue_index.get_jira_keys(offense_ids)
+    handled_updated_times = offense_issue_index.get_handled_updated_times(list(jira_keys))
+    last_synced_times = offense_issue_index.get_last_synced_times(list(jira_keys))
+    now = time.time()
+    issue_updates: Dict[str,List[int]] = {}
+    for offense_id, jira_key in jira_keys.items():
+        if updated_offenses[offense_id].get('last_updated_time') <= handled_updated_times.get(offense_id, -1):
+            throttled_updates.pop(offense_id, None) #Returned again by the first page of a cycle, which starts at the watermark millisecond
+        elif now - last_synced_times.get(offense_id, 0) < config.min_update_interval:
+            throttled_updates[offense_id] = updated_offenses[offense_id]
+        else:
+            throttled_updates.pop(offense_id, None)
+            issue_updates.setdefault(jira_key, []).append(offense_id)
+    pending_updates = [(jira_key, issue_offense_ids, jira_update_executor.submit(push_update_to_jira, jira_key, [updated_offenses[offense_id] for offense_id in issue_offense_ids]))
+                       for jira_key, issue_offense_ids in issue_updates.items()]
+    offense_updates_to_jira_logger.info(f"{len(updated_offenses)} updated offenses, {len(jira_keys)} of them with a JIRA issue. Pushing {len(pending_updates)} comments, {len(throttled_updates)} updates pending.")
+
+    synced_updated_times = {}
+    for jira_key, issue_offense_ids, update in pending_updates:
+        try:
+            update.result()
+        except JiraCircuitOpenError:
+            offense_updates_to_jira_logger.info(f"JIRA is unavailable (circuit breaker open). The update of offenses {issue_offense_ids} will be pushed to the JIRA issue {jira_key} once JIRA recovers.")
+            for offense_id in issue_offense_ids: #Not counted as a failed attempt, as JIRA was not called
+                throttled_updates[offense_id] = updated_offenses[offense_id]
+            continue
+        except Exception as e:
+            for offense_id in issue_offense_ids:
+                record_failed_update(offense_id, jira_key, updated_offenses[offense_id], e)
+            continue
+        for offense_id in issue_offense_ids:
+            synced_updated_times[offense_id] = updated_offenses[offense_id].get('last_updated_time')
+            update_attempts.pop(offense_id, None)
+        metrics.offense_updates_pushed.inc(len(issue_offense_ids), "pushed")
+    offense_issue_index.record_synced(synced_updated_times)
+
+
+
+def sync_offense_updates() -> None:
+    """Fetches the offenses updated since the last cycle (delta query on last_updated_time) and pushes their updates to the mapped JIRA issues. The watermark is saved after every page and once the pending updates are pushed.
+    Paging stops once a whole page would not fit on the pending updates, so they stay bounded by max_pending_offense_updates: the next pages are fetched on a later cycle, from the watermark."""
+    global last_updated_time
+    if last_updated_time is None:
+        last_updated_time = load_last_updated_time()
+
+    after = (last_updated_time, None)
+    while True:
+        if len(throttled_updates) + config.offenses_page_size > config.max_pending_offense_updates:
+            offense_updates_to_jira_logger.warning(f"{len(throttled_updates)} offense updates pending. Not fetching more updated offenses until some of them are pushed.")
+            break
+        offense_updates_to_jira_logger.info(f"Getting offenses updated after {after[0]} from QRADAR SIEM...")
+        updated_offenses_page = get_updated_offenses_page(after, config.offenses_page_size)
+        offense_updates_to_jira_logger.info(f"Call succesfully made to QRADAR SIEM. {len(updated_offenses_page)} updated offenses obtained.")
+        if not updated_offenses_page:
+            break
+        push_updates_to_jira({offense.get('id'): offense for offense in updated_offenses_page if offense_in_shard(offense.get('id'))})
+        after = (updated_offenses_page[-1].get('last_updated_time'), updated_offenses_page[-1].get('id'))
+        save_last_updated_time(after[0])
+        if len(updated_offenses_page) < config.offenses_page_size:
+            break
+
+    #Throttled updates whose min update interval is over are pushed now, even if the offense was not updated again
+    if throttled_updates:
+        push_updates_to_jira(dict(throttled_updates))
+        save_last_updated_time(last_updated_time)
+
+def init_vars(passedconfig: ServerConfig):
+    '''
+    Initializates variables for the script
+
+    :param ServerConfig passedconfig: Configuration received from the config.ini file
+    :return: None
+    :rtype: None
+    '''
+    global config
+    config = passedconfig
+    init_http_clients(config)
+    global offense_issue_index
+    offense_issue_index = init_offense_issue_index(config)
+    global jira_update_executor
+    jira_update_executor = ThreadPoolExecutor(max_workers=config.jira_upload_workers, thread_name_prefix="jira_update_worker")
+    metrics.register(metrics.Gauge("qradar2jira_pending_offense_updates", "Offense updates kept aside (throttled or failed) waiting to be pushed to JIRA.", callback=lambda: len(throttled_updates)))
+
+def main(passedconfig: ServerConfig):
+
+    init_vars(passedconfig)
+
+    """Main loop to continuously push the updates of the offenses to their JIRA issues."""
+    while True:
+        metrics.heartbeat("offense_updates_to_jira")
+        try:
+            sync_offense_updates()
+        except Exception as e:
+            offense_updates_to_jira_logger.error(f"Error pulling and/or pushing offense updates to JIRA: {str(e)}")
+        metrics.sleep_with_heartbeat("offense_updates_to_jira", config.polling_rate_offense_updates_sync)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import threading
+
+class AdaptivePollingScheduler:
+    '''Computes the wait before the next poll of new offenses from what the last poll found, instead of always waiting the same polling rate:
+
+    - A full page: more new offenses are waiting on QRADAR, so it is polled again right away.
+    - Some new offenses: the next poll waits min_interval.
+    - No new offenses: the first idle poll waits min_interval, and the wait is multiplied by backoff_factor on every idle poll after it, up to max_interval.
+
+    While idle, the poller can send a cheap probe before the full fetch (see should_probe).'''
+
+    def __init__(self, min_interval:int, max_interval:int, backoff_factor:int):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff_factor = backoff_factor
+        self.interval = min_interval #Wait before the next poll
+        self.idle_polls = 0 #Polls in a row without new offenses
+        self.lock = threading.Lock()
+
+    def record_poll(self, offenses_count:int, page_full:bool) -> float:
+        '''Records the outcome of a polling cycle and computes the wait before the next one.
+
+        :param int offenses_count: Number of new offenses obtained on the cycle.
+        :param bool page_full: If the last page of the cycle was full (more new offenses are waiting on QRADAR).
+        :return: Seconds to wait before the next poll.
+        :rtype: float
+        '''
+        with self.lock:
+            if offenses_count > 0:
+                self.idle_polls = 0
+                self.interval = 0 if page_full else self.min_interval
+            else:
+                self.idle_polls += 1
+                self.interval = self.min_interval if self.idle_polls == 1 else min(self.max_interval, max(self.interval, self.min_interval) * self.backoff_factor)
+            return self.interval
+
+    def should_probe(self) -> bool:
+        '''Checks if the next poll should send a cheap probe before the full fetch: only while QRADAR is idle, so a burst of offenses is fetched without the extra call.
+
+        :return: True if the last poll found no new offenses.
+        :rtype: bool
+        '''
+        with self.lock:
+            return self.idle_polls > 0
+
+    def reconfigure(self, min_interval:int, max_interval:int, backoff_factor:int) -> None:
+        '''Applies new intervals and backoff factor (on a config reload). The current wait is capped to the new max interval.
+
+        :param int min_interval: Seconds to wait after a poll with new offenses.
+        :param int max_interval: Maximum seconds to wait while idle.
+        :param int backoff_factor: Factor applied to the wait on every idle poll.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.min_interval = min_interval
+            self.max_interval = max(max_interval, min_interval)
+            self.backoff_factor = backoff_factor
+            self.interval = min(self.interval, self.max_interval)
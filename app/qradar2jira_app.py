@@ -1,7 +1,12 @@
+import signal
 import threading
 from qradar_siem_offenses_to_jira import main as offenses_to_jira_run
 from reupload_failed_offenses_to_jira import main as retry_uploading_failed_offenses_run
-from app_config import server_config
+from offense_updates_to_jira import main as offense_updates_to_jira_run
+import async_runtime
+import metrics
+import sharding
+from app_config import app_bootstrap_logger, init_app, start_config_reloader
 
 def send_offenses_to_jira(server_config ):
     '''Calls the main method for the send offenses to jira Python module, which runs in a separate thread.
@@ -17,13 +22,39 @@ def retry_uploading_to_jira_failed_offenses(server_config):
     '''
     retry_uploading_failed_offenses_run(server_config)
 
+def sync_offense_updates_to_jira(server_config):
+    '''Calls the main method of the offense updates to jira Python module, which runs in a separate thread.
+    
+    :param ServerConfig server_config: Configuration needed for the thread
+    '''
+    offense_updates_to_jira_run(server_config)
+
 def main():
-    '''Main method. Runs both threads (offenses and failed offenses) in daemon mode. '''
+    '''Main method. Runs both threads (offenses and failed offenses) in daemon mode, or both coroutines on an event loop if the asyncio runtime is selected. The offense updates thread and the metrics endpoint are also started if enabled.
+    If sharding is enabled, the instance first waits for the lease of a shard and then only processes the offenses of that shard.
+    The config.ini file is reloaded on SIGHUP (and when it changes, if the config watcher is enabled) without restarting the app. '''
+    server_config = init_app()
+    start_config_reloader()
+    metrics.start_metrics_server(server_config)
+    sharding.init_sharding(server_config)
+    if server_config.runtime == 'asyncio':
+        if async_runtime.is_available():
+            async_runtime.main(server_config)
+            return
+        app_bootstrap_logger.error("asyncio runtime selected but the aiohttp package is not installed. Falling back to the threads runtime.")
+
+    #SIGTERM (service stop) interrupts the main thread like Ctrl+C, so the app exits normally and the exit hooks save the in-memory checkpoints
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     t1 = threading.Thread(target=send_offenses_to_jira, args=(server_config,), daemon=True)
     t2 = threading.Thread(target=retry_uploading_to_jira_failed_offenses , args=(server_config,), daemon=True)
     
     t1.start()
     t2.start()
+
+    if server_config.offense_updates_sync_enabled:
+        t3 = threading.Thread(target=sync_offense_updates_to_jira, args=(server_config,), daemon=True)
+        t3.start()
     
     #List all threads currently running
     #print(threading.enumerate())
@@ -1,154 +1,574 @@
-import requests
+import atexit
 import time
-import os
-import json
-from typing import Dict, List
-from app_config import ServerConfig, offenses_to_jira_logger
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Deque, Dict, Iterable, List, Tuple
+from app_config import SAMPLED_LOG, LazyJson, ServerConfig, offenses_to_jira_logger, on_config_reload
+from http_client import init_http_clients, qradar_get
+from json_stream import iter_json_array
+import metrics
+from checkpoint import Checkpoint
+from sharding import offense_in_shard
+from address_resolver import init_address_resolver, resolve_offenses_addresses
+from failed_offenses_store import FailedOffensesStore, init_failed_offenses_store
+from offense_coalescing import get_coalescing_key_fields, get_group_lock, get_offense_fields, group_offenses
+from jira_bulk import JIRA_BULK_MAX_ISSUES, JiraBulkBatcher
+from jira_spool import JiraSpool, init_jira_spool
+from jira_uploads import UploadSteps, init_jira_uploads, run_upload_steps, upload_offense_group_steps, upload_offenses_steps
+from offense_issue_index import OffenseIssueIndex, init_offense_issue_index
+from polling_scheduler import AdaptivePollingScheduler
 
+SINGLE_UPLOAD = "single" #Upload of a single offense with its own JIRA request
+BULK_UPLOAD = "bulk" #Upload of a batch of offenses with a single JIRA bulk request
+GROUP_UPLOAD = "group" #Upload of a group of correlated offenses with a single JIRA issue or comment
 
-qradar_headers = {'SEC': None, 'Accept': 'application/json'} #Headers for QRadar API. Paritally obtained from config.ini file
 config: ServerConfig = None
-jira_auth = ()
+jira_upload_executor: ThreadPoolExecutor = None #Worker pool used to create JIRA tickets in parallel. Created on init_vars
+jira_bulk_batcher: JiraBulkBatcher = None #Collects offenses into JIRA bulk requests. Only created if JIRA bulk creation is enabled
+pending_uploads: Deque[Tuple[int, Future]] = deque() #Submitted uploads in offense ID order: (offense ID, future of the upload with the outcome of every offense of the upload)
+failed_offenses_store: FailedOffensesStore = None #Store shared with the failed offenses thread. Created on init_vars
+offense_issue_index: OffenseIssueIndex = None #Offense to JIRA issue index shared with the failed offenses thread. Created on init_vars
+polling_scheduler: AdaptivePollingScheduler = None #Computes the wait between polls from the offenses arrival rate. Only created if adaptive polling is enabled
+jira_spool: JiraSpool = None #Spool of the rendered JIRA issues of the offenses processed while the JIRA circuit breaker is open. Only created if the JIRA circuit breaker is enabled
+last_processed_id_checkpoint: Checkpoint = None #Persists last_processed_id on the last_processed_id_file, coalescing the writes. Created on init_vars
+last_processed_id: int = None #Watermark: every offense up to this ID was uploaded or stored as failed
+last_fetched_id: int = None #Highest offense ID fetched from QRADAR. Can be ahead of last_processed_id while offenses wait on the bulk batcher
+newest_offense_id: int = None #Newest open offense ID on QRADAR seen by the poller (probed or fetched), read by the watermark lag metric
+newest_offense_id_probe_time: float = None #Monotonic time of the last newest offense ID probe
+hooks_registered: bool = False #The exit and config reload hooks are registered by the first init_vars call only
 
 def load_last_processed_id()-> int:
-    """Load the last processed offense ID from a file.
+    """Load the last processed offense ID from a file. Only done at startup: afterwards the watermark is kept in memory.
     
     :return: ID of the last processed offense ID.
     :rtype: int
     :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/reading the file
     """
-    if os.path.exists(config.last_processed_id_file):
-        with open(config.last_processed_id_file, 'r') as file:
-            return int(file.read().strip())
-    return None
+    return last_processed_id_checkpoint.load()
 
 
 
 def save_last_processed_id(offense_id:int) -> None:
-    """Save the last processed offense ID to a file and updates the script variable
+    """Updates the script variable with the last processed offense ID. It is written to the file (atomically) once checkpoint_flush_every offenses are pending,
+    checkpoint_flush_interval seconds have passed since the last write, or the app stops.
     
     :param int offense_id: The ID of the offense to write on the file as the latest offense processed.
     :return: Nothing.
     :rtype: None
-    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/writing the file"""
-    with open(config.last_processed_id_file, 'w') as file:
-        file.write(str(offense_id))
+    :raises OSError: if an error occurs when writing the file"""
+    last_processed_id_checkpoint.update(offense_id)
     global last_processed_id
     last_processed_id = offense_id
 
 
 
-def save_failed_offense_update_on_jira(offense_id_that_failed:int) -> None:
-    """Appends a numeric offense ID the failed JIRA uploaded offenses file, separated by commas.
+def flush_last_processed_id() -> None:
+    """Writes the last processed offense ID to the file right away, if it changed since the last write. Called on shutdown.
 
-    :param int offense_id_that_failed: The ID of the offense to write on the Failed Offenses file as the latest offense that failed to be uploaded to JIRA.
+    :return: Nothing.
+    :rtype: None"""
+    try:
+        last_processed_id_checkpoint.flush()
+    except Exception as e:
+        offenses_to_jira_logger.error(f"Error saving the last processed offense ID {str(last_processed_id)} on shutdown: {str(e)}")
+
+
+
+def save_failed_offense_update_on_jira(offense_id_that_failed:int, error:str = None) -> None:
+    """Adds a numeric offense ID to the failed JIRA uploaded offenses store.
+
+    :param int offense_id_that_failed: The ID of the offense to add to the Failed Offenses store as an offense that failed to be uploaded to JIRA.
+    :param str error: Error obtained when uploading the offense.
     :return: Nothing.
     :rtype: None
-    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/writing the file"""
-    with open(config.failed_processed_id_file, 'a') as file:
-        if file.tell() > 0:  # Check if the file is not empty
-            file.write(',')
-        file.write(str(offense_id_that_failed))
+    :raises sqlite3.Error: if an error occurs when inserting the offense on the store"""
+    failed_offenses_store.add(offense_id_that_failed, error, time.time() + config.retry_base_delay)
 
 
 
-def get_latest_offenses() -> List[Dict[any,any]]:
-    """Retrieve the latest offense from QRadar. Filtering by status as OPEN, the ID being bigger than the offset ID of the last processed ID from QRADAR, and filtering by start_time in ascendant mode to get the latest one.
+def get_latest_offenses(page_size:int = 1) -> Iterable[Dict[any,any]]:
+    """Retrieve a page of the latest offenses from QRadar. Filtering by status as OPEN, the ID being bigger than the last offense ID fetched from QRADAR, and sorting by ID in ascendant mode so the page starts with the oldest unprocessed offense.
+    Only the fields used by the JIRA tickets are requested. If streaming JSON parsing is enabled, the offenses are parsed one at a time while they are read.
     
-    :return: JSON response of the offenses obtained.
-    :rtype: Dict[any,any]
+    :param int page_size: Maximum number of offenses to retrieve in the page.
+    :return: JSON response of the offenses obtained, as a list or as an iterator if streaming JSON parsing is enabled.
+    :rtype: Iterable[Dict[any,any]]
+    :raises HttpError: if an error occurred making the HTTP request"""
+    params = { "filter": 'status=OPEN and id > ' + str(last_fetched_id), "sort": "+id", "fields": get_offense_fields(config) }
+    start_time = time.monotonic()
+    response = qradar_get(config.qradar_url, params=params, headers={"RANGE": f"items=0-{page_size - 1}"}, stream=config.streaming_json_parsing_enabled)
+    metrics.qradar_poll_duration.observe(time.monotonic() - start_time)
+    if not config.streaming_json_parsing_enabled:
+        response.raise_for_status()
+        return response.json()
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    return iter_json_array(response)
+
+
+
+def has_new_offenses() -> bool:
+    """Probes QRadar for new offenses with a cheap call (a single open offense with an ID bigger than the last offense ID fetched, with its ID only), so an idle poll skips the full fetch.
+
+    :return: True if there is at least one new open offense.
+    :rtype: bool
     :raises HttpError: if an error occurred making the HTTP request"""
-    params = { "filter": 'status=OPEN and id > ' + str(last_processed_id), "sort": "+start_time" }
-    global qradar_headers
-    qradar_headers = qradar_headers.copy()
-    qradar_headers["RANGE"] = "items=0-0"
-    qradar_headers["VERSION"] = "20.0"
-    response = requests.get(config.qradar_url, headers=qradar_headers, verify=False, params=params)
+    params = { "filter": 'status=OPEN and id > ' + str(last_fetched_id), "fields": "id" }
+    response = qradar_get(config.qradar_url, params=params, headers={"RANGE": "items=0-0"})
     response.raise_for_status()
-    return response.json()
+    new_offenses = len(response.json()) > 0
+    metrics.new_offenses_probes.inc(1, "new_offenses" if new_offenses else "empty")
+    return new_offenses
 
 
 
-def create_jira_ticket(offense):
-    """Create a new JIRA ticket for the given offense.
-    
-    :param Dict[any,any] offense: The offense obtained from QRADAR SIEM
-    :return: The json response from creating the JIRA ticket
-    :rtype: Dict[any,any]
+def should_probe_new_offenses() -> bool:
+    """Checks if the poll should start with a cheap probe for new offenses: only with adaptive polling and the probe enabled, while QRADAR is idle.
+
+    :return: True if the new offenses probe should be sent before the full fetch.
+    :rtype: bool"""
+    return polling_scheduler is not None and config.new_offenses_probe_enabled and polling_scheduler.should_probe()
+
+
+
+def get_next_polling_interval(offenses_count:int, page_full:bool) -> float:
+    """Computes the wait before the next polling cycle: the adaptive polling scheduler wait if it is enabled, or the fixed polling rate otherwise.
+
+    :param int offenses_count: Number of new offenses obtained on the cycle.
+    :param bool page_full: If the last page of the cycle was full.
+    :return: Seconds to wait before the next polling cycle.
+    :rtype: float"""
+    if polling_scheduler is None:
+        return config.polling_rate_new_offenses_checking
+    return polling_scheduler.record_poll(offenses_count, page_full)
+
+
+
+def get_newest_offense_id() -> int:
+    """Retrieve the ID of the newest open offense from QRadar with a cheap call (a single offense with its ID only, sorted by ID in descendant mode).
+
+    :return: ID of the newest open offense, or None if there are no open offenses.
+    :rtype: int
     :raises HttpError: if an error occurred making the HTTP request"""
-    issue_data = {
-        "fields": {
-            "project": {
-                "key": config.jira_project_key
-            },
-            "summary": f"QRadar Offense {offense['id']}: {offense['description']}",
-            "description": (
-                f"Offense ID: {offense['id']}\n"
-                f"Offense Description: {offense['description']}\n"
-                f"Offense Type: {offense['offense_type']}\n"
-                f"Source IPs: {', '.join(offense.get('source_address_ids', []))}\n"
-                f"Destination IPs: {', '.join(offense.get('destination_address_ids', []))}\n"
-                f"Start Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(offense['start_time'] / 1000))}\n"
-                f"Last Updated: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(offense['last_updated_time'] / 1000))}\n"
-            ),
-            "issuetype": {
-                "name": "Task"
-            }
-        }
-    }
-
-    response = requests.post(config.jira_url, json=issue_data, auth=jira_auth)
+    params = { "filter": "status=OPEN", "sort": "-id", "fields": "id" }
+    response = qradar_get(config.qradar_url, params=params, headers={"RANGE": "items=0-0"})
     response.raise_for_status()
-    return response.json()
+    offenses = response.json()
+    return offenses[0].get('id') if offenses else None
 
 
 
-def process_offense():
-    """Process the next unprocessed offense and create a JIRA ticket for it."""
-    global last_processed_id
-    last_processed_id = load_last_processed_id()
+def is_newest_offense_id_probe_due() -> bool:
+    """Checks if the poller has to probe the newest offense ID for the watermark lag metric: only with metrics enabled, at most once every metrics_lag_probe_interval seconds.
+
+    :return: True if the newest offense ID has to be probed.
+    :rtype: bool"""
+    return config.metrics_enabled and (newest_offense_id_probe_time is None or time.monotonic() - newest_offense_id_probe_time >= config.metrics_lag_probe_interval)
+
+
+
+def set_newest_offense_id(offense_id:int) -> None:
+    """Caches the result of a newest offense ID probe for the watermark lag metric.
+
+    :param int offense_id: ID of the newest open offense, or None if there are no open offenses.
+    :return: None
+    :rtype: None"""
+    global newest_offense_id, newest_offense_id_probe_time
+    newest_offense_id_probe_time = time.monotonic()
+    newest_offense_id = offense_id
+
+
+
+def refresh_newest_offense_id() -> None:
+    """Probes the newest offense ID for the watermark lag metric if it is due. It runs on the polling cycle, so a metrics scrape never calls QRADAR. A failed probe keeps the cached ID.
+
+    :return: None
+    :rtype: None"""
+    if not is_newest_offense_id_probe_due():
+        return
+    try:
+        set_newest_offense_id(get_newest_offense_id())
+    except Exception as e:
+        offenses_to_jira_logger.warning(f"Error probing the newest offense ID for the watermark lag metric: {str(e)}")
+
+
+
+def get_watermark_lag() -> int:
+    """Computes the watermark lag metric: newest open offense ID on QRADAR minus the last processed offense ID. It only reads the newest offense ID cached by the poller.
+
+    :return: Number of offense IDs behind QRADAR, or None if it is not known yet.
+    :rtype: int"""
+    if newest_offense_id is None or last_processed_id is None:
+        return None
+    return max(0, newest_offense_id - last_processed_id)
+
+
+
+def get_offense_uploads(new_offenses:List[Dict[any,any]]) -> List[Tuple[str,List[Dict[any,any]],str]]:
+    """Splits new offenses into JIRA uploads: one per group of correlated offenses if coalescing is enabled, one per full JIRA bulk batch if bulk creation is enabled, or one per offense otherwise.
+    Offenses waiting on a bulk batch that is not full yet are uploaded on a later page or polling cycle.
+
+    :param List[Dict[any,any]] new_offenses: New offenses, sorted by ID.
+    :return: List of uploads: (SINGLE_UPLOAD, BULK_UPLOAD or GROUP_UPLOAD, offenses of the upload sorted by ID, coalescing key of a group upload).
+    :rtype: List[Tuple[str,List[Dict[any,any]],str]]"""
+    if config.coalescing_enabled:
+        uploads = []
+        for group_key, group in group_offenses(new_offenses, get_coalescing_key_fields(config), config.coalescing_window):
+            offenses_to_jira_logger.info(f"Uploading a group of {len(group)} correlated offenses ({group_key}). From ID {group[0].get('id')} to ID {group[-1].get('id')}")
+            uploads.append((GROUP_UPLOAD, group, group_key))
+        return uploads
+    if jira_bulk_batcher is not None:
+        batches = [jira_bulk_batcher.add(offense) for offense in new_offenses]
+        return [get_bulk_upload(batch) for batch in batches if batch]
+    return [(SINGLE_UPLOAD, [offense], None) for offense in new_offenses]
+
+
+
+def get_bulk_upload(batch:List[Dict[any,any]]) -> Tuple[str,List[Dict[any,any]],str]:
+    """Returns the JIRA upload of a bulk batch of offenses.
+
+    :param List[Dict[any,any]] batch: Offenses of the batch, sorted by ID.
+    :return: The BULK_UPLOAD upload of the batch.
+    :rtype: Tuple[str,List[Dict[any,any]],str]"""
+    offenses_to_jira_logger.info(f"Sending a JIRA bulk request with {len(batch)} offenses. From ID {batch[0].get('id')} to ID {batch[-1].get('id')}")
+    return (BULK_UPLOAD, batch, None)
+
+
+
+def get_expired_bulk_upload() -> Tuple[str,List[Dict[any,any]],str]:
+    """Returns the JIRA upload of the bulk batch that is not full yet, if its oldest offense has waited more than the max linger time.
+
+    :return: The BULK_UPLOAD upload of the batch, or None if there is nothing to flush yet.
+    :rtype: Tuple[str,List[Dict[any,any]],str]"""
+    batch = jira_bulk_batcher.take_expired() if jira_bulk_batcher is not None else None
+    return get_bulk_upload(batch) if batch else None
+
+
+
+def get_pending_bulk_upload() -> Tuple[str,List[Dict[any,any]],str]:
+    """Returns the JIRA upload of every offense still waiting on the bulk batcher, whatever the size or age of the batch. Used on shutdown.
+
+    :return: The BULK_UPLOAD upload of the batch, or None if the batcher is empty.
+    :rtype: Tuple[str,List[Dict[any,any]],str]"""
+    batch = jira_bulk_batcher.take_all() if jira_bulk_batcher is not None else None
+    return get_bulk_upload(batch) if batch else None
+
+
+
+def get_upload_steps(upload:Tuple[str,List[Dict[any,any]],str]) -> UploadSteps:
+    """Returns the upload logic shared with the asyncio runtime for a JIRA upload. A group upload must run while holding the lock of its group.
+
+    :param Tuple[str,List[Dict[any,any]],str] upload: The upload, as returned by get_offense_uploads.
+    :return: Generator of the upload requests, returning a dictionary with the offense ID as key and the created (or already existing) issue, SPOOLED_ISSUE or the exception of the offense, as value.
+    :rtype: UploadSteps"""
+    upload_kind, offenses, group_key = upload
+    if upload_kind == GROUP_UPLOAD:
+        return upload_offense_group_steps(group_key, offenses, jira_spool)
+    return upload_offenses_steps(offenses, upload_kind == BULK_UPLOAD, jira_spool)
+
+
+
+def run_offense_upload(upload:Tuple[str,List[Dict[any,any]],str]) -> Dict[int,any]:
+    """Runs a JIRA upload on the calling thread (a JIRA upload worker), holding the lock of its group if it is a group upload.
+
+    :param Tuple[str,List[Dict[any,any]],str] upload: The upload, as returned by get_offense_uploads.
+    :return: Dictionary with the offense ID as key and the created (or already existing) issue, SPOOLED_ISSUE or the exception of the offense, as value.
+    :rtype: Dict[int,any]
+    :raises HttpError: if the whole upload failed"""
+    if upload[0] == GROUP_UPLOAD:
+        with get_group_lock(upload[2]):
+            return run_upload_steps(get_upload_steps(upload))
+    return run_upload_steps(get_upload_steps(upload))
+
+
+
+def submit_offense_uploads(uploads:List[Tuple[str,List[Dict[any,any]],str]]) -> None:
+    """Submits JIRA uploads to the JIRA upload worker pool.
+
+    :param List[Tuple[str,List[Dict[any,any]],str]] uploads: The uploads, as returned by get_offense_uploads.
+    :return: None
+    :rtype: None
+    """
+    submitted_uploads = {}
+    for upload in uploads:
+        future = jira_upload_executor.submit(run_offense_upload, upload)
+        submitted_uploads.update({offense.get('id'): future for offense in upload[1]})
+    pending_uploads.extend((offense_id, submitted_uploads[offense_id]) for offense_id in sorted(submitted_uploads)) #Kept in offense ID order for the watermark, whatever the upload of every offense
+
+
+
+def commit_upload_outcome(offense_id:int, outcome:any) -> None:
+    """Logs the outcome of the upload of an offense, stores the offense on the failed offenses store if it failed, and moves the last processed ID up to it.
+    Must be called in offense ID order.
+
+    :param int offense_id: ID of the offense.
+    :param any outcome: The created (or already existing) issue, SPOOLED_ISSUE or the exception of the offense.
+    :return: None
+    :rtype: None
+    :raises sqlite3.Error: if an error occurs when inserting the offense on the failed offenses store
+    :raises OSError: if an error occurs when writing the last processed ID file
+    """
+    if isinstance(outcome, Exception):
+        offenses_to_jira_logger.error(f"Exception creating JIRA ticket for offense with ID: {str(offense_id)}: {str(outcome)}")
+        save_failed_offense_update_on_jira(offense_id, str(outcome)) #store the failed offense to be uploaded to jira in the failed offenses store
+        metrics.offenses_processed.inc(1, "failed")
+    elif outcome.get('spooled'):
+        offenses_to_jira_logger.info("JIRA is unavailable. Ticket of offense with ID %s spooled, it will be created once JIRA recovers", offense_id, extra=SAMPLED_LOG)
+        metrics.offenses_processed.inc(1, "spooled")
+    else:
+        offenses_to_jira_logger.info("Ticket created succesfully on JIRA for offense with ID: %s", offense_id, extra=SAMPLED_LOG)
+        metrics.offenses_processed.inc(1, "created")
+    save_last_processed_id(offense_id)
+
+
+
+def commit_skipped_offenses() -> None:
+    """Moves the last processed ID up to the last fetched offense once no offense is in flight or waiting on a bulk batch: offenses of other shards are skipped without an upload.
+
+    :return: None
+    :rtype: None
+    :raises OSError: if an error occurs when writing the last processed ID file
+    """
+    if last_fetched_id is not None and last_fetched_id > last_processed_id and (jira_bulk_batcher is None or jira_bulk_batcher.is_empty()):
+        save_last_processed_id(last_fetched_id)
+
+
+
+def commit_upload_outcomes(outcomes:List[Tuple[int,any]]) -> None:
+    """Commits the outcomes of finished uploads in offense ID order, and then the skipped offenses (used by the asyncio runtime, from a worker thread).
+
+    :param List[Tuple[int,any]] outcomes: List of (offense ID, outcome of the offense), sorted by offense ID.
+    :return: None
+    :rtype: None
+    """
+    for offense_id, outcome in outcomes:
+        commit_upload_outcome(offense_id, outcome)
+    commit_skipped_offenses()
+
+
+
+def commit_finished_uploads() -> None:
+    """Waits for the submitted uploads and updates the file containing the last processed ID in ID order.
+    It only moves past an offense once every lower offense ID has been uploaded or stored on the failed offenses store, so a crash never skips an offense.
+
+    :return: None
+    :rtype: None
+    """
+    while pending_uploads:
+        offense_id, upload = pending_uploads[0]
+        try:
+            outcome = upload.result()[offense_id]
+        except Exception as e:
+            outcome = e
+        commit_upload_outcome(offense_id, outcome)
+        pending_uploads.popleft()
+    commit_skipped_offenses()
+
+
+
+def flush_jira_bulk_batch() -> None:
+    """Uploads the offenses still waiting on the JIRA bulk batcher on the calling thread and commits them, so a shutdown does not leave them behind.
+    Called on shutdown, before the last processed ID is saved. The JIRA upload worker pool is already shut down by then, so the uploads still pending on it are finished.
+
+    :return: None
+    :rtype: None"""
+    pending_bulk_upload = get_pending_bulk_upload()
+    if pending_bulk_upload is None:
+        return
+    try:
+        outcomes = run_offense_upload(pending_bulk_upload)
+    except Exception as e:
+        outcomes = {offense.get('id'): e for offense in pending_bulk_upload[1]}
+    try:
+        commit_finished_uploads()
+        commit_upload_outcomes([(offense.get('id'), outcomes[offense.get('id')]) for offense in pending_bulk_upload[1]])
+    except Exception as e:
+        offenses_to_jira_logger.error(f"Error committing the JIRA bulk batch on shutdown: {str(e)}")
+
+
+
+def load_watermarks() -> None:
+    """Loads the last processed offense ID on the first polling cycle, and moves the last fetched offense ID up to it.
+
+    :return: None
+    :rtype: None
+    :raises Exception: if the file does not provide a minimum offense ID"""
+    global last_processed_id, last_fetched_id
+    if last_processed_id is None:
+        last_processed_id = load_last_processed_id()
     if not last_processed_id:
         raise Exception("ERROR! Provide a minimum Offense ID on the Offense ID index File!")
-    
-    offenses_to_jira_logger.info("Last processed Offense ID stored on memory file: " + str(last_processed_id) + " . Getting offense from QRADAR SIEM...")
-    latest_offense = get_latest_offenses()
-    offenses_to_jira_logger.info("Call succesfully made to QRADAR SIEM...")
-    offenses_to_jira_logger.debug("Offense to process and send to JIRA: " + json.dumps(latest_offense))
-    # Sort offenses by ID in ascending order
-    #latest_offense.sort(key=lambda x: x.get('id',None))
-
-    if (not latest_offense or len(latest_offense) == 0):
-        offenses_to_jira_logger.info("No offenses obtained from QRADAR SIEM.")
-    #For the first offense obtained, create the jira ticked and update the file containing the last processed ID.
-    for offense in latest_offense:
+    last_fetched_id = max(last_fetched_id or 0, last_processed_id)
+
+
+
+def select_new_offenses(offenses:List[Dict[any,any]]) -> Tuple[List[Dict[any,any]],int]:
+    """Selects the offenses to upload of a page: the ones after the last fetched offense that belong to the shard of this instance.
+    The last fetched offense ID is not moved here: the caller moves it with advance_last_fetched_id once the uploads are queued, so the skipped offenses are never committed past an offense that was not uploaded.
+
+    :param List[Dict[any,any]] offenses: Offenses obtained from QRADAR SIEM, sorted by ID.
+    :return: The new offenses of this shard, sorted by ID, and the last fetched offense ID once the page is processed.
+    :rtype: Tuple[List[Dict[any,any]],int]"""
+    global newest_offense_id
+    fetched_id = last_fetched_id
+    new_offenses = []
+    for offense in offenses:
         offense_id = offense.get('id', None)
-        if last_processed_id is not None and offense_id > last_processed_id:
-            offenses_to_jira_logger.info(f"Processing offense with ID. About to create ticket on JIRA!: {offense_id}")
-            try:
-                #create_jira_ticket(offense)
-                save_last_processed_id(offense_id)
-                pass
-            except Exception as e:
-                offenses_to_jira_logger.error(f"Exception creating JIRA ticket for offense with ID: {str(offense_id)}: {str(e)}")
-                save_failed_offense_update_on_jira(offense_id) #store the failed offense to be uploaded to jira in a file
-            break #Process only one offense at a time
+        if offense_id is not None and (newest_offense_id is None or offense_id > newest_offense_id):
+            newest_offense_id = offense_id #Keeps the watermark lag metric current between probes
+        offenses_to_jira_logger.debug("Offense to process and send to JIRA: %s", LazyJson(offense), extra=SAMPLED_LOG)
+        if fetched_id is not None and offense_id > fetched_id:
+            fetched_id = offense_id
+            if not offense_in_shard(offense_id):
+                offenses_to_jira_logger.debug("Offense %s belongs to another shard. Skipping it.", offense_id, extra=SAMPLED_LOG)
+                continue
+            offenses_to_jira_logger.info("Processing offense with ID. About to create ticket on JIRA!: %s", offense_id, extra=SAMPLED_LOG)
+            new_offenses.append(offense)
         else:
             offenses_to_jira_logger.error(f"Offense {offense_id} has already been processed. Please, increase the Offense ID offset on the file to start scanning new offenses!.")
+    return new_offenses, fetched_id
+
+
+
+def advance_last_fetched_id(offense_id:int) -> None:
+    """Moves the last fetched offense ID up to the given offense, once the uploads of the offenses up to it are queued.
+
+    :param int offense_id: The last fetched offense ID returned by select_new_offenses.
+    :return: None
+    :rtype: None"""
+    global last_fetched_id
+    if offense_id is not None and (last_fetched_id is None or offense_id > last_fetched_id):
+        last_fetched_id = offense_id
+
+
+
+def process_offenses_page(latest_offenses: Iterable[Dict[any,any]]) -> int:
+    """Creates a JIRA ticket for every offense in the page using the JIRA upload worker pool, one request per offense, bulk requests or one request per group of correlated offenses, as configured.
+    Offenses waiting on a bulk batch that is not full yet are uploaded on a later page or polling cycle.
+    The page is consumed in groups of address_lookup_chunk_size offenses, so it can be streamed from QRADAR while the addresses of every group are still resolved at once.
+
+    :param Iterable[Dict[any,any]] latest_offenses: Page of offenses obtained from QRADAR SIEM (a list or a stream), sorted by ID.
+    :return: Number of offenses in the page.
+    :rtype: int
+    """
+    offenses_count = 0
+    latest_offenses = iter(latest_offenses)
+    while True:
+        offenses_group = list(islice(latest_offenses, config.address_lookup_chunk_size))
+        if not offenses_group:
+            break
+        offenses_count += len(offenses_group)
+        if jira_bulk_batcher is None:
+            try:
+                resolve_offenses_addresses(offenses_group) #Warms the address IPs cache with one lookup per addresses endpoint for the whole group, instead of one per offense
+            except Exception as e:
+                offenses_to_jira_logger.warning(f"Error resolving the addresses of the offenses page: {str(e)}. They will be resolved on every ticket creation.")
+        new_offenses, fetched_id = select_new_offenses(offenses_group)
+        submit_offense_uploads(get_offense_uploads(new_offenses))
+        advance_last_fetched_id(fetched_id)
+
+    commit_finished_uploads()
+    return offenses_count
+
+
+
+def process_offense() -> float:
+    """Process the unprocessed offenses and create a JIRA ticket for each of them.
+    If drain mode is enabled, pages of offenses are requested until QRADAR returns a page that is not full (no more new offenses).
+    Otherwise, only one page is processed. A JIRA bulk batch that is not full is uploaded once it has waited more than the max linger time.
+    With adaptive polling, while QRADAR is idle the pages are only requested once a cheap probe finds new offenses.
+
+    :return: Seconds to wait before the next polling cycle.
+    :rtype: float"""
+    load_watermarks()
+    
+    offenses_count = 0
+    page_full = False
+    if should_probe_new_offenses() and not has_new_offenses():
+        offenses_to_jira_logger.info("No new offenses on QRADAR SIEM (probe).")
+    else:
+        while True:
+            offenses_to_jira_logger.info("Last processed Offense ID stored on memory file: " + str(last_processed_id) + " . Getting offenses from QRADAR SIEM...")
+            latest_offenses = get_latest_offenses(config.offenses_page_size)
+            page_count = process_offenses_page(latest_offenses)
+            offenses_count += page_count
+            page_full = page_count >= config.offenses_page_size
+            offenses_to_jira_logger.info(f"Call succesfully made to QRADAR SIEM. {page_count} offenses obtained.")
+
+            if page_count == 0:
+                offenses_to_jira_logger.info("No offenses obtained from QRADAR SIEM.")
+                break
+
+            if not config.drain_mode_enabled or not page_full:
+                break
+
+    expired_bulk_upload = get_expired_bulk_upload()
+    if expired_bulk_upload:
+        submit_offense_uploads([expired_bulk_upload])
+        commit_finished_uploads()
+    last_processed_id_checkpoint.flush_if_due()
+    refresh_newest_offense_id()
+    return get_next_polling_interval(offenses_count, page_full)
+
+def apply_reloaded_config(reloaded_config:ServerConfig) -> None:
+    '''Applies a reloaded configuration to the last processed ID checkpoint, the JIRA bulk batcher and the adaptive polling scheduler. Pending offenses and uploads are kept.
+
+    :param ServerConfig reloaded_config: Configuration updated by the config reload
+    :return: None
+    :rtype: None
+    '''
+    last_processed_id_checkpoint.flush_every = reloaded_config.checkpoint_flush_every
+    last_processed_id_checkpoint.flush_interval = reloaded_config.checkpoint_flush_interval
+    if jira_bulk_batcher is not None:
+        jira_bulk_batcher.batch_size = min(reloaded_config.jira_bulk_batch_size, JIRA_BULK_MAX_ISSUES)
+        jira_bulk_batcher.max_linger_seconds = reloaded_config.jira_bulk_max_linger
+    if polling_scheduler is not None:
+        polling_scheduler.reconfigure(reloaded_config.polling_rate_new_offenses_checking, reloaded_config.max_polling_rate_new_offenses_checking, reloaded_config.polling_backoff_factor)
 
-def init_vars(passedconfig: ServerConfig):
+def init_vars(passedconfig: ServerConfig, jira_spool_enabled:bool = True):
     '''
     Initializates variables for the script
 
     :param int passedconfig: Configuration received from the config.ini file
+    :param bool jira_spool_enabled: If false, offenses are not spooled while the JIRA circuit breaker is open (they fail right away instead)
     :return: None
     :rtype: None
     '''
     global config
     config = passedconfig
-    global qradar_headers
-    qradar_headers = {'SEC': config.qradar_api_key, 'Accept': 'application/json'}
-    global jira_auth
-    jira_auth = (config.jira_user, config.jira_api_token)
+    init_http_clients(config)
+    init_address_resolver(config)
+    init_jira_uploads(config)
+    global last_processed_id_checkpoint
+    last_processed_id_checkpoint = Checkpoint(config.last_processed_id_file, config.checkpoint_flush_every, config.checkpoint_flush_interval)
+    global hooks_registered
+    if not hooks_registered:
+        hooks_registered = True
+        atexit.register(flush_last_processed_id)
+        atexit.register(flush_jira_bulk_batch) #Exit hooks run in reverse order, so the batch is committed before the last processed ID is saved
+        on_config_reload(apply_reloaded_config)
+    global failed_offenses_store
+    failed_offenses_store = init_failed_offenses_store(config)
+    global offense_issue_index
+    offense_issue_index = init_offense_issue_index(config)
+    global jira_spool
+    if config.circuit_breaker_enabled and jira_spool_enabled:
+        jira_spool = init_jira_spool(config)
+    global jira_upload_executor
+    jira_upload_executor = ThreadPoolExecutor(max_workers=config.jira_upload_workers, thread_name_prefix="jira_upload_worker")
+    global jira_bulk_batcher
+    if config.jira_bulk_enabled and not config.coalescing_enabled:
+        jira_bulk_batcher = JiraBulkBatcher(config.jira_bulk_batch_size, config.jira_bulk_max_linger)
+    global polling_scheduler
+    if config.adaptive_polling_enabled:
+        polling_scheduler = AdaptivePollingScheduler(config.polling_rate_new_offenses_checking, config.max_polling_rate_new_offenses_checking, config.polling_backoff_factor)
+        metrics.register(metrics.Gauge("qradar2jira_polling_interval_seconds", "Seconds to wait before the next poll of new offenses, set by the adaptive polling scheduler.", callback=lambda: polling_scheduler.interval))
+    metrics.register(metrics.Gauge("qradar2jira_last_processed_offense_id", "Last processed offense ID (watermark).", callback=lambda: last_processed_id))
+    metrics.register(metrics.Gauge("qradar2jira_watermark_lag_offenses", "Newest open offense ID on QRADAR minus the last processed offense ID.", callback=get_watermark_lag))
 
 def main(passedconfig: ServerConfig):
     
@@ -156,11 +576,13 @@ def main(passedconfig: ServerConfig):
 
     """Main loop to continuously check for new offenses and process them."""
     while True:
+        metrics.heartbeat("offenses_to_jira")
+        polling_interval = config.polling_rate_new_offenses_checking
         try:
-            process_offense()
+            polling_interval = process_offense()
         except Exception as e:
             offenses_to_jira_logger.error(f"Error pulling and/or sending tickets to JIRA from QRADAR SIEM Offenses obtention: {str(e)}")
-        time.sleep(config.polling_rate_new_offenses_checking)
+        metrics.sleep_with_heartbeat("offenses_to_jira", polling_interval)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
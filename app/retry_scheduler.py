@@ -0,0 +1,108 @@
+import heapq
+import random
+import threading
+import time
+from typing import Dict, List, Tuple
+
+class RetryScheduler:
+    '''Timer heap with the next attempt time of every failed offense. Each offense has its own exponential backoff with jitter, so an offense is retried as soon as it is due instead of on a global sweep.'''
+
+    def __init__(self, base_delay:int, max_delay:int):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.heap: List[Tuple[float,int]] = []
+        self.scheduled_times: Dict[int,float] = {} #Latest scheduled time of every offense. Older heap entries of the offense are skipped when popped
+        self.lock = threading.Lock()
+
+    def reconfigure(self, base_delay:int, max_delay:int) -> None:
+        '''Applies a new backoff to the next computed attempt times (on a config reload). Attempts already scheduled are kept.
+
+        :param int base_delay: Seconds to wait before the first retry of an offense.
+        :param int max_delay: Maximum seconds between two retries of an offense.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.base_delay = base_delay
+            self.max_delay = max_delay
+
+    def compute_next_attempt_time(self, attempts:int, now:float = None) -> float:
+        '''Computes when an offense that already failed the given number of attempts should be retried: base_delay * 2^(attempts - 1), capped to max_delay, with a random jitter between half and the whole delay so retries of offenses that failed together are spread.
+
+        :param int attempts: Number of failed attempts of the offense (at least 1).
+        :param float now: Current epoch time. Defaults to time.time().
+        :return: Epoch time of the next attempt.
+        :rtype: float
+        '''
+        now = time.time() if now is None else now
+        delay = min(self.max_delay, self.base_delay * (2 ** max(attempts - 1, 0)))
+        return now + random.uniform(delay / 2, delay)
+
+    def schedule(self, offense_id:int, next_attempt_time:float) -> None:
+        '''Schedules (or reschedules) the next attempt of an offense.
+
+        :param int offense_id: ID of the failed offense.
+        :param float next_attempt_time: Epoch time of the next attempt.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.scheduled_times[offense_id] = next_attempt_time
+            heapq.heappush(self.heap, (next_attempt_time, offense_id))
+
+    def unschedule(self, offense_id:int) -> None:
+        '''Removes an offense from the scheduler. Its heap entries are discarded lazily.
+
+        :param int offense_id: ID of the offense.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.scheduled_times.pop(offense_id, None)
+
+    def merge(self, scheduled_offenses:List[Tuple[int,float]]) -> None:
+        '''Replaces every scheduled offense with the given ones. Offenses that were already scheduled keep their scheduled time, so an attempt that was postponed is not moved back.
+
+        :param List[Tuple[int,float]] scheduled_offenses: (offense ID, next attempt time) of every offense to schedule.
+        :return: None
+        :rtype: None
+        '''
+        with self.lock:
+            self.scheduled_times = {offense_id: self.scheduled_times.get(offense_id, next_attempt_time) for offense_id, next_attempt_time in scheduled_offenses}
+            self.heap = [(next_attempt_time, offense_id) for offense_id, next_attempt_time in self.scheduled_times.items()]
+            heapq.heapify(self.heap)
+
+    def pop_due(self, now:float = None) -> List[int]:
+        '''Removes and returns every offense whose next attempt time has been reached.
+
+        :param float now: Current epoch time. Defaults to time.time().
+        :return: IDs of the due offenses, oldest due first.
+        :rtype: List[int]
+        '''
+        now = time.time() if now is None else now
+        due_offense_ids = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                next_attempt_time, offense_id = heapq.heappop(self.heap)
+                if self.scheduled_times.get(offense_id) == next_attempt_time:
+                    del self.scheduled_times[offense_id]
+                    due_offense_ids.append(offense_id)
+        return due_offense_ids
+
+    def seconds_until_next(self, now:float = None) -> float:
+        '''Returns the seconds left until the next scheduled attempt.
+
+        :param float now: Current epoch time. Defaults to time.time().
+        :return: Seconds until the next attempt (0 if already due), or None if nothing is scheduled.
+        :rtype: float
+        '''
+        now = time.time() if now is None else now
+        with self.lock:
+            while self.heap and self.scheduled_times.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return None
+            return max(0, self.heap[0][0] - now)
+
+    def __len__(self):
+        return len(self.scheduled_times)
@@ -1,134 +1,243 @@
-import requests
 import time
-import os
-import json
-from typing import Dict
-from app_config import ServerConfig, failed_offenses_to_jira_retries_logger
+from typing import Dict, List
+from app_config import SAMPLED_LOG, LazyJson, ServerConfig, failed_offenses_to_jira_retries_logger, on_config_reload
+from http_client import get_jira_circuit_wait, init_http_clients, qradar_get
+from address_resolver import init_address_resolver
+from failed_offenses_store import FailedOffensesStore, init_failed_offenses_store
+from offense_coalescing import get_offense_fields
+from offense_issue_index import OffenseAlreadyClaimedError, OffenseIssueIndex, init_offense_issue_index
+from jira_circuit_breaker import JiraCircuitOpenError
+from jira_uploads import init_jira_uploads, run_upload_steps, upload_offense_steps
+from retry_scheduler import RetryScheduler
+import metrics
+
+NEW_FAILED_OFFENSES_COALESCING_SECONDS = 1 #Time to wait after being notified of a new failed offense before scheduling it, so offenses failing together are scheduled at once
+CLAIMED_OFFENSE_RETRY_SECONDS = 5 #Time to wait before retrying a failed offense that was being uploaded by another thread
 
-qradar_headers = {'SEC': None, 'Accept': 'application/json'} #Headers for QRadar API. Paritally obtained from config.ini file
-failed_offenses_ids_list = [] #do not edit! Used to temporary store in memory the failed offenses IDs obtained from the file
 config: ServerConfig = None
-jira_auth = ()
-
-def load_failed_ids_from_file() -> str:
-    """Load the ids of the failed offenses from the failed offenses file.
+failed_offenses_store: FailedOffensesStore = None #Store shared with the new offenses thread. Created on init_vars
+offense_issue_index: OffenseIssueIndex = None #Offense to JIRA issue index shared with the new offenses thread. Created on init_vars
+retry_scheduler: RetryScheduler = None #Timer heap with the next attempt time of every failed offense. Created on init_vars
+hooks_registered: bool = False #The config reload hook is registered by the first init_vars call only
+last_store_load_time: float = 0 #Monotonic time of the last load of the failed offenses store into the scheduler
+
+def remove_offense_from_failed_offenses_store(offense_id:int) -> None:
+    """Remove the offense ID from the failed offenses store.
     
-    :return: A string of the content in the file
-    :rtype: Str
-    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/reading the file
+    :param int offense_id: The ID of the offense to remove from the store.
+    :return: Nothing
+    :rtype: None
+    :raises sqlite3.Error: if an error occurs when deleting the offense from the store
     """
-    if os.path.exists(config.failed_processed_id_file):
-        with open(config.failed_processed_id_file, 'r') as file:
-            return (file.read().strip())
-    return None
+    failed_offenses_store.remove(offense_id)
+    retry_scheduler.unschedule(offense_id)
+    failed_offenses_to_jira_retries_logger.info(f"Deleted succcesfully offense ID from the failed offenses store with ID {str(offense_id)}")
 
 
 
-def remove_offense_id_from_failed_offenses_file(offense_id:int) -> None:
-    """Remove the offense Id from the failed offense file and from memory and rewrites the file with the failed missing offenses (if any)
+def remove_offenses_from_failed_offenses_store(offense_ids:List[int]) -> None:
+    """Remove several offense IDs from the failed offenses store at once.
     
-    :param int offense_id: The ID of the offense to remove from the file and memory.
+    :param List[int] offense_ids: The IDs of the offenses to remove from the store.
     :return: Nothing
     :rtype: None
-    :raises OSError,FileNotFoundError,ValueError: if an error occurs when opening/editing the file
+    :raises sqlite3.Error: if an error occurs when deleting the offenses from the store
     """
-    global failed_offenses_ids_list
+    failed_offenses_store.remove_many(offense_ids)
+    for offense_id in offense_ids:
+        retry_scheduler.unschedule(offense_id)
+    failed_offenses_to_jira_retries_logger.info(f"Deleted succcesfully {len(offense_ids)} offense IDs from the failed offenses store: {offense_ids}")
 
-    try:
-        failed_offenses_ids_list.remove(offense_id)
-    except:
-        failed_offenses_to_jira_retries_logger.warn("Error removing failed offense ID from file. The offense ID did not exist on the file. Was the file manipulated by a user?.")
-    
-    failed_offenses_ids_as_string = [str(id) for id in failed_offenses_ids_list]
-    comma_separated_string_of_failed_offense_ids = ",".join(failed_offenses_ids_as_string)
 
-    with open(config.failed_processed_id_file, 'w') as file:
-        if comma_separated_string_of_failed_offense_ids:
-            file.write(comma_separated_string_of_failed_offense_ids)
-        else:
-            file.write("")
 
-    failed_offenses_to_jira_retries_logger.info(f"Deleted succcesfully offense ID from the failed offenses file with ID {str(offense_id)}")
+def record_failed_retry(offense_id:int, error:str) -> None:
+    """Records on the failed offenses store that the offense failed again and schedules its next attempt with an exponential backoff.
+    If the offense reached the max retry attempts, it is moved to the dead letter state and is not retried anymore.
+
+    :param int offense_id: The ID of the offense that failed again.
+    :param str error: Error obtained when retrying the offense.
+    :return: Nothing
+    :rtype: None
+    :raises sqlite3.Error: if an error occurs when updating the store
+    """
+    failed_offense = failed_offenses_store.get(offense_id)
+    attempts = (failed_offense.attempts if failed_offense else 0) + 1
+    if attempts >= config.retry_max_attempts:
+        failed_offenses_store.mark_dead_letter(offense_id, error)
+        retry_scheduler.unschedule(offense_id)
+        failed_offenses_to_jira_retries_logger.error(f"Offense {offense_id} failed {attempts} times. Moving it to the dead letter state. It will not be retried anymore.")
+        metrics.retry_attempts.inc(1, "dead_letter")
+        return
+    next_attempt_time = retry_scheduler.compute_next_attempt_time(attempts)
+    failed_offenses_store.record_attempt(offense_id, error, next_attempt_time)
+    retry_scheduler.schedule(offense_id, next_attempt_time)
+    metrics.retry_attempts.inc(1, "failed")
+    failed_offenses_to_jira_retries_logger.info(f"Offense {offense_id} failed {attempts} times. Retrying it in {int(next_attempt_time - time.time())} seconds.")
+
+
+
+def postpone_failed_retry(offense_id:int, error:JiraCircuitOpenError) -> None:
+    """Schedules again an offense that was not retried because the JIRA circuit breaker is open, without counting it as a failed attempt.
+
+    :param int offense_id: The ID of the offense that was not retried.
+    :param JiraCircuitOpenError error: Error raised by the JIRA circuit breaker.
+    :return: Nothing
+    :rtype: None
+    """
+    retry_scheduler.schedule(offense_id, time.time() + max(error.seconds_until_probe, 1))
+    failed_offenses_to_jira_retries_logger.info(f"JIRA is unavailable (circuit breaker open). Offense {offense_id} will be retried once JIRA recovers.")
 
 
 
-def get_offense(offense_id: int)-> Dict[any,any]: 
-    """Retrieve an offense from QRADAR.
+def reschedule_claimed_offense(offense_id:int) -> None:
+    """Schedules again an offense that was not retried because another thread or coroutine was uploading it, without counting it as a failed attempt.
 
-    :param int offense_id: The ID of the offense to get it's data from QRADAR.
-    :return: The json response from obtaining the offense.
-    :rtype: Dict[any,any]
-    :raises HttpError: if an error occurs obtaining the offense info
+    :param int offense_id: The ID of the offense that was not retried.
+    :return: Nothing
+    :rtype: None
     """
-    global qradar_headers
-    qradar_headers = qradar_headers.copy()
-    qradar_headers["VERSION"] = "20.0"
-    response = requests.get(config.qradar_url + "/" + str(offense_id), headers=qradar_headers, verify=False)
-    response.raise_for_status()
-    return response.json()
+    retry_scheduler.schedule(offense_id, time.time() + CLAIMED_OFFENSE_RETRY_SECONDS)
+    failed_offenses_to_jira_retries_logger.warning(f"Offense {offense_id} is being uploaded to JIRA by another thread right now. Retrying it in {CLAIMED_OFFENSE_RETRY_SECONDS} seconds.")
+
+
+
+def load_failed_offenses_into_scheduler() -> None:
+    """Loads every pending offense of the failed offenses store into the retry scheduler, with its next attempt time. Offenses already scheduled keep their scheduled time.
+
+    :return: Nothing
+    :rtype: None
+    :raises sqlite3.Error: if an error occurs when reading the store
+    """
+    global last_store_load_time
+    failed_offenses_store.take_new_offenses()
+    retry_scheduler.merge([(failed_offense.offense_id, failed_offense.next_attempt_time) for failed_offense in failed_offenses_store.get_all()])
+    last_store_load_time = time.monotonic()
+    failed_offenses_to_jira_retries_logger.debug(f"Failed offenses store loaded. {len(retry_scheduler)} offenses scheduled for retrying.")
+
+
+
+def schedule_new_failed_offenses() -> None:
+    """Schedules the offenses added to the failed offenses store since the last check, without reloading the rest of the store.
+
+    :return: Nothing
+    :rtype: None
+    """
+    for offense_id, next_attempt_time in failed_offenses_store.take_new_offenses():
+        retry_scheduler.schedule(offense_id, next_attempt_time)
 
 
 
-def create_jira_ticket(offense) -> Dict[any,any]:
-    """Create a new JIRA ticket for the given offense.
+def refresh_scheduler_if_needed() -> None:
+    """Schedules the new failed offenses, or reloads the whole failed offenses store into the retry scheduler once the store scan interval is reached (to pick up offenses stored by other processes, like a backfill).
 
-    :param Dict[any,any] offense: The offense obtained from QRADAR SIEM
-    :return: The json response from creating the JIRA ticket
-    :rtype: Dict[any,any]
-    :raises HttpError: if an error occurs creating the ticket
+    :return: Nothing
+    :rtype: None
     """
+    if time.monotonic() - last_store_load_time >= config.polling_rate_offenses_failure_reuploading:
+        load_failed_offenses_into_scheduler()
+    elif failed_offenses_store.new_offense_event.is_set():
+        schedule_new_failed_offenses()
+
+
 
-    issue_data = {
-        "fields": {
-            "project": {
-                "key": config.jira_project_key
-            },
-            "summary": f"QRadar Offense {offense['id']}: {offense['description']}",
-            "description": (
-                f"Offense ID: {offense['id']}\n"
-                f"Offense Description: {offense['description']}\n"
-                f"Offense Type: {offense['offense_type']}\n"
-                f"Source IPs: {', '.join(offense.get('source_address_ids', []))}\n"
-                f"Destination IPs: {', '.join(offense.get('destination_address_ids', []))}\n"
-                f"Start Time: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(offense['start_time'] / 1000))}\n"
-                f"Last Updated: {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(offense['last_updated_time'] / 1000))}\n"
-            ),
-            "issuetype": {
-                "name": "Task"
-            }
-        }
-    }
-
-    response = requests.post(config.jira_url, json=issue_data, auth=jira_auth)
+def wait_for_next_retry() -> None:
+    """Blocks until the next failed offense is due, a new failed offense is added to the store or the store scan interval is reached. A heartbeat is recorded while waiting.
+
+    :return: Nothing
+    :rtype: None
+    """
+    seconds_until_next_retry = retry_scheduler.seconds_until_next()
+    timeout = config.polling_rate_offenses_failure_reuploading if seconds_until_next_retry is None else min(seconds_until_next_retry, config.polling_rate_offenses_failure_reuploading)
+    deadline = time.time() + timeout
+    while True:
+        metrics.heartbeat("failed_offenses_to_jira")
+        remaining_seconds = deadline - time.time()
+        if remaining_seconds <= 0:
+            return
+        if failed_offenses_store.new_offense_event.wait(min(remaining_seconds, metrics.HEARTBEAT_INTERVAL_SECONDS)):
+            time.sleep(NEW_FAILED_OFFENSES_COALESCING_SECONDS)
+            return
+
+
+
+def get_open_offenses(offense_ids: List[int]) -> Dict[int,Dict[any,any]]:
+    """Retrieve the open offenses of a chunk of offense IDs from QRADAR with a single filtered call, limited to the fields requested for the new offenses.
+
+    :param List[int] offense_ids: The IDs of the offenses to get their data from QRADAR.
+    :return: Dictionary with the offense ID as key and the offense as value. Closed or non-existent offenses are not on it.
+    :rtype: Dict[int,Dict[any,any]]
+    :raises HttpError: if an error occurs obtaining the offenses info
+    """
+    params = { "filter": f"status=OPEN and id in ({','.join(str(offense_id) for offense_id in offense_ids)})", "fields": get_offense_fields(config) }
+    response = qradar_get(config.qradar_url, params=params, headers={"RANGE": f"items=0-{len(offense_ids) - 1}"})
     response.raise_for_status()
-    return response.json()
+    return {offense.get('id'): offense for offense in response.json()}
 
 
 
-def process_offense(offense_id: int) -> None:
-    """Process the next unprocessed offense and create a JIRA ticket for it.
+def process_offense(latest_offense: Dict[any,any]) -> None:
+    """Create a JIRA ticket for a previously failed offense with the upload logic of the new offenses, removing it from the failed offenses store on success.
 
-    :param int offense_id: Receives the Offense ID of the offense to upload to JIRA 
+    :param Dict[any,any] latest_offense: Receives the open offense obtained from QRADAR to upload to JIRA 
     :return: None
     :rtype: None
     """
-    failed_offenses_to_jira_retries_logger.info("Processing and sending to JIRA the old failed-to-upload offense_id to JIRA with ID: " + str(offense_id))
-    latest_offense = get_offense(offense_id)
-    failed_offenses_to_jira_retries_logger.debug("Offense obtained from QRADAR SIEM: " + json.dumps(latest_offense))
-
-    if latest_offense and latest_offense.get("status", None) == "OPEN":
-        offense_id = latest_offense.get('id',None)
-        failed_offenses_to_jira_retries_logger.info(f"Processing offense with ID. About to create ticket on JIRA!: {str(offense_id)}")
-        try:
-            #create_jira_ticket(offense)
-            failed_offenses_to_jira_retries_logger.info(f"Ticket created succesfully for offense with ID: " + str(offense_id) + " . Proceeding to delete the ID of the offense from the failed offenses file.")
-            remove_offense_id_from_failed_offenses_file(offense_id)
-            pass
-        except Exception as e:
-            failed_offenses_to_jira_retries_logger.error(f"Error creating ticket on JIRA for offense with id {offense_id} . Error: {str(e)}" )
-    else:
-        failed_offenses_to_jira_retries_logger.warning(f"Offense {offense_id} is closed or non-existent in QRADAR. Removing the offense ID from the file.")
-        remove_offense_id_from_failed_offenses_file(offense_id)
+    offense_id = latest_offense.get('id',None)
+    failed_offenses_to_jira_retries_logger.debug("Offense obtained from QRADAR SIEM: %s", LazyJson(latest_offense), extra=SAMPLED_LOG)
+    failed_offenses_to_jira_retries_logger.info("Processing offense with ID. About to create ticket on JIRA!: %s", offense_id, extra=SAMPLED_LOG)
+    try:
+        run_upload_steps(upload_offense_steps(latest_offense, None, failed_offenses_to_jira_retries_logger))
+    except OffenseAlreadyClaimedError:
+        reschedule_claimed_offense(offense_id)
+        return
+    except JiraCircuitOpenError as e:
+        postpone_failed_retry(offense_id, e)
+        return
+    except Exception as e:
+        failed_offenses_to_jira_retries_logger.error(f"Error creating ticket on JIRA for offense with id {offense_id} . Error: {str(e)}" )
+        record_failed_retry(offense_id, str(e))
+        return
+    failed_offenses_to_jira_retries_logger.info("Ticket created succesfully for offense with ID: %s . Proceeding to delete the ID of the offense from the failed offenses store.", offense_id, extra=SAMPLED_LOG)
+    metrics.retry_attempts.inc(1, "created")
+    remove_offense_from_failed_offenses_store(offense_id)
+
+
+
+def get_open_offenses_and_prune(offense_ids: List[int]) -> List[Dict[any,any]]:
+    """Retrieves a chunk of failed offenses from QRADAR with a single call and removes at once from the failed offenses store the ones that are closed or non-existent.
+    Offenses that already have a JIRA issue on the offense issue index are removed from the store without looking them up.
+
+    :param List[int] offense_ids: Receives the Offense IDs of the chunk
+    :return: The open offenses of the chunk, to be uploaded to JIRA
+    :rtype: List[Dict[any,any]]
+    :raises HttpError: if an error occurs obtaining the offenses info
+    """
+    failed_offenses_to_jira_retries_logger.info(f"Processing and sending to JIRA {len(offense_ids)} old failed-to-upload offenses with IDs: {offense_ids}")
+    jira_keys = offense_issue_index.get_jira_keys(offense_ids)
+    if jira_keys:
+        failed_offenses_to_jira_retries_logger.warning(f"Offenses {list(jira_keys)} already have a JIRA issue. Removing the offense IDs from the store.")
+        remove_offenses_from_failed_offenses_store(list(jira_keys))
+        offense_ids = [offense_id for offense_id in offense_ids if offense_id not in jira_keys]
+        if not offense_ids:
+            return []
+    open_offenses = get_open_offenses(offense_ids)
+    pruned_offense_ids = [offense_id for offense_id in offense_ids if offense_id not in open_offenses]
+    if pruned_offense_ids:
+        failed_offenses_to_jira_retries_logger.warning(f"Offenses {pruned_offense_ids} are closed or non-existent in QRADAR. Removing the offense IDs from the store.")
+        remove_offenses_from_failed_offenses_store(pruned_offense_ids)
+    return [open_offenses[offense_id] for offense_id in offense_ids if offense_id in open_offenses]
+
+
+
+def split_in_chunks(offense_ids: List[int]) -> List[List[int]]:
+    """Splits the offense IDs in chunks of the configured QRADAR lookup chunk size.
+
+    :param List[int] offense_ids: The offense IDs to split.
+    :return: The chunks of offense IDs.
+    :rtype: List[List[int]]
+    """
+    chunk_size = config.failed_offenses_lookup_chunk_size
+    return [offense_ids[start:start + chunk_size] for start in range(0, len(offense_ids), chunk_size)]
 
 
 def init_vars(passedconfig: ServerConfig):
@@ -141,49 +250,49 @@ def init_vars(passedconfig: ServerConfig):
     '''
     global config
     config = passedconfig
-    global qradar_headers
-    qradar_headers = {'SEC': config.qradar_api_key, 'Accept': 'application/json'}
-    global jira_auth
-    jira_auth = (config.jira_user, config.jira_api_token)
+    init_http_clients(config)
+    init_address_resolver(config)
+    init_jira_uploads(config)
+    global failed_offenses_store
+    failed_offenses_store = init_failed_offenses_store(config)
+    failed_offenses_store.track_new_offenses()
+    global offense_issue_index
+    offense_issue_index = init_offense_issue_index(config)
+    global retry_scheduler
+    retry_scheduler = RetryScheduler(config.retry_base_delay, config.retry_max_delay)
+    global hooks_registered
+    if not hooks_registered:
+        hooks_registered = True
+        on_config_reload(lambda reloaded_config: retry_scheduler.reconfigure(reloaded_config.retry_base_delay, reloaded_config.retry_max_delay))
+    metrics.register(metrics.Gauge("qradar2jira_failed_offenses", "Offenses on the failed offenses store, by state (pending or dead_letter).", ("state",),
+                                   callback=lambda: {("pending",): failed_offenses_store.count(), ("dead_letter",): failed_offenses_store.count(dead_letter=True)}))
 
-def safe_convert_offense_id(id_str):
-    try:
-        return int(id_str)
-    except ValueError:
-        return None
-    
 def main(passedconfig: ServerConfig):
     
     init_vars(passedconfig)
 
-    """Main loop to continuously check for failed offenses and try reuploading them to JIRA."""
+    """Main loop to retry every failed offense as soon as its next attempt is due."""
     while True:
-
-        ids_as_string = load_failed_ids_from_file().split(",")
-
-        missing_failed_offenses_mssg = "No failed offense IDs to upload to JIRA were found on the Failed Jira Offense Uploads File."
-        if (ids_as_string and len(ids_as_string) > 0):
-            global failed_offenses_ids_list
-
-            # Use a set to avoid duplicates
-            failed_offenses_ids_set = {
-                safe_convert_offense_id(id_str) for id_str in ids_as_string if id_str.strip() != ""
-            }
-
-            # Filter out None values and convert back to a list
-            failed_offenses_ids_list = [id for id in failed_offenses_ids_set if id is not None]
-    
-            if (len(failed_offenses_ids_list) > 0):
-                for id in failed_offenses_ids_list:
-                    try:
-                        process_offense(id)
-                    except Exception as e:
-                        failed_offenses_to_jira_retries_logger.error(f"Error pulling and/or sending previously failed offense to JIRA with ID: {e}. Advancing to next offense.")
-            else:
-                failed_offenses_to_jira_retries_logger.error(missing_failed_offenses_mssg)
-        else:
-            failed_offenses_to_jira_retries_logger.error(missing_failed_offenses_mssg)
-        time.sleep(config.polling_rate_offenses_failure_reuploading)
+        metrics.heartbeat("failed_offenses_to_jira")
+        try:
+            refresh_scheduler_if_needed()
+        except Exception as e:
+            failed_offenses_to_jira_retries_logger.error(f"Error loading the failed offenses store: {e}")
+        circuit_wait_seconds = get_jira_circuit_wait()
+        if circuit_wait_seconds > 0: #No failed offense is retried while the JIRA circuit breaker is open, so no attempt is wasted
+            metrics.sleep_with_heartbeat("failed_offenses_to_jira", min(circuit_wait_seconds, config.polling_rate_offenses_failure_reuploading))
+            continue
+        for offense_ids in split_in_chunks(retry_scheduler.pop_due()):
+            try:
+                open_offenses = get_open_offenses_and_prune(offense_ids)
+            except Exception as e:
+                failed_offenses_to_jira_retries_logger.error(f"Error pulling previously failed offenses from QRADAR with IDs {offense_ids}: {e}. Advancing to next chunk.")
+                for offense_id in offense_ids:
+                    record_failed_retry(offense_id, str(e))
+                continue
+            for open_offense in open_offenses:
+                process_offense(open_offense)
+        wait_for_next_retry()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,183 @@
+import atexit
+import os
+import socket
+import sqlite3
+import threading
+import time
+import app_config
+from app_config import ServerConfig, app_bootstrap_logger
+from checkpoint import write_file_atomically
+
+shard_index: int = None #Shard owned by this instance. None if sharding is disabled (the instance processes every offense)
+shard_count: int = 1
+
+class ShardLeaseStore:
+    '''Leases of the offense shards, stored on an SQLite database shared by every instance of the app (a local or shared folder is enough to coordinate them).
+    Every instance holds the lease of one shard and renews it periodically. If an instance dies, its lease expires and a standby instance takes its shard over.'''
+
+    def __init__(self, db_file:str, shard_count:int, lease_ttl:int):
+        self.shard_count = shard_count
+        self.lease_ttl = lease_ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None, timeout=lease_ttl)
+        with self.lock:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS shard_leases (
+                shard_index INTEGER PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_time REAL NOT NULL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS shard_settings (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL)''')
+            self.connection.execute("INSERT OR IGNORE INTO shard_settings (name, value) VALUES ('shard_count', ?)", (str(shard_count),))
+            stored_shard_count = int(self.connection.execute("SELECT value FROM shard_settings WHERE name = 'shard_count'").fetchone()[0])
+        if stored_shard_count != shard_count:
+            raise ValueError(f"shard_count is {shard_count} but the instances sharing {db_file} use {stored_shard_count}. Every instance must use the same shard_count."
+                             " To change it, stop every instance and delete the shard lease database.")
+
+    def try_acquire(self, owner:str) -> int:
+        '''Takes the lease of a shard that is free or whose lease expired. A shard already leased by the same owner (an instance restarted with the same instance ID) is taken back first.
+
+        :param str owner: ID of the instance.
+        :return: Index of the leased shard, or None if every shard is leased by a live instance.
+        :rtype: int
+        :raises sqlite3.Error: if an error occurs when accessing the database
+        '''
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                leases = {row[0]: (row[1], row[2]) for row in self.connection.execute("SELECT shard_index, owner, expires_time FROM shard_leases")}
+                candidates = [index for index in range(self.shard_count) if index in leases and leases[index][0] == owner]
+                candidates += [index for index in range(self.shard_count) if index not in leases or leases[index][1] < now]
+                if not candidates:
+                    self.connection.execute("COMMIT")
+                    return None
+                self.connection.execute("INSERT OR REPLACE INTO shard_leases (shard_index, owner, expires_time) VALUES (?, ?, ?)", (candidates[0], owner, now + self.lease_ttl))
+                self.connection.execute("COMMIT")
+                return candidates[0]
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def renew(self, shard_index:int, owner:str) -> bool:
+        '''Extends the lease of a shard.
+
+        :param int shard_index: Index of the leased shard.
+        :param str owner: ID of the instance.
+        :return: False if the lease was taken over by another instance.
+        :rtype: bool
+        :raises sqlite3.Error: if an error occurs when accessing the database
+        '''
+        with self.lock:
+            cursor = self.connection.execute("UPDATE shard_leases SET expires_time = ? WHERE shard_index = ? AND owner = ?", (time.time() + self.lease_ttl, shard_index, owner))
+            return cursor.rowcount == 1
+
+    def release(self, shard_index:int, owner:str) -> None:
+        '''Frees the lease of a shard, so a standby instance can take it over right away.
+
+        :param int shard_index: Index of the leased shard.
+        :param str owner: ID of the instance.
+        :return: None
+        :rtype: None
+        '''
+        try:
+            with self.lock:
+                self.connection.execute("UPDATE shard_leases SET expires_time = 0 WHERE shard_index = ? AND owner = ?", (shard_index, owner))
+        except sqlite3.Error as e:
+            app_bootstrap_logger.error(f"Error releasing the lease of shard {shard_index}: {str(e)}. It will be taken over once it expires.")
+
+def offense_in_shard(offense_id:int) -> bool:
+    '''Checks if an offense belongs to the shard owned by this instance (offense ID mod shard_count).
+
+    :param int offense_id: ID of the offense.
+    :return: True if this instance has to process the offense.
+    :rtype: bool
+    '''
+    return shard_index is None or offense_id % shard_count == shard_index
+
+def get_shard_file(file_path:str, index:int, count:int) -> str:
+    '''Returns the location of the per shard version of a file (for example, last_processed_id.shard0of4.txt).
+
+    :param str file_path: Location of the file without sharding.
+    :param int index: Index of the shard.
+    :param int count: Number of shards.
+    :return: Location of the file of the shard.
+    :rtype: str
+    '''
+    root, extension = os.path.splitext(file_path)
+    return f"{root}.shard{index}of{count}{extension}"
+
+def get_shard_watermark_file(file_path:str, index:int, count:int) -> str:
+    '''Returns the location of the per shard version of a watermark file. If it does not exist yet, it starts from the watermark of the file without sharding, so switching to sharded mode never reprocesses or skips offenses.
+
+    :param str file_path: Location of the watermark file without sharding.
+    :param int index: Index of the shard.
+    :param int count: Number of shards.
+    :return: Location of the watermark file of the shard.
+    :rtype: str
+    :raises OSError: if an error occurs when copying the watermark
+    '''
+    shard_file_path = get_shard_file(file_path, index, count)
+    if not os.path.exists(shard_file_path) and os.path.exists(file_path):
+        with open(file_path, 'r') as file:
+            watermark = file.read().strip()
+        if watermark:
+            write_file_atomically(shard_file_path, watermark)
+    return shard_file_path
+
+def keep_lease(lease_store:ShardLeaseStore, owner:str, lease_ttl:int) -> None:
+    '''Renews the lease of the owned shard every third of its TTL. If the lease is lost (taken over by another instance after a long pause, or not renewed in time), the process exits right away
+    without saving anything else, so two instances never process the same shard. The service manager is expected to restart it (it comes back as a standby instance).
+
+    :param ShardLeaseStore lease_store: Store of the shard leases.
+    :param str owner: ID of the instance.
+    :param int lease_ttl: Seconds a lease is valid without being renewed.
+    :return: None
+    :rtype: None
+    '''
+    last_renewal_time = time.time()
+    while True:
+        time.sleep(lease_ttl / 3)
+        try:
+            if lease_store.renew(shard_index, owner):
+                last_renewal_time = time.time()
+                continue
+            app_bootstrap_logger.critical(f"The lease of shard {shard_index} was taken over by another instance. Exiting.")
+        except sqlite3.Error as e:
+            if time.time() - last_renewal_time < lease_ttl:
+                app_bootstrap_logger.error(f"Error renewing the lease of shard {shard_index}: {str(e)}. Retrying.")
+                continue
+            app_bootstrap_logger.critical(f"The lease of shard {shard_index} could not be renewed before it expired: {str(e)}. Exiting.")
+        app_config.log_listener.stop()
+        os._exit(1)
+
+def init_sharding(config:ServerConfig) -> int:
+    '''If sharding is enabled, waits until this instance gets the lease of a shard (as a standby instance while every shard is leased), keeps the lease renewed on a daemon thread
+    and points the watermark files, the failed offenses store and the JIRA spool of the config to the ones of the shard. Must be called before starting the app threads.
+
+    :param ServerConfig config: Configuration received from the config.ini file
+    :return: Index of the owned shard, or None if sharding is disabled.
+    :rtype: int
+    :raises sqlite3.Error,ValueError: if the shard lease database cannot be used
+    '''
+    if not config.sharding_enabled:
+        return None
+    lease_store = ShardLeaseStore(config.shard_lease_file, config.shard_count, config.shard_lease_ttl)
+    owner = config.shard_instance_id or f"{socket.gethostname()}-{os.getpid()}"
+    acquired_shard_index = lease_store.try_acquire(owner)
+    while acquired_shard_index is None:
+        app_bootstrap_logger.info(f"Every one of the {config.shard_count} shards is leased by another instance. Waiting as standby instance {owner}...")
+        time.sleep(config.shard_lease_ttl / 3)
+        acquired_shard_index = lease_store.try_acquire(owner)
+
+    global shard_index, shard_count
+    shard_index = acquired_shard_index
+    shard_count = config.shard_count
+    config.last_processed_id_file = get_shard_watermark_file(config.last_processed_id_file, shard_index, shard_count)
+    config.last_updated_time_file = get_shard_watermark_file(config.last_updated_time_file, shard_index, shard_count)
+    config.failed_offenses_store_file = get_shard_file(config.failed_offenses_store_file, shard_index, shard_count)
+    config.jira_spool_file = get_shard_file(config.jira_spool_file, shard_index, shard_count)
+    atexit.register(lease_store.release, shard_index, owner)
+    threading.Thread(target=keep_lease, args=(lease_store, owner, config.shard_lease_ttl), name="shard_lease_keeper", daemon=True).start()
+    app_bootstrap_logger.info(f"Instance {owner} owns shard {shard_index} of {shard_count} (offenses with ID mod {shard_count} = {shard_index}). Last processed offense ID file: {config.last_processed_id_file}, failed offenses store: {config.failed_offenses_store_file}")
+    return shard_index
@@ -0,0 +1,237 @@
+import json
+import operator
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+FIRST_OFFENSE_ID = 1001 #ID of the first offense served by the fake QRADAR. The benchmark watermark starts right before it
+FILTER_TOKEN_PATTERN = re.compile(r"\s*(>=|<=|!=|[=<>(),]|[A-Za-z_]\w*|-?\d+)")
+FILTER_OPERATORS = {"=": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+def parse_filter_value(token:str) -> any:
+    return int(token) if re.fullmatch(r"-?\d+", token) else token
+
+def parse_filter(offense_filter:str) -> Callable[[Dict[any,any]], bool]:
+    '''Parses the subset of the QRADAR filter syntax used by the app (=, !=, <, <=, >, >=, in, and, or and parentheses) into a predicate on an offense.
+
+    :param str offense_filter: Value of the filter query parameter.
+    :return: Function returning True for the offenses matching the filter.
+    :rtype: Callable[[Dict[any,any]], bool]
+    '''
+    tokens = FILTER_TOKEN_PATTERN.findall(offense_filter)
+    position = 0
+
+    def peek() -> str:
+        return tokens[position].lower() if position < len(tokens) else None
+
+    def take() -> str:
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or() -> Callable[[Dict[any,any]], bool]:
+        predicates = [parse_and()]
+        while peek() == "or":
+            take()
+            predicates.append(parse_and())
+        return lambda offense: any(predicate(offense) for predicate in predicates)
+
+    def parse_and() -> Callable[[Dict[any,any]], bool]:
+        predicates = [parse_condition()]
+        while peek() == "and":
+            take()
+            predicates.append(parse_condition())
+        return lambda offense: all(predicate(offense) for predicate in predicates)
+
+    def parse_condition() -> Callable[[Dict[any,any]], bool]:
+        if peek() == "(":
+            take()
+            predicate = parse_or()
+            take() #Closing parenthesis
+            return predicate
+        field, condition = take(), take().lower()
+        if condition == "in":
+            take() #Opening parenthesis
+            values = set()
+            while peek() != ")":
+                token = take()
+                if token != ",":
+                    values.add(parse_filter_value(token))
+            take()
+            return lambda offense: offense.get(field) in values
+        value = parse_filter_value(take())
+        return lambda offense: FILTER_OPERATORS[condition](offense.get(field), value)
+
+    return parse_or() if tokens else lambda offense: True
+
+def sort_offenses(offenses:List[Dict[any,any]], sort:str) -> List[Dict[any,any]]:
+    '''Sorts the offenses by the comma separated fields of the sort query parameter, each one prefixed by + (ascending) or - (descending).'''
+    for sort_field in reversed([sort_field.strip() for sort_field in sort.split(",") if sort_field.strip()]):
+        field = sort_field.lstrip("+-")
+        offenses = sorted(offenses, key=lambda offense: offense.get(field), reverse=sort_field.startswith("-"))
+    return offenses
+
+class FakeQRadar:
+    '''Local stand-in of the QRADAR offenses and addresses API. Offenses become visible at a configurable arrival rate, so the end-to-end latency of every offense can be measured from the moment it appears.'''
+
+    def __init__(self, offenses_count:int, arrival_rate:float, latency:float, addresses_count:int):
+        self.offenses_count = offenses_count
+        self.arrival_rate = arrival_rate
+        self.latency = latency
+        self.start_time = None
+        self.requests_count = 0
+        self.lock = threading.Lock()
+        self.offenses = [{
+            "id": offense_id,
+            "description": f"Benchmark offense {offense_id}",
+            "offense_type": offense_id % 5,
+            "status": "OPEN",
+            "start_time": 1700000000000 + offense_id,
+            "last_updated_time": 1700000000000 + offense_id,
+            "source_address_ids": [offense_id % addresses_count],
+            "local_destination_address_ids": [(offense_id * 7) % addresses_count],
+            "categories": ["Benchmark category"] * 20, #Unused fields, removed by the fields projection
+            "rules": [{"id": rule_id, "type": "CRE_RULE"} for rule_id in range(10)],
+        } for offense_id in range(FIRST_OFFENSE_ID, FIRST_OFFENSE_ID + offenses_count)]
+
+    def start(self) -> None:
+        self.start_time = time.monotonic()
+
+    def available_time(self, offense_id:int) -> float:
+        '''Returns the monotonic time when an offense became visible on the fake QRADAR.'''
+        if not self.arrival_rate:
+            return self.start_time
+        return self.start_time + (offense_id - FIRST_OFFENSE_ID) / self.arrival_rate
+
+    def visible_offenses(self) -> List[Dict[any,any]]:
+        if self.start_time is None:
+            return []
+        if not self.arrival_rate:
+            return self.offenses
+        return self.offenses[:min(self.offenses_count, int((time.monotonic() - self.start_time) * self.arrival_rate) + 1)]
+
+    def get_offenses(self, query:Dict[str,List[str]], range_header:str) -> List[Dict[any,any]]:
+        offense_filter = parse_filter(query.get("filter", [""])[0])
+        offenses = sort_offenses([offense for offense in self.visible_offenses() if offense_filter(offense)], query.get("sort", [""])[0])
+        if range_header:
+            first, last = map(int, range_header.split("=")[1].split("-"))
+            offenses = offenses[first:last + 1]
+        fields = query.get("fields", [""])[0]
+        if fields:
+            field_names = fields.split(",")
+            offenses = [{field: offense[field] for field in field_names if field in offense} for offense in offenses]
+        return offenses
+
+    def get_addresses(self, endpoint:str, query:Dict[str,List[str]]) -> List[Dict[any,any]]:
+        ip_field = "source_ip" if endpoint == "source_addresses" else "local_destination_ip"
+        address_ids = [int(address_id) for address_id in re.findall(r"\d+", query.get("filter", [""])[0])]
+        return [{"id": address_id, ip_field: f"10.{address_id // 65536 % 256}.{address_id // 256 % 256}.{address_id % 256}"} for address_id in address_ids]
+
+class FakeJira:
+    '''Local stand-in of the JIRA issue creation API, with configurable latency, error rate and 429 injection. It records when the ticket of every offense was created.'''
+
+    def __init__(self, latency:float, error_rate:float, throttle_rate:float, retry_after:int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.created_times: Dict[int,List[float]] = {} #Offense ID -> monotonic time of every ticket created for it
+        self.requests_count = 0
+        self.errors_count = 0
+        self.throttled_count = 0
+        self.issues_count = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(42)
+
+    def inject_failure(self) -> int:
+        '''Returns the error status to answer with (429 or 500), or None to answer normally.'''
+        with self.lock:
+            self.requests_count += 1
+            draw = self.random.random()
+            if draw < self.throttle_rate:
+                self.throttled_count += 1
+                return 429
+            if draw < self.throttle_rate + self.error_rate:
+                self.errors_count += 1
+                return 500
+        return None
+
+    def create_issue(self, issue:Dict[any,any]) -> Dict[str,str]:
+        match = re.search(r"QRadar Offense (\d+)", issue["fields"]["summary"])
+        with self.lock:
+            self.issues_count += 1
+            key = f"BENCH-{self.issues_count}"
+            if match:
+                self.created_times.setdefault(int(match.group(1)), []).append(time.monotonic())
+        return {"id": str(self.issues_count), "key": key}
+
+def build_handler(qradar:FakeQRadar, jira:FakeJira):
+    '''Builds the HTTP request handler class serving both fake APIs on the same port.'''
+
+    class FakeApiRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True #Sets TCP_NODELAY: the headers and the body are two unbuffered writes, so Nagle would delay every response until the client's delayed ACK (about 40ms)
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status:int, body:any, headers:Dict[str,str] = None) -> None:
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if qradar.latency:
+                time.sleep(qradar.latency)
+            with qradar.lock:
+                qradar.requests_count += 1
+            if url.path == "/api/siem/offenses":
+                return self.send_json(200, qradar.get_offenses(query, self.headers.get("Range")))
+            if url.path in ("/api/siem/source_addresses", "/api/siem/local_destination_addresses"):
+                return self.send_json(200, qradar.get_addresses(url.path.rsplit("/", 1)[1], query))
+            self.send_json(404, {"message": "Not found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if jira.latency:
+                time.sleep(jira.latency)
+            failure_status = jira.inject_failure()
+            if failure_status == 429:
+                return self.send_json(429, {"errorMessages": ["Rate limit exceeded"]}, {"Retry-After": str(jira.retry_after)})
+            if failure_status == 500:
+                return self.send_json(500, {"errorMessages": ["Injected error"]})
+            if url.path == "/rest/api/3/issue":
+                return self.send_json(201, jira.create_issue(body))
+            if url.path == "/rest/api/3/issue/bulk":
+                return self.send_json(201, {"issues": [jira.create_issue(issue) for issue in body.get("issueUpdates", [])], "errors": []})
+            if url.path.startswith("/rest/api/3/issue/") and url.path.endswith("/comment"):
+                return self.send_json(201, {"id": "1"})
+            self.send_json(404, {"errorMessages": ["Not found"]})
+
+    return FakeApiRequestHandler
+
+def start_fake_servers(qradar:FakeQRadar, jira:FakeJira, port:int = 0) -> ThreadingHTTPServer:
+    '''Starts the fake QRADAR and JIRA APIs on a local port, on a daemon thread.
+
+    :param FakeQRadar qradar: Fake QRADAR state.
+    :param FakeJira jira: Fake JIRA state.
+    :param int port: Port to listen on. 0 picks a free one.
+    :return: The started server. Its port is on server.server_address[1].
+    :rtype: ThreadingHTTPServer
+    '''
+    server = ThreadingHTTPServer(("127.0.0.1", port), build_handler(qradar, jira))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake_servers", daemon=True).start()
+    return server
@@ -0,0 +1,170 @@
+'''Runs the real qradar2jira_app pipeline against local stand-ins of QRADAR and JIRA and reports its throughput, end-to-end latency, memory and duplicated/lost offenses.
+Everything runs offline. Example:
+
+    python benchmarks/run_benchmark.py --offenses 2000 --jira-latency 0.05 --error-rate 0.02 --throttle-rate 0.01
+'''
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+from fake_servers import FIRST_OFFENSE_ID, FakeJira, FakeQRadar, start_fake_servers
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+FINISHED_CHECK_SECONDS = 0.2 #Time between two checks of the tickets created on the fake JIRA
+
+CONFIG_TEMPLATE = '''[MainConfig]
+qradar_url = {base_url}/api/siem/offenses
+qradar_api_key = benchmark
+failed_processed_id_file = failed_processed_ids.txt
+failed_offenses_store_file = failed_offenses.db
+offense_issue_index_file = offense_jira_issues.db
+last_processed_id_file = last_processed_id.txt
+last_updated_time_file = last_updated_time.txt
+jira_url = {base_url}/rest/api/3/issue
+jira_user = benchmark
+jira_api_token = benchmark
+jira_project_key = BENCH
+
+[Logging]
+logging_level = {logging_level}
+cli_logging_enabled = false
+
+[OffensesPollingRate]
+polling_rate_new_offenses_checking = 1
+polling_rate_offenses_failure_reuploading = 5
+
+[FailedOffensesRetry]
+retry_base_delay = 1
+retry_max_delay = 4
+retry_max_attempts = 20
+
+[OffensesProcessing]
+drain_mode_enabled = true
+offenses_page_size = {page_size}
+jira_upload_workers = {workers}
+jira_bulk_enabled = {bulk}
+jira_bulk_max_linger = 1
+streaming_json_parsing_enabled = {streaming}
+
+[JiraRateLimit]
+jira_requests_per_second = {jira_requests_per_second}
+jira_burst = {jira_requests_per_second}
+jira_max_concurrency = {workers}
+
+[Runtime]
+runtime = {runtime}
+'''
+
+def parse_arguments(argv:List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark of the QRADAR to JIRA pipeline against local fake QRADAR and JIRA servers.")
+    parser.add_argument("--offenses", type=int, default=1000, help="Number of offenses served by the fake QRADAR.")
+    parser.add_argument("--arrival-rate", type=float, default=0, help="Offenses per second appearing on the fake QRADAR. 0 makes every offense visible at start.")
+    parser.add_argument("--qradar-latency", type=float, default=0.01, help="Seconds taken by every fake QRADAR response.")
+    parser.add_argument("--jira-latency", type=float, default=0.05, help="Seconds taken by every fake JIRA response.")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of JIRA requests answered with a 500 error.")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="Fraction of JIRA requests answered with a 429 error.")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent on the 429 errors.")
+    parser.add_argument("--addresses", type=int, default=100, help="Number of distinct source and destination addresses of the offenses.")
+    parser.add_argument("--page-size", type=int, default=50, help="offenses_page_size of the app.")
+    parser.add_argument("--workers", type=int, default=8, help="jira_upload_workers and jira_max_concurrency of the app.")
+    parser.add_argument("--jira-requests-per-second", type=int, default=1000, help="jira_requests_per_second of the app.")
+    parser.add_argument("--bulk", action="store_true", help="Enable the JIRA bulk creation.")
+    parser.add_argument("--streaming", action="store_true", help="Enable the streaming JSON parsing of the offense pages.")
+    parser.add_argument("--runtime", choices=("threads", "asyncio"), default="threads", help="Runtime of the app.")
+    parser.add_argument("--timeout", type=float, default=300, help="Max seconds to wait for every offense to have a JIRA ticket.")
+    parser.add_argument("--logging-level", default="warning", help="logging_level of the app.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    return parser.parse_args(argv)
+
+def percentile(values:list, fraction:float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def run_benchmark(arguments:argparse.Namespace) -> Dict[str,any]:
+    '''Runs the app against the fake servers until every offense has a JIRA ticket or the timeout is reached.
+
+    :param Namespace arguments: Parsed command line arguments.
+    :return: The benchmark report.
+    :rtype: Dict[str,any]
+    '''
+    qradar = FakeQRadar(arguments.offenses, arguments.arrival_rate, arguments.qradar_latency, arguments.addresses)
+    jira = FakeJira(arguments.jira_latency, arguments.error_rate, arguments.throttle_rate, arguments.retry_after)
+    server = start_fake_servers(qradar, jira)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory(prefix="qradar2jira_benchmark_") as work_dir:
+        os.makedirs(os.path.join(work_dir, "logs"))
+        with open(os.path.join(work_dir, "config.ini"), "w") as file:
+            file.write(CONFIG_TEMPLATE.format(base_url=base_url, logging_level=arguments.logging_level, page_size=arguments.page_size, workers=arguments.workers,
+                                              bulk=str(arguments.bulk).lower(), streaming=str(arguments.streaming).lower(),
+                                              jira_requests_per_second=arguments.jira_requests_per_second, runtime=arguments.runtime))
+        with open(os.path.join(work_dir, "last_processed_id.txt"), "w") as file:
+            file.write(str(FIRST_OFFENSE_ID - 1))
+
+        qradar.start()
+        app_errors_file = open(os.path.join(work_dir, "app_stderr.txt"), "w+")
+        app = subprocess.Popen([sys.executable, os.path.join(APP_DIR, "qradar2jira_app.py")], cwd=work_dir, stdout=subprocess.DEVNULL, stderr=app_errors_file)
+        try:
+            while time.monotonic() - qradar.start_time < arguments.timeout and app.poll() is None:
+                with jira.lock:
+                    created_offenses_count = len(jira.created_times)
+                if created_offenses_count >= arguments.offenses:
+                    break
+                time.sleep(FINISHED_CHECK_SECONDS)
+            elapsed_seconds = time.monotonic() - qradar.start_time
+            time.sleep(FINISHED_CHECK_SECONDS) #Late duplicates of in-flight retries are still counted
+        finally:
+            app.terminate()
+            try:
+                app.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                app.kill()
+                app.wait()
+            app_errors_file.seek(0)
+            app_errors = app_errors_file.read()
+            app_errors_file.close()
+    server.shutdown()
+
+    with jira.lock:
+        created_times = {offense_id: list(times) for offense_id, times in jira.created_times.items()}
+    latencies = [times[0] - qradar.available_time(offense_id) for offense_id, times in created_times.items()]
+    last_creation_time = max((times[0] for times in created_times.values()), default=qradar.start_time)
+    return {
+        "offenses": arguments.offenses,
+        "created": len(created_times),
+        "lost": arguments.offenses - len(created_times),
+        "duplicated": sum(len(times) - 1 for times in created_times.values()),
+        "elapsed_seconds": round(elapsed_seconds, 3),
+        "offenses_per_second": round(len(created_times) / max(last_creation_time - qradar.start_time, 1e-9), 2),
+        "latency_p50_seconds": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "latency_p99_seconds": round(percentile(latencies, 0.99), 3) if latencies else None,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1), #ru_maxrss is in KB on Linux
+        "qradar_requests": qradar.requests_count,
+        "jira_requests": jira.requests_count,
+        "jira_errors_injected": jira.errors_count,
+        "jira_throttled_injected": jira.throttled_count,
+        "app_exit_code": app.returncode,
+        "app_errors": app_errors[-2000:] if app.returncode not in (0, -15) else "",
+    }
+
+def main():
+    arguments = parse_arguments()
+    report = run_benchmark(arguments)
+    if arguments.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name, value in report.items():
+            if name != "app_errors" or value:
+                print(f"{name}: {value}")
+    if report["lost"] or report["duplicated"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#The app modules import each other by their bare name, as they are run from the app folder
+for folder in ("app", "benchmarks"):
+    sys.path.insert(0, os.path.join(REPO_DIR, folder))
@@ -0,0 +1,73 @@
+import argparse
+import json
+import pytest
+import backfill_offenses_to_jira as backfill
+from backfill_offenses_to_jira import load_progress, parse_arguments, parse_time, save_progress, split_range
+
+def test_parse_time_accepts_epoch_milliseconds_and_iso_dates():
+    assert parse_time("1704067200000") == 1704067200000
+    assert parse_time("2024-01-01T00:00:00") == 1704067200000 #UTC unless it has a timezone
+    assert parse_time("2024-01-01T00:00:00Z") == 1704067200000
+    assert parse_time("2024-01-01T02:00:00+02:00") == 1704067200000
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_time("yesterday")
+
+def test_parse_arguments_id_range():
+    arguments = parse_arguments(["--from-id", "10", "--to-id", "20"])
+    assert (arguments.from_id, arguments.to_id, arguments.from_time) == (10, 20, None)
+
+def test_parse_arguments_time_range():
+    arguments = parse_arguments(["--from-time", "2024-01-01T00:00:00Z", "--to-time", "1704153600000", "--all-statuses"])
+    assert (arguments.from_time, arguments.to_time, arguments.all_statuses) == (1704067200000, 1704153600000, True)
+
+@pytest.mark.parametrize("command_line", [
+    [],
+    ["--from-id", "10"],
+    ["--from-id", "20", "--to-id", "10"],
+    ["--from-id", "10", "--to-id", "20", "--from-time", "1", "--to-time", "2"],
+    ["--from-time", "5", "--to-time", "5"],
+    ["--from-id", "10", "--to-id", "20", "--sub-ranges", "0"],
+])
+def test_parse_arguments_rejects_invalid_ranges(command_line):
+    with pytest.raises(SystemExit):
+        parse_arguments(command_line)
+
+def test_split_range_covers_the_whole_range():
+    sub_ranges = split_range(100, 200, 3)
+    assert [(sub_range["start"], sub_range["end"]) for sub_range in sub_ranges] == [(100, 133), (133, 166), (166, 200)]
+    assert all(sub_range["cursor"] is None and not sub_range["done"] for sub_range in sub_ranges)
+    assert len(split_range(1, 3, 16)) == 2 #Less sub-ranges than requested for a small range
+
+def test_id_range_includes_the_last_offense_id(tmp_path):
+    progress = load_progress(parse_arguments(["--from-id", "10", "--to-id", "20", "--sub-ranges", "2", "--progress-file", str(tmp_path / "progress.json")]))
+    assert (progress["field"], progress["start"], progress["end"]) == ("id", 10, 21)
+    assert [(sub_range["start"], sub_range["end"]) for sub_range in progress["sub_ranges"]] == [(10, 15), (15, 21)]
+
+def test_interrupted_backfill_is_resumed_from_the_progress_file(tmp_path, monkeypatch):
+    command_line = ["--from-time", "1000", "--to-time", "2000", "--sub-ranges", "4", "--progress-file", str(tmp_path / "progress.json")]
+    progress = load_progress(parse_arguments(command_line))
+    progress["sub_ranges"][0].update({"cursor": 42, "done": True})
+    progress["sub_ranges"][1]["cursor"] = 57
+    progress["created"] = 3
+    monkeypatch.setattr(backfill, "progress", progress)
+    save_progress(str(tmp_path / "progress.json"))
+
+    resumed_progress = load_progress(parse_arguments(command_line + ["--sub-ranges", "8"]))
+    assert resumed_progress == json.loads(json.dumps(progress)) #The saved sub-ranges are kept, whatever --sub-ranges says now
+    assert [sub_range["cursor"] for sub_range in resumed_progress["sub_ranges"]] == [42, 57, None, None]
+
+def test_progress_file_of_another_backfill_is_rejected(tmp_path, monkeypatch):
+    progress_file = str(tmp_path / "progress.json")
+    monkeypatch.setattr(backfill, "progress", load_progress(parse_arguments(["--from-id", "10", "--to-id", "20", "--progress-file", progress_file])))
+    save_progress(progress_file)
+    with pytest.raises(ValueError):
+        load_progress(parse_arguments(["--from-id", "10", "--to-id", "30", "--progress-file", progress_file]))
+    with pytest.raises(ValueError):
+        load_progress(parse_arguments(["--from-id", "10", "--to-id", "20", "--all-statuses", "--progress-file", progress_file]))
+
+def test_dry_run_ignores_the_progress_file(tmp_path, monkeypatch):
+    progress_file = str(tmp_path / "progress.json")
+    monkeypatch.setattr(backfill, "progress", load_progress(parse_arguments(["--from-id", "10", "--to-id", "20", "--progress-file", progress_file])))
+    save_progress(progress_file)
+    progress = load_progress(parse_arguments(["--from-id", "10", "--to-id", "30", "--dry-run", "--progress-file", progress_file]))
+    assert progress["end"] == 31
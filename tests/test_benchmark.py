@@ -0,0 +1,38 @@
+import pytest
+from fake_servers import FIRST_OFFENSE_ID, FakeQRadar, parse_filter, sort_offenses
+from run_benchmark import parse_arguments, run_benchmark
+
+def build_qradar(offenses_count:int = 10) -> FakeQRadar:
+    qradar = FakeQRadar(offenses_count, 0, 0, 10)
+    qradar.start()
+    return qradar
+
+def test_filter_honors_status_and_id():
+    qradar = build_qradar()
+    qradar.offenses[3]["status"] = "CLOSED"
+    offense_ids = [offense["id"] for offense in qradar.get_offenses({"filter": [f"status=OPEN and id > {FIRST_OFFENSE_ID + 1}"]}, None)]
+    assert offense_ids == [FIRST_OFFENSE_ID + 2, FIRST_OFFENSE_ID + 4, FIRST_OFFENSE_ID + 5, FIRST_OFFENSE_ID + 6, FIRST_OFFENSE_ID + 7, FIRST_OFFENSE_ID + 8, FIRST_OFFENSE_ID + 9]
+
+def test_filter_supports_in_and_nested_or():
+    offenses = [{"id": 1, "last_updated_time": 10}, {"id": 2, "last_updated_time": 10}, {"id": 3, "last_updated_time": 11}, {"id": 4, "last_updated_time": 9}]
+    updated_filter = parse_filter("(last_updated_time > 10 or (last_updated_time = 10 and id > 1))")
+    assert [offense["id"] for offense in offenses if updated_filter(offense)] == [2, 3]
+    assert [offense["id"] for offense in offenses if parse_filter("id in (1,4)")(offense)] == [1, 4]
+    assert [offense["id"] for offense in offenses if parse_filter("")(offense)] == [1, 2, 3, 4]
+
+def test_sort_honors_every_field_and_order():
+    offenses = [{"id": 1, "last_updated_time": 11}, {"id": 2, "last_updated_time": 10}, {"id": 3, "last_updated_time": 10}]
+    assert [offense["id"] for offense in sort_offenses(offenses, "-id")] == [3, 2, 1]
+    assert [offense["id"] for offense in sort_offenses(offenses, "+last_updated_time,+id")] == [2, 3, 1]
+    assert [offense["id"] for offense in sort_offenses(offenses, "+last_updated_time,-id")] == [3, 2, 1]
+
+def test_range_and_fields_projection():
+    qradar = build_qradar()
+    assert qradar.get_offenses({"sort": ["-id"], "fields": ["id"]}, "items=0-0") == [{"id": FIRST_OFFENSE_ID + 9}]
+
+@pytest.mark.parametrize("options", [[], ["--bulk"], ["--streaming"]])
+def test_benchmark_creates_every_offense_once(options):
+    report = run_benchmark(parse_arguments(["--offenses", "150", "--page-size", "20", "--qradar-latency", "0", "--jira-latency", "0",
+                                            "--error-rate", "0.05", "--throttle-rate", "0.02", "--timeout", "60"] + options))
+    assert report["lost"] == 0, report["app_errors"]
+    assert report["duplicated"] == 0
@@ -0,0 +1,64 @@
+import os
+from checkpoint import Checkpoint, write_file_atomically
+
+def read(file_path) -> str:
+    with open(file_path) as file:
+        return file.read()
+
+def test_write_file_atomically_replaces_the_content(tmp_path):
+    file_path = tmp_path / "watermark.txt"
+    write_file_atomically(str(file_path), "100")
+    write_file_atomically(str(file_path), "200")
+    assert read(file_path) == "200"
+    assert os.listdir(tmp_path) == ["watermark.txt"] #No temporary file is left behind
+
+def test_load_missing_or_empty_file(tmp_path):
+    assert Checkpoint(str(tmp_path / "missing.txt"), 10, 60).load() is None
+    (tmp_path / "empty.txt").write_text("\n")
+    assert Checkpoint(str(tmp_path / "empty.txt"), 10, 60).load() is None
+
+def test_load_reads_the_watermark(tmp_path):
+    (tmp_path / "watermark.txt").write_text("1234\n")
+    checkpoint = Checkpoint(str(tmp_path / "watermark.txt"), 10, 60)
+    assert checkpoint.load() == 1234
+    assert checkpoint.value == 1234
+
+def test_updates_are_coalesced_until_flush_every(tmp_path):
+    file_path = tmp_path / "watermark.txt"
+    file_path.write_text("100")
+    checkpoint = Checkpoint(str(file_path), 3, 3600)
+    checkpoint.load()
+    checkpoint.update(101)
+    checkpoint.update(102)
+    assert read(file_path) == "100"
+    checkpoint.update(103)
+    assert read(file_path) == "103"
+    assert checkpoint.pending_updates == 0
+
+def test_update_writes_once_the_flush_interval_passed(tmp_path):
+    file_path = tmp_path / "watermark.txt"
+    checkpoint = Checkpoint(str(file_path), 1000, 0)
+    checkpoint.update(5)
+    assert read(file_path) == "5"
+
+def test_flush_if_due_waits_for_the_flush_interval(tmp_path):
+    file_path = tmp_path / "watermark.txt"
+    checkpoint = Checkpoint(str(file_path), 1000, 3600)
+    checkpoint.update(7)
+    checkpoint.flush_if_due()
+    assert not file_path.exists()
+    checkpoint.flush_interval = 0
+    checkpoint.flush_if_due()
+    assert read(file_path) == "7"
+
+def test_flush_writes_only_changed_values(tmp_path):
+    file_path = tmp_path / "watermark.txt"
+    checkpoint = Checkpoint(str(file_path), 1000, 3600)
+    checkpoint.flush()
+    assert not file_path.exists() #Nothing to save yet
+    checkpoint.update(9)
+    checkpoint.flush()
+    assert read(file_path) == "9"
+    file_path.write_text("changed outside")
+    checkpoint.flush()
+    assert read(file_path) == "changed outside" #The value did not change since the last write
@@ -0,0 +1,71 @@
+import time
+from email.utils import formatdate
+import pytest
+from jira_rate_governor import CONCURRENCY_WAIT_SECONDS, THROTTLED_DEFAULT_PAUSE_SECONDS, JiraRateGovernor, get_pause_seconds, parse_http_time
+
+def test_token_bucket_allows_the_burst_and_then_waits():
+    governor = JiraRateGovernor(requests_per_second=1, burst=2, min_concurrency=1, max_concurrency=10, latency_target=5)
+    assert governor.try_acquire() == 0
+    assert governor.try_acquire() == 0
+    assert 0 < governor.try_acquire() <= 1
+    assert governor.in_flight == 2
+
+def test_concurrency_limit_waits_for_a_free_slot():
+    governor = JiraRateGovernor(requests_per_second=1000, burst=1000, min_concurrency=1, max_concurrency=1, latency_target=5)
+    assert governor.try_acquire() == 0
+    assert governor.try_acquire() == CONCURRENCY_WAIT_SECONDS
+    governor.release(201, {}, 0.01)
+    assert governor.try_acquire() == 0
+
+def test_throttled_response_pauses_every_call_and_halves_the_concurrency():
+    governor = JiraRateGovernor(requests_per_second=1000, burst=1000, min_concurrency=1, max_concurrency=8, latency_target=5)
+    governor.try_acquire()
+    governor.release(429, {"Retry-After": "30"}, 0.01)
+    assert governor.concurrency_limit == 4
+    assert governor.throttled_count == 1
+    assert 29 < governor.try_acquire() <= 30
+
+def test_throttled_response_without_header_pauses_the_default_time():
+    governor = JiraRateGovernor(requests_per_second=1000, burst=1000, min_concurrency=1, max_concurrency=8, latency_target=5)
+    governor.try_acquire()
+    governor.release(503, {}, 0.01)
+    assert 0 < governor.try_acquire() <= THROTTLED_DEFAULT_PAUSE_SECONDS
+
+def test_throttling_storm_only_decreases_the_concurrency_once():
+    governor = JiraRateGovernor(requests_per_second=1000, burst=1000, min_concurrency=1, max_concurrency=8, latency_target=5)
+    for _ in range(3):
+        governor.release(429, {"Retry-After": "0"}, 0.01)
+    assert governor.concurrency_limit == 4
+
+def test_slow_responses_decrease_and_fast_responses_increase_the_concurrency():
+    governor = JiraRateGovernor(requests_per_second=1000, burst=1000, min_concurrency=1, max_concurrency=8, latency_target=0.5)
+    governor.release(201, {}, 2)
+    assert governor.concurrency_limit == 4
+    governor.release(201, {}, 0.01)
+    assert governor.concurrency_limit == pytest.approx(4.25)
+    for _ in range(100):
+        governor.release(201, {}, 0.01)
+    assert governor.concurrency_limit == 8
+
+def test_reconfigure_caps_the_concurrency_and_the_tokens():
+    governor = JiraRateGovernor(requests_per_second=10, burst=10, min_concurrency=1, max_concurrency=8, latency_target=5)
+    governor.reconfigure(requests_per_second=1, burst=1, max_concurrency=2, latency_target=1)
+    assert governor.concurrency_limit == 2
+    assert governor.try_acquire() == 0
+    assert governor.try_acquire() > 0
+
+def test_pause_seconds_from_retry_after_seconds_and_http_date():
+    assert get_pause_seconds(429, {"Retry-After": "12"}) == 12
+    assert 55 < get_pause_seconds(429, {"Retry-After": formatdate(time.time() + 60, usegmt=True)}) <= 60
+
+def test_pause_seconds_from_rate_limit_reset_once_exhausted():
+    reset = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 120))
+    assert 115 < get_pause_seconds(200, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": reset}) <= 120
+    assert get_pause_seconds(200, {"X-RateLimit-Remaining": "10", "X-RateLimit-Reset": reset}) == 0
+    assert get_pause_seconds(200, {}) == 0
+
+def test_parse_http_time():
+    assert parse_http_time("2024-01-01T00:00:00Z") == 1704067200
+    assert parse_http_time("2024-01-01T01:00:00+01:00") == 1704067200
+    assert parse_http_time("Mon, 01 Jan 2024 00:00:00 GMT") == 1704067200
+    assert parse_http_time("not a date") is None
@@ -0,0 +1,61 @@
+import pytest
+from json_stream import JsonArrayStreamParser, iter_json_array
+
+OFFENSES_JSON = '[{"id": 1, "description": "a ] tricky, description"}, {"id": 2, "rules": [{"id": 3}]} , {"id": 4, "description": "\\u00e9"}]'
+
+class FakeStreamedResponse:
+    '''Stand-in of a requests Response made with stream=True.'''
+
+    def __init__(self, body:bytes, chunk_size:int, encoding:str = None):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.closed = False
+
+    def iter_content(self, chunk_size:int):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1000])
+def test_items_are_parsed_whatever_the_chunk_size(chunk_size):
+    parser = JsonArrayStreamParser()
+    items = []
+    for start in range(0, len(OFFENSES_JSON), chunk_size):
+        items.extend(parser.feed(OFFENSES_JSON[start:start + chunk_size]))
+    parser.close()
+    assert items == [{"id": 1, "description": "a ] tricky, description"}, {"id": 2, "rules": [{"id": 3}]}, {"id": 4, "description": "é"}]
+
+def test_items_are_returned_as_soon_as_they_are_complete():
+    parser = JsonArrayStreamParser()
+    assert parser.feed('[{"id": 1}, {"id"') == [{"id": 1}]
+    assert parser.feed(': 2}]') == [{"id": 2}]
+    parser.close()
+
+def test_empty_array():
+    parser = JsonArrayStreamParser()
+    assert parser.feed(" [ ] ") == []
+    parser.close()
+
+def test_not_an_array_is_rejected():
+    with pytest.raises(ValueError):
+        JsonArrayStreamParser().feed('{"id": 1}')
+
+def test_truncated_array_is_rejected_on_close():
+    parser = JsonArrayStreamParser()
+    parser.feed('[{"id": 1}, {"id": 2')
+    with pytest.raises(ValueError):
+        parser.close()
+
+def test_iter_json_array_decodes_multibyte_characters_split_across_chunks():
+    response = FakeStreamedResponse(OFFENSES_JSON.replace("\\u00e9", "é").encode("utf-8"), 3)
+    assert [item["id"] for item in iter_json_array(response)] == [1, 2, 4]
+    assert response.closed
+
+def test_iter_json_array_closes_the_response_on_error():
+    response = FakeStreamedResponse(b'[{"id": 1}, {"id": ', 4)
+    with pytest.raises(ValueError):
+        list(iter_json_array(response))
+    assert response.closed
@@ -0,0 +1,45 @@
+from polling_scheduler import AdaptivePollingScheduler
+
+def test_full_page_polls_again_right_away():
+    scheduler = AdaptivePollingScheduler(10, 300, 2)
+    assert scheduler.record_poll(50, page_full=True) == 0
+    assert scheduler.record_poll(3, page_full=False) == 10
+
+def test_idle_polls_back_off_up_to_max_interval():
+    scheduler = AdaptivePollingScheduler(10, 60, 2)
+    assert [scheduler.record_poll(0, page_full=False) for _ in range(5)] == [10, 20, 40, 60, 60]
+
+def test_new_offenses_reset_the_backoff():
+    scheduler = AdaptivePollingScheduler(10, 300, 2)
+    for _ in range(3):
+        scheduler.record_poll(0, page_full=False)
+    assert scheduler.record_poll(1, page_full=False) == 10
+    assert scheduler.record_poll(0, page_full=False) == 10
+
+def test_backoff_after_a_full_page_starts_from_min_interval():
+    scheduler = AdaptivePollingScheduler(10, 300, 2)
+    scheduler.record_poll(50, page_full=True)
+    assert scheduler.record_poll(0, page_full=False) == 10
+    assert scheduler.record_poll(0, page_full=False) == 20
+
+def test_probes_only_while_idle():
+    scheduler = AdaptivePollingScheduler(10, 300, 2)
+    assert not scheduler.should_probe()
+    scheduler.record_poll(0, page_full=False)
+    assert scheduler.should_probe()
+    scheduler.record_poll(1, page_full=False)
+    assert not scheduler.should_probe()
+
+def test_max_interval_is_never_lower_than_min_interval():
+    scheduler = AdaptivePollingScheduler(30, 10, 2)
+    assert scheduler.max_interval == 30
+    assert [scheduler.record_poll(0, page_full=False) for _ in range(3)] == [30, 30, 30]
+
+def test_reconfigure_caps_the_current_wait():
+    scheduler = AdaptivePollingScheduler(10, 300, 2)
+    for _ in range(5):
+        scheduler.record_poll(0, page_full=False)
+    assert scheduler.interval == 160
+    scheduler.reconfigure(5, 100, 3)
+    assert scheduler.interval == 100
+    assert scheduler.record_poll(0, page_full=False) == 100
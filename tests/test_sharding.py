@@ -0,0 +1,53 @@
+import time
+import pytest
+import sharding
+from sharding import ShardLeaseStore, get_shard_file, get_shard_watermark_file, offense_in_shard
+
+def test_every_instance_gets_its_own_shard(tmp_path):
+    store = ShardLeaseStore(str(tmp_path / "leases.db"), 2, 60)
+    assert store.try_acquire("instance-a") == 0
+    assert store.try_acquire("instance-b") == 1
+    assert store.try_acquire("instance-c") is None #Standby until a lease is free
+
+def test_restarted_instance_takes_its_shard_back(tmp_path):
+    store = ShardLeaseStore(str(tmp_path / "leases.db"), 2, 60)
+    store.try_acquire("instance-a")
+    store.try_acquire("instance-b")
+    assert store.try_acquire("instance-b") == 1
+
+def test_released_or_expired_lease_is_taken_over(tmp_path):
+    store = ShardLeaseStore(str(tmp_path / "leases.db"), 1, 60)
+    assert store.try_acquire("instance-a") == 0
+    store.release(0, "instance-a")
+    assert store.try_acquire("instance-b") == 0
+    assert not store.renew(0, "instance-a")
+    assert store.renew(0, "instance-b")
+
+    expiring_store = ShardLeaseStore(str(tmp_path / "expiring_leases.db"), 1, 0)
+    assert expiring_store.try_acquire("instance-a") == 0
+    time.sleep(0.01)
+    assert expiring_store.try_acquire("instance-b") == 0
+
+def test_instances_must_share_the_shard_count(tmp_path):
+    ShardLeaseStore(str(tmp_path / "leases.db"), 2, 60)
+    with pytest.raises(ValueError):
+        ShardLeaseStore(str(tmp_path / "leases.db"), 3, 60)
+
+def test_offense_in_shard(monkeypatch):
+    assert offense_in_shard(7) #Sharding disabled
+    monkeypatch.setattr(sharding, "shard_index", 1)
+    monkeypatch.setattr(sharding, "shard_count", 3)
+    assert [offense_id for offense_id in range(10) if offense_in_shard(offense_id)] == [1, 4, 7]
+
+def test_shard_files():
+    assert get_shard_file("data/last_processed_id.txt", 0, 4) == "data/last_processed_id.shard0of4.txt"
+    assert get_shard_file("jira_spool.db", 3, 4) == "jira_spool.shard3of4.db"
+
+def test_shard_watermark_starts_from_the_unsharded_watermark(tmp_path):
+    (tmp_path / "last.txt").write_text("500")
+    shard_file = get_shard_watermark_file(str(tmp_path / "last.txt"), 1, 2)
+    assert shard_file == str(tmp_path / "last.shard1of2.txt")
+    assert (tmp_path / "last.shard1of2.txt").read_text() == "500"
+    (tmp_path / "last.shard1of2.txt").write_text("600")
+    get_shard_watermark_file(str(tmp_path / "last.txt"), 1, 2)
+    assert (tmp_path / "last.shard1of2.txt").read_text() == "600" #An existing shard watermark is kept